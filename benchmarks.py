@@ -0,0 +1,363 @@
+"""
+Microbenchmarks for MediGuide's per-message hot paths.
+
+Usage:
+    python benchmarks.py              # Run all benchmarks
+    python benchmarks.py extraction   # Run selected benchmarks by name
+
+Each benchmark compares the current implementation in code.py with a copy of
+the implementation it replaced, so before/after numbers come from one run.
+"""
+
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+import time
+import timeit
+import types
+
+# code.py shares its name with the standard library `code` module, so load it by path
+_spec = importlib.util.spec_from_file_location("mediguide", os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py"))
+mediguide = importlib.util.module_from_spec(_spec)
+sys.modules["mediguide"] = mediguide
+_spec.loader.exec_module(mediguide)
+
+import logging
+logging.getLogger().setLevel(logging.ERROR) # Extraction logs at INFO level on every call
+
+SAMPLE_MESSAGES = [
+    "My blood pressure is 120/80 and my pulse is 72 bpm.",
+    "Temp was 101.2 F this morning, glucose 110 mg/dl, spo2 96%",
+    "I'm 34 years old, my height is 5 ft 10 in and I weigh 170 lbs.",
+    "I have a mild headache and a runny nose since yesterday, what should I do?",
+    "What are the symptoms of seasonal allergies?",
+    "How can I improve my sleep quality? I've been feeling tired and stressed at work lately, "
+    "and I usually only get about five hours a night.",
+]
+
+
+def _report(name, seconds_per_call_before, seconds_per_call_after):
+    speedup = seconds_per_call_before / seconds_per_call_after if seconds_per_call_after else float("inf")
+    print(f"{name:<32} before: {seconds_per_call_before * 1e6:8.2f} us/msg   "
+          f"after: {seconds_per_call_after * 1e6:8.2f} us/msg   speedup: {speedup:5.2f}x")
+
+
+def _time_per_message(func, messages, number):
+    total = timeit.timeit(lambda: [func(m) for m in messages], number=number)
+    return total / (number * len(messages))
+
+
+# --- Vital-sign extraction (user-004) ---
+
+def legacy_extract_vital_signs(message):
+    """The per-vital re.search extraction used before the single-pass extractor."""
+    message_lower = message.lower()
+    extracted_data = {}
+    bp_match = re.search(r'(?:blood pressure|bp)\s*(?:is|was|:|)\s*(\d{2,3})\s*/\s*(\d{2,3})', message_lower, re.IGNORECASE)
+    if bp_match:
+        extracted_data["blood_pressure"] = f"{bp_match.group(1)}/{bp_match.group(2)}"
+    temp_match = re.search(r'(?:temperature|temp)\s*(?:is|was|:|)\s*(\d{2,3}(?:\.\d)?)\s*(?:°|degrees)?\s*([CF])?', message_lower, re.IGNORECASE)
+    if temp_match:
+        value = float(temp_match.group(1))
+        unit = temp_match.group(2).upper() if temp_match.group(2) else None
+        if not unit:
+            unit = "°F" if value > 50 else "°C"
+        elif unit == 'F': unit = "°F"
+        elif unit == 'C': unit = "°C"
+        extracted_data["temperature"] = {"value": value, "unit": unit}
+    hr_match = re.search(r'(?:heart rate|hr|pulse)\s*(?:is|was|:|)\s*(\d{2,3})\s*(bpm)?', message_lower, re.IGNORECASE)
+    if hr_match:
+        extracted_data["heart_rate"] = {"value": int(hr_match.group(1)), "unit": "bpm"}
+    sugar_match = re.search(r'(?:blood sugar|glucose|sugar level)\s*(?:is|was|:|)\s*(\d{1,3}(?:\.\d)?)\s*(mg/dl|mmol/l)?', message_lower, re.IGNORECASE)
+    if sugar_match:
+        unit = sugar_match.group(2) if sugar_match.group(2) else "mg/dL"
+        extracted_data["blood_sugar"] = {"value": float(sugar_match.group(1)), "unit": unit}
+    spo2_match = re.search(r'(?:spo2|oxygen saturation|o2 sat)\s*(?:is|was|:|)\s*(\d{2,3})\s*(%)?', message_lower, re.IGNORECASE)
+    if spo2_match:
+        extracted_data["oxygen_saturation"] = {"value": int(spo2_match.group(1)), "unit": "%"}
+    weight_match = re.search(r'(?:weight|weighs|weigh)\s*(?:is|was|:|)\s*(\d{2,4}(?:\.\d)?)\s*(kg|kilos|kilograms|lb|lbs|pounds)', message_lower, re.IGNORECASE)
+    if weight_match:
+        value = float(weight_match.group(1))
+        unit_str = weight_match.group(2).lower()
+        if "lb" in unit_str or "pound" in unit_str:
+            value = round(value * 0.453592, 1)
+        extracted_data["weight_kg"] = {"value": value, "unit": "kg"}
+    height_cm_match = re.search(r'(?:height|tall)\s*(?:is|was|:|)\s*(\d{2,3}(?:\.\d)?)\s*(cm|centimeters)', message_lower, re.IGNORECASE)
+    height_m_match = re.search(r'(?:height|tall)\s*(?:is|was|:|)\s*(\d(?:\.\d{1,2})?)\s*(m|meters)', message_lower, re.IGNORECASE)
+    height_ft_in_match = re.search(r'(?:height|tall)\s*(?:is|was|:|)\s*(\d+)\s*(?:ft|feet|\')(?:\s*(\d{1,2})\s*(?:in|inches|"))?', message_lower, re.IGNORECASE)
+    if height_cm_match:
+        extracted_data["height_cm"] = {"value": float(height_cm_match.group(1)), "unit": "cm"}
+    elif height_m_match:
+        extracted_data["height_cm"] = {"value": round(float(height_m_match.group(1)) * 100, 1), "unit": "cm"}
+    elif height_ft_in_match:
+        feet = int(height_ft_in_match.group(1))
+        inches = int(height_ft_in_match.group(2)) if height_ft_in_match.group(2) else 0
+        extracted_data["height_cm"] = {"value": round((feet * 12 + inches) * 2.54, 1), "unit": "cm"}
+    age_match = re.search(r'\b(age|aged)\s*(\d{1,3})\b|\bI(?: am|\'m)\s*(\d{1,3})\s*(?:years? old)?\b', message_lower, re.IGNORECASE)
+    if age_match:
+        extracted_data["age"] = int(age_match.group(2) or age_match.group(3))
+    return extracted_data
+
+
+def bench_extraction(number=2000):
+    """Per-message cost of vital-sign extraction, per-vital re.search vs. single compiled pass."""
+    for message in SAMPLE_MESSAGES:
+        assert legacy_extract_vital_signs(message) == mediguide.extract_vital_signs(message), message
+    before = _time_per_message(legacy_extract_vital_signs, SAMPLE_MESSAGES, number)
+    after = _time_per_message(mediguide.extract_vital_signs, SAMPLE_MESSAGES, number)
+    _report("vital-sign extraction", before, after)
+
+
+# --- Emergency keyword matching (user-005) ---
+
+def legacy_emergency_score(message, keywords):
+    """The substring loop that scored emergency keywords before the automaton."""
+    message_lower = message.lower()
+    return sum(score for keyword, score in keywords.items() if keyword in message_lower)
+
+
+def _synthetic_keywords(count):
+    """Deterministic multi-word phrases used to grow the keyword list to realistic sizes."""
+    modifiers = ["sudden", "severe", "sharp", "crushing", "persistent", "acute", "rapid", "extreme", "heavy", "intense"]
+    findings = ["chest pressure", "jaw pain", "arm numbness", "vision loss", "confusion", "bleeding", "swelling",
+                "palpitations", "fainting", "vomiting blood", "neck stiffness", "burns", "choking", "paralysis",
+                "abdominal pain", "back pain", "headache", "dizziness", "wheezing", "rash", "fever", "cold sweat",
+                "blue lips", "slurring", "tremor", "weakness", "shock", "dehydration", "pain", "breathlessness",
+                "hives", "nosebleed", "fracture", "cramping", "numbness", "tingling", "seizures", "blackout",
+                "disorientation", "hallucinations", "agitation", "lethargy", "pallor", "jaundice", "cyanosis",
+                "stridor", "drooling", "lockjaw", "eye pain", "hearing loss"]
+    phrases = [f"{m} {f}" for f in findings for m in modifiers]
+    return {phrase: 5 for phrase in phrases[:count]}
+
+
+def bench_emergency(number=2000):
+    """Per-message cost of emergency keyword scoring: substring loop vs. Aho-Corasick automaton."""
+    keywords = mediguide.EMERGENCY_KEYWORDS
+    for message in SAMPLE_MESSAGES:
+        assert legacy_emergency_score(message, keywords) == mediguide.score_emergency_keywords(message, check_negation=False)[0], message
+    before = _time_per_message(lambda m: legacy_emergency_score(m, keywords), SAMPLE_MESSAGES, number)
+    after = _time_per_message(lambda m: mediguide.score_emergency_keywords(m, check_negation=False), SAMPLE_MESSAGES, number)
+    _report(f"emergency scoring ({len(keywords)} kw)", before, after)
+
+    large_keywords = dict(keywords, **_synthetic_keywords(500))
+    automaton = mediguide.KeywordAutomaton(large_keywords)
+    before = _time_per_message(lambda m: legacy_emergency_score(m, large_keywords), SAMPLE_MESSAGES, number // 4)
+    after = _time_per_message(lambda m: list(automaton.iter_matches(m.lower())), SAMPLE_MESSAGES, number // 4)
+    _report(f"emergency scoring ({len(large_keywords)} kw)", before, after)
+
+
+# --- Symptom matching (user-006) ---
+
+def legacy_identify_potential_conditions(message, symptom_db):
+    """The per-symptom regex scan and specificity rescans used before the inverted symptom index."""
+    message_lower = message.lower()
+    potential_conditions = []
+    reported_symptoms = set()
+    all_known_symptoms = set()
+    for condition_data in symptom_db.values():
+        all_known_symptoms.update(condition_data.get("symptoms", []))
+    for known_symptom in all_known_symptoms:
+        if re.search(r'\b' + re.escape(known_symptom) + r'\b', message_lower, re.IGNORECASE):
+            reported_symptoms.add(known_symptom)
+    if not reported_symptoms:
+        return [], []
+    for condition, condition_data in symptom_db.items():
+        condition_symptoms = set(condition_data.get("symptoms", []))
+        matched_symptoms = list(reported_symptoms.intersection(condition_symptoms))
+        if matched_symptoms:
+            match_percentage = (len(matched_symptoms) / len(condition_symptoms)) * 100 if condition_symptoms else 0
+            total_specificity = 0
+            for symptom in matched_symptoms:
+                count = sum(1 for data in symptom_db.values()
+                            if symptom.lower() in [s.lower() for s in data.get("symptoms", [])])
+                total_specificity += 1.0 / (count + 1) if count > 0 else 0
+            potential_conditions.append({
+                "condition": condition,
+                "matched_symptoms": matched_symptoms,
+                "match_percentage": round(match_percentage, 1),
+                "specificity_score": round(total_specificity / len(matched_symptoms), 3),
+            })
+    potential_conditions.sort(key=lambda x: (x["match_percentage"], x["specificity_score"]), reverse=True)
+    return potential_conditions, list(reported_symptoms)
+
+
+def _synthetic_symptom_db(count):
+    """A deterministic condition database of `count` entries drawn from a shared symptom vocabulary."""
+    vocabulary = sorted({s for data in mediguide.COMMON_SYMPTOMS.values() for s in data["symptoms"]} |
+                        {f"{m} {f}" for m, f in zip(["joint", "lower", "upper", "chronic", "mild", "night", "skin", "eye"] * 8,
+                                                    ["pain", "swelling", "stiffness", "itching", "redness", "sweats", "rash", "dryness"] * 8)})
+    db = dict(mediguide.COMMON_SYMPTOMS)
+    for i in range(count - len(db)):
+        db[f"Condition {i}"] = {"symptoms": [vocabulary[(i * 7 + k * 3) % len(vocabulary)] for k in range(6)]}
+    return db
+
+
+def _comparable(result):
+    conditions, symptoms = result
+    return ([(c["condition"], sorted(c["matched_symptoms"]), c["match_percentage"], c["specificity_score"]) for c in conditions],
+            sorted(symptoms))
+
+
+def bench_symptoms(number=500):
+    """Per-message cost of identify_potential_conditions: regex scan vs. inverted index."""
+    for label, db, runs in (("symptom matching (4 cond)", mediguide.COMMON_SYMPTOMS, number),
+                            ("symptom matching (300 cond)", _synthetic_symptom_db(300), number // 10)):
+        for message in SAMPLE_MESSAGES:
+            assert _comparable(legacy_identify_potential_conditions(message, db)) == \
+                   _comparable(mediguide.identify_potential_conditions(message, db)), message
+        before = _time_per_message(lambda m: legacy_identify_potential_conditions(m, db), SAMPLE_MESSAGES, runs)
+        after = _time_per_message(lambda m: mediguide.identify_potential_conditions(m, db), SAMPLE_MESSAGES, runs)
+        _report(label, before, after)
+
+
+# --- Symptom severity tagging (user-008) ---
+
+def legacy_detect_symptom_severities(message_lower, reported_symptoms):
+    """Severity detection before the single-pass tagger: one fresh three-way regex per symptom and keyword."""
+    symptom_severities = {}
+    for symptom in reported_symptoms:
+        symptom_severity = "moderate"
+        for sev_level, keywords in mediguide.SYMPTOM_SEVERITY_KEYWORDS.items():
+            for keyword in keywords:
+                pattern = rf'\b({keyword})\s+({re.escape(symptom)})\b|\b({re.escape(symptom)})\s+({keyword})\b|\b({re.escape(symptom)})\s+(?:is|was)\s+({keyword})\b'
+                if re.search(pattern, message_lower, re.IGNORECASE):
+                    symptom_severity = sev_level
+                    break
+            if symptom_severity != "moderate": break
+        symptom_severities[symptom] = symptom_severity
+    return symptom_severities
+
+
+SEVERITY_MESSAGES = [
+    "I have a severe headache, mild fever, a bit of a cough and my sore throat is bad. "
+    "Also some nausea, terrible body aches, slight chills, noticeable fatigue and a runny nose.",
+    "Congestion was intense, sneezing is minor, shortness of breath is significant, "
+    "loss of taste, loss of smell, vomiting was unbearable and diarrhea was mild.",
+    "Headache",
+]
+
+
+def bench_severity(number=500):
+    """Per-message cost of symptom severity tagging on messages with many symptoms."""
+    index = mediguide.get_symptom_index()
+
+    def legacy(message):
+        message_lower = message.lower()
+        _, symptoms = mediguide.identify_potential_conditions(message)
+        return legacy_detect_symptom_severities(message_lower, symptoms)
+
+    def current(message):
+        message_lower = message.lower()
+        return mediguide.detect_symptom_severities(message_lower, index.find_symptom_mentions(message_lower))
+
+    for message in SEVERITY_MESSAGES + SAMPLE_MESSAGES:
+        assert legacy(message) == current(message), message
+    # The legacy regexes hit re's compile cache only while it holds them all; real
+    # messages with new symptom/keyword combinations pay the compilation every time
+    before = _time_per_message(legacy, SEVERITY_MESSAGES, number)
+    after = _time_per_message(current, SEVERITY_MESSAGES, number)
+    _report("severity tagging", before, after)
+
+
+# --- Cold start (user-021) ---
+
+HEAVY_MODULES = ["gradio", "google.generativeai", "pandas", "matplotlib", "PIL", "numpy"]
+
+def bench_startup(runs=3):
+    """Imports code.py in fresh interpreters under `python -X importtime` and reports the slowest imports."""
+    code_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+    loader = ("import importlib.util, sys; "
+              f"spec = importlib.util.spec_from_file_location('mediguide', {code_path!r}); "
+              "module = importlib.util.module_from_spec(spec); sys.modules['mediguide'] = module; "
+              "spec.loader.exec_module(module)")
+    totals = []
+    for _ in range(runs):
+        start = timeit.default_timer()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", loader],
+                                capture_output=True, text=True, check=True)
+        totals.append(timeit.default_timer() - start)
+    # "import time: self [us] | cumulative | imported package" lines, from the last run
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cum, name = line.split("|", 2)
+            if cum.strip().isdigit():
+                cumulative[name[1:].rstrip()] = int(cum) # Nested imports keep their extra indentation
+    print(f"{'cold start (module load)':<32} best of {runs}: {min(totals) * 1e3:8.1f} ms")
+    flat = {name.strip(): us for name, us in cumulative.items()}
+    for name in HEAVY_MODULES:
+        status = f"{flat[name] / 1e3:8.1f} ms" if name in flat else "not imported at startup"
+        print(f"    {name:<28} {status}")
+    print("    slowest top-level imports:")
+    top_level = {name: us for name, us in cumulative.items() if not name.startswith(" ")}
+    for name, us in sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:8]:
+        print(f"    {name:<28} {us / 1e3:8.1f} ms")
+
+
+# --- Response cache (user-025) ---
+
+EXAMPLE_QUESTIONS = [ # The UI's example buttons, plus the variants users type
+    "What are the symptoms of seasonal allergies?",
+    "How can I improve my sleep quality?",
+    "what are the symptoms of seasonal allergies",
+    "How can I improve my  sleep quality ?",
+]
+
+class _SlowModel:
+    """Stands in for Gemini: a fixed-latency, non-streamed reply."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, contents, stream=False):
+        self.calls += 1
+        time.sleep(self.latency)
+        part = types.SimpleNamespace(text="Drink water, rest and see a doctor if symptoms persist.")
+        candidate = types.SimpleNamespace(content=types.SimpleNamespace(parts=[part]))
+        return _Reply([types.SimpleNamespace(candidates=[candidate], text=part.text)])
+
+class _Reply(list):
+    """A non-streamed response: iterates as one chunk."""
+    prompt_feedback = None
+
+def bench_response_cache(turns=40, latency=0.05):
+    """Per-turn latency of example-question clicks from fresh sessions, without and with the response cache."""
+    saved_model, saved_cache = mediguide.model, mediguide.response_cache
+
+    def run(cache, label):
+        mediguide.model, mediguide.response_cache = _SlowModel(latency), cache
+        start = timeit.default_timer()
+        for i in range(turns):
+            for _ in mediguide.health_chatbot(EXAMPLE_QUESTIONS[i % len(EXAMPLE_QUESTIONS)], [], f"bench-{label}-{i}"):
+                pass
+        return (timeit.default_timer() - start) / turns, mediguide.model.calls
+
+    try:
+        before, calls_before = run(mediguide.ResponseCache(max_entries=0, path=""), "nocache")
+        cache = mediguide.ResponseCache(max_entries=100, path="")
+        after, calls_after = run(cache, "cache")
+    finally:
+        mediguide.model, mediguide.response_cache = saved_model, saved_cache
+    _report("example question turn", before, after)
+    metrics = cache.metrics()
+    print(f"    model calls: {calls_before} -> {calls_after}   hit rate: {metrics['hit_rate']:.0%} over {metrics['lookups']} lookups")
+
+
+BENCHMARKS = {
+    "extraction": bench_extraction,
+    "emergency": bench_emergency,
+    "symptoms": bench_symptoms,
+    "severity": bench_severity,
+    "startup": bench_startup,
+    "response_cache": bench_response_cache,
+}
+
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+        BENCHMARKS[name]()
@@ -1,18 +1,29 @@
 
 import os
+import asyncio
 import gradio as gr
-import google.generativeai as genai
 from datetime import datetime
-import pandas as pd # Keep pandas import although not directly used in the final version, might be useful for future file processing
+from html import escape as html_escape
+from urllib.parse import quote as url_quote
 import numpy as np
-import matplotlib
-matplotlib.use('Agg') # Use Agg backend for non-interactive plotting in backend environments
-import matplotlib.pyplot as plt
-from PIL import Image
+# google.generativeai, matplotlib, pandas and PIL are imported on first use (see get_model,
+# get_figure_class, the spreadsheet importer and __main__) to keep cold start fast
 import io
 import base64
+import codecs
+import hashlib
 import json
+import mmap
 import time
+import collections
+import threading
+import multiprocessing
+import concurrent.futures
+import sqlite3
+import atexit
+import uuid
+import weakref
+import bisect
 import re
 import random
 import logging
@@ -39,14 +50,33 @@ try:
          # Optionally, disable API calls if using placeholder
          # model = None
 
-    genai.configure(api_key=GOOGLE_API_KEY)
-    # Set up Gemini Flash model
-    model = genai.GenerativeModel('gemini-flash')
-    logging.info("Gemini API configured successfully.")
-
 except Exception as e:
-    logging.error(f"Failed to configure Gemini API: {e}")
-    model = None # Ensure model is None if configuration fails
+    logging.error(f"Failed to read Gemini API configuration: {e}")
+    GOOGLE_API_KEY = "YOUR_API_KEY_HERE"
+
+# The Gemini client is built on first use by get_model(); assigning `model` directly (e.g. a stub) skips that
+model = None
+model_init_attempted = False
+model_init_lock = threading.Lock()
+
+def get_model():
+    """Returns the Gemini model, importing and configuring the SDK on the first call (None on failure)."""
+    global model, model_init_attempted
+    if model is not None or model_init_attempted:
+        return model
+    with model_init_lock:
+        if not model_init_attempted:
+            try:
+                import google.generativeai as genai
+                genai.configure(api_key=GOOGLE_API_KEY)
+                # Set up Gemini Flash model
+                model = genai.GenerativeModel('gemini-flash')
+                logging.info("Gemini API configured successfully.")
+            except Exception as e:
+                logging.error(f"Failed to configure Gemini API: {e}")
+                model = None # Ensure model is None if configuration fails
+            model_init_attempted = True
+    return model
 
 
 # --- Custom CSS ---
@@ -482,6 +512,13 @@ body {
 }
 
 /* Style for example buttons */
+.history-note {
+    font-size: 0.85rem;
+    color: #777;
+    font-style: italic;
+    margin: 0;
+}
+
 .example-btn {
     background: none;
     border: 1px solid #ddd;
@@ -521,6 +558,419 @@ accurate health information while being mindful of the following guidelines:
 Your primary goal is to be a helpful informational guide, always prioritizing user safety and directing them towards professional medical care when appropriate.
 """
 
+# LLM context assembly limits (token counts are estimates, see estimate_tokens)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("MEDIGUIDE_CONTEXT_TOKEN_BUDGET", "4000"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("MEDIGUIDE_CONTEXT_MAX_MESSAGES", "20")) # Individual messages, not pairs
+CONTEXT_SUMMARY_TOKENS = 200 # Upper bound for the summary of turns that no longer fit
+
+# Stream Gemini output into the chat as it is generated (set to 0 to wait for the full reply)
+STREAM_RESPONSES = os.getenv("MEDIGUIDE_STREAM_RESPONSES", "1") != "0"
+
+# Replies to context-free turns (no profile or history in the prompt) are cached: entry cap (0 disables),
+# time to live in seconds, and an optional SQLite file so the cache survives restarts ("" keeps it in memory)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("MEDIGUIDE_RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("MEDIGUIDE_RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_PATH = os.getenv("MEDIGUIDE_RESPONSE_CACHE_PATH", "")
+
+# Concurrency limits: in-flight Gemini requests, and Gradio queue workers for chat events
+LLM_MAX_CONCURRENCY = int(os.getenv("MEDIGUIDE_LLM_MAX_CONCURRENCY", "8"))
+QUEUE_CONCURRENCY = int(os.getenv("MEDIGUIDE_QUEUE_CONCURRENCY", "16"))
+
+# Health score history: at most one snapshot per bucket, capped ring buffer
+HEALTH_SCORE_BUCKET_SECONDS = int(os.getenv("MEDIGUIDE_HEALTH_SCORE_BUCKET_SECONDS", "3600"))
+HEALTH_SCORE_HISTORY_LIMIT = int(os.getenv("MEDIGUIDE_HEALTH_SCORE_HISTORY_LIMIT", "500"))
+
+# Vital sign series are downsampled to at most this many points per chart
+CHART_MAX_POINTS = int(os.getenv("MEDIGUIDE_CHART_MAX_POINTS", "200"))
+# Chart renderer: "svg" (lightweight, default) or "matplotlib" (PNG)
+CHART_BACKEND = os.getenv("MEDIGUIDE_CHART_BACKEND", "svg").lower()
+# Matplotlib chart worker processes (0 renders in-thread) and the per-view render deadline
+CHART_RENDER_WORKERS = int(os.getenv("MEDIGUIDE_CHART_RENDER_WORKERS", "2"))
+CHART_RENDER_TIMEOUT = float(os.getenv("MEDIGUIDE_CHART_RENDER_TIMEOUT", "10"))
+# Session storage: "memory" (default, lost on restart), "sqlite" (WAL-mode file, write-behind,
+# shareable by several processes) or "eventlog" (per-user append-only mutation log with snapshots)
+SESSION_STORE = os.getenv("MEDIGUIDE_SESSION_STORE", "memory").lower()
+SESSION_DB_PATH = os.getenv("MEDIGUIDE_SESSION_DB", "mediguide_sessions.db")
+SESSION_FLUSH_INTERVAL = float(os.getenv("MEDIGUIDE_SESSION_FLUSH_INTERVAL", "2"))
+EVENT_LOG_DIR = os.getenv("MEDIGUIDE_EVENT_LOG_DIR", "session_events")
+EVENT_LOG_FSYNC_INTERVAL = float(os.getenv("MEDIGUIDE_EVENT_LOG_FSYNC_INTERVAL", "0.5"))
+EVENT_LOG_COMPACT_EVENTS = int(os.getenv("MEDIGUIDE_EVENT_LOG_COMPACT_EVENTS", "1000"))
+# Live-session bounds: idle expiry (seconds) and LRU caps; evicted sessions are spilled to disk
+SESSION_IDLE_TTL = float(os.getenv("MEDIGUIDE_SESSION_IDLE_TTL", "1800"))
+SESSION_MAX_LIVE = int(os.getenv("MEDIGUIDE_SESSION_MAX_LIVE", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("MEDIGUIDE_SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+# Spill directory for the in-memory store ("" discards evicted sessions) and how long spill files are kept
+SESSION_SPILL_DIR = os.getenv("MEDIGUIDE_SESSION_SPILL_DIR", "session_spill")
+SESSION_SPILL_RETENTION = float(os.getenv("MEDIGUIDE_SESSION_SPILL_RETENTION", str(7 * 86400)))
+
+# Chat turns shown in the chat window (and added per "Show earlier messages" click)
+CHAT_HISTORY_TURNS = int(os.getenv("MEDIGUIDE_CHAT_HISTORY_TURNS", "30"))
+
+# Uploaded documents are read in fixed-size blocks and fed to the extractors in text chunks of about this size
+DOCUMENT_CHUNK_CHARS = int(os.getenv("MEDIGUIDE_DOCUMENT_CHUNK_CHARS", "4000"))
+DOCUMENT_READ_BYTES = 64 * 1024
+DOCUMENT_EXTENSIONS = {".txt", ".md", ".pdf"}
+SPREADSHEET_EXTENSIONS = {".csv", ".xlsx", ".xls"}
+IMPORT_CHUNK_ROWS = int(os.getenv("MEDIGUIDE_IMPORT_CHUNK_ROWS", "50000")) # CSV rows parsed per piece
+# Upload processing runs as background jobs: concurrent jobs, how long finished jobs stay pollable, UI poll period
+UPLOAD_JOB_WORKERS = int(os.getenv("MEDIGUIDE_UPLOAD_JOB_WORKERS", "2"))
+UPLOAD_JOB_RETENTION = float(os.getenv("MEDIGUIDE_UPLOAD_JOB_RETENTION", "3600"))
+UPLOAD_POLL_INTERVAL = 1.0
+
+# Dashboard chart time windows (days; None = full history) and the trend daily-mean span
+CHART_WINDOWS = {"7d": 7, "30d": 30, "90d": 90, "all": None}
+TREND_DAILY_DAYS = 7
+# Byte budget for cached chart data URIs, shared across users
+CHART_CACHE_MAX_BYTES = int(os.getenv("MEDIGUIDE_CHART_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# --- Timestamps ---
+# Records store timestamps as epoch seconds (float) and are formatted only for display.
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def to_epoch(timestamp=None):
+    """Converts None (now), a number, a datetime or a TIMESTAMP_FORMAT string to epoch seconds."""
+    if timestamp is None:
+        return time.time()
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if isinstance(timestamp, datetime):
+        return timestamp.timestamp()
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp()
+
+def format_timestamp(epoch, fmt=TIMESTAMP_FORMAT):
+    """Formats an epoch timestamp for display."""
+    return datetime.fromtimestamp(epoch).strftime(fmt)
+
+def local_timezone_name():
+    """IANA name of the server's time zone (from TZ or the /etc/localtime link), or None if unknown."""
+    name = os.environ.get("TZ", "").lstrip(":")
+    if not name:
+        path = os.path.realpath("/etc/localtime")
+        if "zoneinfo/" in path:
+            name = path.split("zoneinfo/", 1)[1]
+    return name or None
+
+def local_utc_offsets(epochs):
+    """UTC offset (seconds) in effect at each epoch timestamp in the server's time zone, DST included."""
+    epochs = np.asarray(epochs, dtype=float)
+    name = local_timezone_name()
+    if name and epochs.size:
+        import pandas as pd
+        try:
+            local = pd.to_datetime(epochs, unit="s", utc=True).tz_convert(name)
+            return (local.tz_localize(None).asi8 - local.tz_convert(None).asi8) / 1e9
+        except (KeyError, ValueError) as e: # Unknown zone name, e.g. a POSIX TZ string
+            logging.warning(f"Could not use time zone '{name}', using the current UTC offset: {e}")
+    return np.full(epochs.shape, datetime.now().astimezone().utcoffset().total_seconds())
+
+def score_bucket(epoch):
+    """Health score snapshot bucket index for an epoch timestamp."""
+    return int(epoch // HEALTH_SCORE_BUCKET_SECONDS)
+
+def days_since(epoch, now=None):
+    """Whole days elapsed since an epoch timestamp (same as timedelta.days)."""
+    now = time.time() if now is None else now
+    return int((now - epoch) // 86400)
+
+# --- Vital Sign Time Series ---
+
+def parse_vital_value(vital_type, value):
+    """Parses a reading into (primary, secondary) floats; BP "120/80" -> (120.0, 80.0). Returns None if unparseable."""
+    try:
+        if "blood_pressure" in vital_type.lower().replace(' ', '_'):
+            parts = str(value).split('/')
+            if len(parts) != 2:
+                return None
+            return float(int(parts[0].strip())), float(int(parts[1].strip()))
+        return float(value), float("nan")
+    except (ValueError, TypeError):
+        return None
+
+class VitalSeries:
+    """Columnar time series for one vital type, stored as parallel NumPy columns.
+
+    Columns: timestamp (epoch seconds), value (systolic for BP), value2 (diastolic for BP,
+    NaN otherwise) and a small unit code. Readings are kept in timestamp order.
+    """
+    unit_codes = {} # Shared unit string -> code table
+    unit_names = []
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, vital_type):
+        self.vital_type = vital_type
+        self.is_pair = "blood_pressure" in vital_type.lower().replace(' ', '_')
+        self.size = 0
+        self.version = 0 # Bumped on every append; lets callers cache derived views
+        self.total = 0.0 # Running sum of the value column
+        self._timestamps = np.empty(self.INITIAL_CAPACITY, dtype=np.float64)
+        self._values = np.empty(self.INITIAL_CAPACITY, dtype=np.float64)
+        self._values2 = np.empty(self.INITIAL_CAPACITY, dtype=np.float64)
+        self._units = np.empty(self.INITIAL_CAPACITY, dtype=np.uint8)
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def unit_code(cls, unit):
+        unit = unit or ""
+        code = cls.unit_codes.get(unit)
+        if code is None:
+            code = len(cls.unit_names)
+            cls.unit_codes[unit] = code
+            cls.unit_names.append(unit)
+        return code
+
+    @property
+    def timestamps(self): return self._timestamps[:self.size]
+    @property
+    def values(self): return self._values[:self.size]
+    @property
+    def values2(self): return self._values2[:self.size]
+    @property
+    def units(self): return self._units[:self.size]
+
+    def _grow(self, needed):
+        capacity = max(needed, len(self._timestamps) * 2)
+        for name in ("_timestamps", "_values", "_values2", "_units"):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            setattr(self, name, grown)
+
+    def append(self, value, unit, timestamp=None):
+        """Appends a reading. Returns False (and stores nothing) if the value cannot be parsed."""
+        parsed = parse_vital_value(self.vital_type, value)
+        if parsed is None:
+            return False
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.size == len(self._timestamps):
+            self._grow(self.size + 1)
+        # Insert in timestamp order (almost always at the end)
+        i = self.size
+        if i and timestamp < self._timestamps[i - 1]:
+            i = int(np.searchsorted(self.timestamps, timestamp, side="right"))
+            for column in (self._timestamps, self._values, self._values2, self._units):
+                column[i + 1:self.size + 1] = column[i:self.size]
+        self._timestamps[i] = timestamp
+        self._values[i], self._values2[i] = parsed
+        self._units[i] = self.unit_code(unit)
+        self.size += 1
+        self.total += parsed[0]
+        self.version += 1
+        return True
+
+    def extend(self, timestamps, values, values2=None, unit=""):
+        """
+        Bulk-appends already-parsed readings (array-likes; values2 is the diastolic
+        column for blood pressure) with a single sorted merge. Returns the count added.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        values = np.asarray(values, dtype=np.float64)
+        values2 = np.full(len(values), np.nan) if values2 is None else np.asarray(values2, dtype=np.float64)
+        count = len(timestamps)
+        if not count:
+            return 0
+        order = np.argsort(timestamps, kind="stable")
+        if self.size + count > len(self._timestamps):
+            self._grow(self.size + count)
+        end = self.size + count
+        self._timestamps[self.size:end] = timestamps[order]
+        self._values[self.size:end] = values[order]
+        self._values2[self.size:end] = values2[order]
+        self._units[self.size:end] = self.unit_code(unit)
+        if self.size and timestamps[order[0]] < self._timestamps[self.size - 1]:
+            # Interleaves with existing readings: stable re-sort keeps equal timestamps in insertion order
+            merged = np.argsort(self._timestamps[:end], kind="stable")
+            for column in (self._timestamps, self._values, self._values2, self._units):
+                column[:end] = column[:end][merged]
+        self.size = end
+        self.total += float(values.sum())
+        self.version += 1
+        return count
+
+    def format_value(self, i):
+        if self.is_pair:
+            return f"{self._values[i]:.0f}/{self._values2[i]:.0f}"
+        return f"{self._values[i]:g}"
+
+    def reading(self, i):
+        """Returns reading i as a {"value", "unit", "timestamp"} dict (display form)."""
+        if i < 0: i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError("VitalSeries index out of range")
+        return {"value": self.format_value(i), "unit": self.unit_names[self._units[i]],
+                "timestamp": float(self._timestamps[i])}
+
+    def latest(self):
+        return self.reading(-1) if self.size else None
+
+    def mean_before_latest(self):
+        """Mean of every value except the latest one, from the running sum."""
+        if self.size < 2: return None
+        return (self.total - self._values[self.size - 1]) / (self.size - 1)
+
+    def latest_in_range(self):
+        """Normal-range check on the latest reading, using the numeric columns directly."""
+        if not self.size: return None
+        return vital_values_in_range(self.vital_type, self._values[self.size - 1], self._values2[self.size - 1])
+
+    def slice(self, start=None, end=None):
+        """Returns a new series with readings where start <= timestamp < end."""
+        ts = self.timestamps
+        lo = 0 if start is None else int(np.searchsorted(ts, start, side="left"))
+        hi = self.size if end is None else int(np.searchsorted(ts, end, side="left"))
+        sliced = VitalSeries(self.vital_type)
+        count = max(hi - lo, 0)
+        if count:
+            sliced._grow(count)
+            for name in ("_timestamps", "_values", "_values2", "_units"):
+                getattr(sliced, name)[:count] = getattr(self, name)[lo:hi]
+            sliced.size = count
+            sliced.version = 1
+            sliced.total = float(sliced.values.sum())
+        return sliced
+
+    def downsample(self, max_points):
+        """Returns (timestamps, values) with at most max_points real readings, picked by LTTB."""
+        ts, vals = self.timestamps, self.values
+        keep = lttb_indices(ts, vals, max_points)
+        return ts[keep], vals[keep]
+
+    def daily_aggregates(self):
+        """Per local calendar day: {"day": midnight epoch, "mean", "min", "max", "count"} arrays."""
+        if not self.size:
+            return {"day": np.empty(0), "mean": np.empty(0), "min": np.empty(0), "max": np.empty(0), "count": np.empty(0, dtype=np.int64)}
+        # Local date of each reading, with the UTC offset in effect on that date
+        day_index = np.floor((self.timestamps + local_utc_offsets(self.timestamps)) / 86400).astype(np.int64)
+        vals = self.values
+        # Readings are in timestamp order, so each day is one contiguous run
+        starts = np.flatnonzero(np.r_[True, day_index[1:] != day_index[:-1]])
+        counts = np.diff(np.r_[starts, self.size])
+        # Local midnight: shift by the offset of the day's first reading, then by midnight's own offset
+        midnight = day_index[starts] * 86400.0
+        midnight -= local_utc_offsets(midnight - local_utc_offsets(self.timestamps[starts]))
+        return {
+            "day": midnight,
+            "mean": np.add.reduceat(vals, starts) / counts,
+            "min": np.minimum.reduceat(vals, starts),
+            "max": np.maximum.reduceat(vals, starts),
+            "count": counts,
+        }
+
+    def to_dict(self):
+        """JSON-friendly form: plain column lists and unit names."""
+        data = {
+            "vital_type": self.vital_type,
+            "timestamps": self.timestamps.tolist(),
+            "values": self.values.tolist(),
+            "units": [self.unit_names[code] for code in self.units],
+        }
+        if self.is_pair:
+            data["values2"] = self.values2.tolist()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        series = cls(data["vital_type"])
+        size = len(data["timestamps"])
+        if size:
+            series._grow(size)
+            series._timestamps[:size] = data["timestamps"]
+            series._values[:size] = data["values"]
+            series._values2[:size] = data.get("values2") or [float("nan")] * size
+            series._units[:size] = [cls.unit_code(unit) for unit in data["units"]]
+            series.size = size
+            series.version = 1
+            series.total = float(series.values.sum())
+        return series
+
+def lttb_indices(x, y, threshold):
+    """
+    Largest-Triangle-Three-Buckets downsampling: indices of `threshold` points that
+    keep the visual shape of (x, y), always including the first and last point.
+    """
+    n = len(x)
+    if threshold <= 0 or n <= threshold:
+        return np.arange(n)
+    if threshold < 3:
+        return np.array([0, n - 1][:threshold])
+
+    every = (n - 2) / (threshold - 2)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        # Pick the point in this bucket forming the largest triangle with a and the average
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(areas.argmax())
+        selected[i + 1] = a
+    selected[-1] = n - 1
+    return selected
+
+class RecentWindow:
+    """
+    Rolling window over timestamped events from the last `days` whole days (same
+    cut-off as days_since(ts) <= days). Counts per key and of flagged events are
+    maintained on insert and expiry, so reads do not rescan the full log.
+    """
+    def __init__(self, days):
+        self.days = days
+        self.horizon = (days + 1) * 86400 # days_since(ts) <= days  <=>  now - ts < (days + 1) days
+        self.entries = collections.deque() # (timestamp, seq, key, flagged), oldest first
+        self.key_entries = {} # key -> deque of (timestamp, seq); len() is the key's count
+        self.flagged_count = 0
+        self.seq = 0
+
+    def add(self, timestamp, key, flagged=False):
+        self.seq += 1
+        entry = (timestamp, self.seq, key, flagged)
+        if self.entries and timestamp < self.entries[-1][0]:
+            bisect.insort(self.entries, entry) # Rare: back-dated event
+        else:
+            self.entries.append(entry)
+        per_key = self.key_entries.setdefault(key, collections.deque())
+        if per_key and timestamp < per_key[-1][0]:
+            bisect.insort(per_key, (timestamp, self.seq))
+        else:
+            per_key.append((timestamp, self.seq))
+        if flagged:
+            self.flagged_count += 1
+
+    def expire(self, now=None):
+        """Drops events that have aged out of the window."""
+        cutoff = (time.time() if now is None else now) - self.horizon
+        entries = self.entries
+        while entries and entries[0][0] <= cutoff:
+            _, _, key, flagged = entries.popleft()
+            per_key = self.key_entries[key]
+            per_key.popleft()
+            if not per_key:
+                del self.key_entries[key]
+            if flagged:
+                self.flagged_count -= 1
+        return self
+
+    def __len__(self):
+        return len(self.entries)
+
+    def unique_count(self):
+        return len(self.key_entries)
+
+    def most_frequent(self, n=3):
+        """Top-n (key, count) pairs; ties keep first-occurrence order, like a stable sort over the log."""
+        ranked = sorted(self.key_entries.items(), key=lambda item: (-len(item[1]), item[1][0]))
+        return [(key, len(per_key)) for key, per_key in ranked[:n]]
+
+    def last_timestamp(self, key):
+        per_key = self.key_entries.get(key)
+        return per_key[-1][0] if per_key else None
+
 # --- User Session Management ---
 
 class UserSession:
@@ -542,15 +992,21 @@ class UserSession:
             "wellness_goals": []
         }
         self.previous_recommendations = []
-        self.vital_signs = {} # e.g., {"blood_pressure": [{"value": "120/80", "unit": "mmHg", "timestamp": ...}]}
+        self.vital_signs = {} # vital_type -> VitalSeries, e.g. {"blood_pressure": VitalSeries("blood_pressure")}
         self.medication_reminders = [] # More structured reminders
         self.symptom_log = [] # e.g., [{"symptom": "headache", "severity": "mild", ...}]
         self.wellness_activities = []
+        # Vitals and profile numbers read from uploaded documents; kept apart from the user's own
+        # readings since the document date is unknown, e.g. [{"vital_type": "blood_pressure", "value": "180/110", ...}]
+        self.document_readings = []
+        # Rolling windows maintained on insert, for the score (7 days) and trends (14 days)
+        self.recent_symptoms = {7: RecentWindow(7), 14: RecentWindow(14)}
+        self.recent_activities = {7: RecentWindow(7), 14: RecentWindow(14)}
         self.health_analytics = {
             "interaction_count": 0,
             "topics_discussed": set(), # Use a set for unique topics
             "last_health_score": None,
-            "health_score_history": [], # Track score changes
+            "health_score_history": collections.deque(maxlen=HEALTH_SCORE_HISTORY_LIMIT), # One snapshot per bucket
             "wellness_trend": "stable" # Could be calculated later
         }
         self.notification_preferences = { # Placeholder for settings
@@ -559,15 +1015,44 @@ class UserSession:
             "health_tips": True,
             "data_summaries": True
         }
+        self.message_chars = 0 # Running total of history text, for approx_bytes()
+        # Gradio [user_msg, bot_msg] pairs, maintained as messages are added (see visible_chat_history)
+        self.display_history = []
+        self.pending_display_message = None
+        self.event_sink = None # Called with (session, event) after each mutation; see EventLog
         logging.info(f"UserSession created for user: {self.user_id}")
 
-    def add_message(self, role, message, timestamp=None):
-        """Adds a message to the conversation history."""
-        if timestamp is None:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.conversation_history.append({"role": role, "message": message, "timestamp": timestamp})
+    def record_event(self, op, **args):
+        """Reports an applied mutation to the event sink (if any) so it can be logged and replayed."""
+        if self.event_sink is not None:
+            self.event_sink(self, {"op": op, "args": args})
+
+    def apply_event(self, event):
+        """Replays a logged mutation. The sink is detached so replay does not log again."""
+        sink, self.event_sink = self.event_sink, None
+        try:
+            getattr(self, event["op"])(**event["args"])
+        finally:
+            self.event_sink = sink
+
+    def add_message(self, role, message, timestamp=None, raw_message=None):
+        """Adds a message to the conversation history.
+
+        For bot messages, `message` is the formatted HTML shown in the UI and
+        `raw_message` the plain model text that is sent back to the LLM.
+        """
+        entry = {"role": role, "message": message, "timestamp": to_epoch(timestamp)}
+        if raw_message is not None:
+            entry["raw_message"] = raw_message
+        self.conversation_history.append(entry)
+        self.message_chars += len(message) + len(raw_message or "")
         if role == "user":
             self.health_analytics["interaction_count"] += 1
+            self.pending_display_message = message
+        elif role == "bot":
+            self.display_history.append([self.pending_display_message, message])
+            self.pending_display_message = None
+        self.record_event("add_message", role=role, message=message, timestamp=entry["timestamp"], raw_message=raw_message)
 
     def update_profile(self, key, value):
         """Updates a specific field in the user profile."""
@@ -596,34 +1081,50 @@ class UserSession:
             else:
                 self.user_profile[key] = value
             logging.info(f"Profile updated for user {self.user_id}: {key} = {self.user_profile[key]}")
+            self.record_event("update_profile", key=key, value=value)
         else:
              logging.warning(f"Attempted to update non-existent profile key: {key}")
 
-    def add_recommendation(self, recommendation, category="general"):
+    def add_recommendation(self, recommendation, category="general", timestamp=None):
         """Adds a health recommendation provided by the bot."""
+        timestamp = time.time() if timestamp is None else timestamp
         self.previous_recommendations.append({
             "recommendation": recommendation,
             "category": category,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": timestamp,
             "implemented": False # Placeholder for future tracking
         })
+        self.record_event("add_recommendation", recommendation=recommendation, category=category, timestamp=timestamp)
 
-    def add_vital_sign(self, vital_type, value, unit):
-        """Adds a vital sign measurement."""
+    def add_vital_sign(self, vital_type, value, unit, timestamp=None):
+        """Adds a vital sign measurement (timestamp defaults to now)."""
         if not vital_type or value is None:
             logging.warning("Attempted to add vital sign with missing type or value.")
             return
-        if vital_type not in self.vital_signs:
-            self.vital_signs[vital_type] = []
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.vital_signs[vital_type].append({
-            "value": value, # Keep original value string if complex (like BP)
-            "unit": unit,
-            "timestamp": timestamp
-        })
+        series = self.vital_signs.get(vital_type)
+        if series is None:
+            series = self.vital_signs[vital_type] = VitalSeries(vital_type)
+        timestamp = time.time() if timestamp is None else timestamp
+        if not series.append(value, unit, timestamp):
+            logging.warning(f"Could not parse vital sign value '{value}' for {vital_type}; reading skipped.")
+            return
         logging.info(f"Vital sign added for user {self.user_id}: {vital_type}={value} {unit}")
-
-    def add_medication_reminder(self, medication, dosage, schedule, duration=None, notes=None):
+        self.record_event("add_vital_sign", vital_type=vital_type, value=value, unit=unit, timestamp=timestamp)
+
+    def add_vital_readings(self, vital_type, timestamps, values, values2=None, unit=""):
+        """Bulk-adds parsed readings of one vital type (see VitalSeries.extend), logged as a single event."""
+        series = self.vital_signs.get(vital_type)
+        if series is None:
+            series = self.vital_signs[vital_type] = VitalSeries(vital_type)
+        count = series.extend(timestamps, values, values2, unit)
+        if count:
+            logging.info(f"{count} {vital_type} readings added for user {self.user_id}")
+            self.record_event("add_vital_readings", vital_type=vital_type, timestamps=np.asarray(timestamps, dtype=float).tolist(),
+                              values=np.asarray(values, dtype=float).tolist(),
+                              values2=None if values2 is None else np.asarray(values2, dtype=float).tolist(), unit=unit)
+        return count
+
+    def add_medication_reminder(self, medication, dosage, schedule, duration=None, notes=None, timestamp=None):
         """Adds a medication reminder."""
         # Avoid duplicates
         if any(m['medication'].lower() == medication.lower() for m in self.medication_reminders):
@@ -636,7 +1137,7 @@ class UserSession:
             "schedule": schedule,
             "duration": duration,
             "notes": notes,
-            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "created_at": time.time() if timestamp is None else timestamp,
             "adhered_doses": 0, # Placeholder
             "missed_doses": 0   # Placeholder
         })
@@ -644,28 +1145,55 @@ class UserSession:
         # Also add to simple profile list if not already there
         if medication not in self.user_profile["current_medications"]:
              self.user_profile["current_medications"].append(medication)
+        self.record_event("add_medication_reminder", medication=medication, dosage=dosage, schedule=schedule,
+                          duration=duration, notes=notes, timestamp=self.medication_reminders[-1]["created_at"])
 
 
-    def log_symptom(self, symptom, severity="moderate", related_factors=None):
-        """Logs a symptom reported by the user."""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.symptom_log.append({
+    def log_symptom(self, symptom, severity="moderate", related_factors=None, timestamp=None, source=None):
+        """
+        Logs a symptom reported by the user. Symptoms with a source (e.g. "document" for
+        uploaded records, which may describe past episodes) are kept in the log but not
+        counted as recent symptoms in the health score and trends.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        entry = {
             "symptom": symptom,
             "severity": severity,
             "related_factors": related_factors,
             "timestamp": timestamp
-        })
+        }
+        if source is not None:
+            entry["source"] = source
+        self.symptom_log.append(entry)
+        if source is None:
+            for window in self.recent_symptoms.values():
+                window.add(timestamp, symptom, flagged=severity == "severe")
+        self.record_event("log_symptom", symptom=symptom, severity=severity, related_factors=related_factors, timestamp=timestamp, source=source)
         logging.info(f"Symptom logged for user {self.user_id}: {symptom} ({severity})")
 
-    def add_wellness_activity(self, activity_type, duration=None, notes=None):
+    def add_document_reading(self, vital_type, value, unit, source, timestamp=None):
+        """
+        Records a vital or profile number found in an uploaded document. It is not added to
+        vital_signs or the profile, so it never becomes the latest reading or drives the health
+        score; `timestamp` is when the document was read, not when the value was measured.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        self.document_readings.append({"vital_type": vital_type, "value": value, "unit": unit,
+                                       "source": source, "timestamp": timestamp})
+        self.record_event("add_document_reading", vital_type=vital_type, value=value, unit=unit, source=source, timestamp=timestamp)
+
+    def add_wellness_activity(self, activity_type, duration=None, notes=None, timestamp=None):
         """Adds a wellness activity reported by the user."""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        timestamp = time.time() if timestamp is None else timestamp
         self.wellness_activities.append({
             "activity_type": activity_type,
             "duration": duration,
             "notes": notes,
             "timestamp": timestamp
         })
+        for window in self.recent_activities.values():
+            window.add(timestamp, activity_type)
+        self.record_event("add_wellness_activity", activity_type=activity_type, duration=duration, notes=notes, timestamp=timestamp)
         logging.info(f"Wellness activity added for user {self.user_id}: {activity_type}")
 
     def calculate_bmi(self):
@@ -712,31 +1240,28 @@ class UserSession:
             logging.debug(f"Score after BMI ({bmi}): {score}")
 
         # Adjust based on recent vital signs (simplified check on last reading)
-        for vital, readings in self.vital_signs.items():
-            if readings:
-                latest_reading = readings[-1]
-                in_range = is_vital_in_normal_range(vital, latest_reading['value'])
+        for vital, series in self.vital_signs.items():
+            if series:
+                in_range = series.latest_in_range()
                 if in_range is True: score += 3
                 elif in_range is False: score -= 3
-                logging.debug(f"Score after vital {vital} ({latest_reading['value']}, range={in_range}): {score}")
+                logging.debug(f"Score after vital {vital} ({series.format_value(len(series) - 1)}, range={in_range}): {score}")
 
         # Adjust based on recent wellness activities (last 7 days)
-        recent_activities = [a for a in self.wellness_activities
-                             if (datetime.now() - datetime.strptime(a["timestamp"], "%Y-%m-%d %H:%M:%S")).days <= 7]
-        if len(recent_activities) >= 3: score += 5
-        elif len(recent_activities) > 0: score += 2
-        logging.debug(f"Score after wellness activities ({len(recent_activities)} recent): {score}")
+        now = time.time()
+        recent_activity_count = len(self.recent_activities[7].expire(now))
+        if recent_activity_count >= 3: score += 5
+        elif recent_activity_count > 0: score += 2
+        logging.debug(f"Score after wellness activities ({recent_activity_count} recent): {score}")
 
 
         # Adjust based on recent symptoms (last 7 days)
-        recent_symptoms = [s for s in self.symptom_log
-                           if (datetime.now() - datetime.strptime(s["timestamp"], "%Y-%m-%d %H:%M:%S")).days <= 7]
+        recent_symptoms = self.recent_symptoms[7].expire(now)
         if len(recent_symptoms) >= 3: score -= 5
         elif len(recent_symptoms) > 0: score -= 2
         # Penalize more for severe symptoms
-        severe_symptoms = [s for s in recent_symptoms if s.get("severity") == "severe"]
-        score -= len(severe_symptoms) * 2
-        logging.debug(f"Score after symptoms ({len(recent_symptoms)} recent, {len(severe_symptoms)} severe): {score}")
+        score -= recent_symptoms.flagged_count * 2
+        logging.debug(f"Score after symptoms ({len(recent_symptoms)} recent, {recent_symptoms.flagged_count} severe): {score}")
 
 
         # Adjust based on chronic conditions
@@ -746,20 +1271,742 @@ class UserSession:
 
         # Ensure score is within bounds [0, 100]
         score = max(0, min(100, int(round(score)))) # Round to integer
+        logging.debug(f"Calculated health score for user {self.user_id}: {score}")
 
-        # Update history and last score
-        if self.health_analytics["last_health_score"] is not None:
-             self.health_analytics["health_score_history"].append({
-                 "score": self.health_analytics["last_health_score"],
-                 "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S") # Approx time of previous score
-             })
-        self.health_analytics["last_health_score"] = score
-        logging.info(f"Calculated health score for user {self.user_id}: {score}")
+        return score
 
+    def record_health_score(self, score=None, timestamp=None):
+        """
+        Records a health score snapshot and returns the score. Keeps one snapshot per
+        HEALTH_SCORE_BUCKET_SECONDS bucket: a later call in the same bucket replaces it.
+        """
+        if score is None:
+            score = self.calculate_health_score()
+        timestamp = time.time() if timestamp is None else timestamp
+        history = self.health_analytics["health_score_history"]
+        snapshot = {"score": score, "timestamp": timestamp}
+        if history and score_bucket(history[-1]["timestamp"]) == score_bucket(timestamp):
+            history[-1] = snapshot
+        else:
+            history.append(snapshot)
+        self.health_analytics["last_health_score"] = score
+        logging.info(f"Recorded health score for user {self.user_id}: {score}")
+        self.record_event("record_health_score", score=score, timestamp=timestamp)
         return score
 
-# Initialize user sessions dictionary
-user_sessions = {}
+    def add_topics(self, topics):
+        """Adds discussed health topics to the analytics."""
+        new_topics = set(topics) - self.health_analytics["topics_discussed"]
+        if new_topics:
+            self.health_analytics["topics_discussed"].update(new_topics)
+            self.record_event("add_topics", topics=sorted(new_topics))
+
+    def merge_from(self, other):
+        """
+        Merges the health data of another session (e.g. the scratch session an
+        upload was imported into) through the regular mutators, so the changes
+        are logged like any other. Vital readings whose timestamps are already
+        stored are skipped; returns {vital_type: boolean mask of the skipped readings}.
+        """
+        skipped = {}
+        for vital_type, series in other.vital_signs.items():
+            existing = self.vital_signs.get(vital_type)
+            new = ~np.isin(series.timestamps, existing.timestamps) if existing is not None else np.ones(series.size, dtype=bool)
+            skipped[vital_type] = ~new
+            for code in np.unique(series.units[new]): # add_vital_readings takes one unit per call
+                rows = new & (series.units == code)
+                self.add_vital_readings(vital_type, series.timestamps[rows], series.values[rows],
+                                        series.values2[rows] if series.is_pair else None, series.unit_names[code])
+        for key in ("age", "height_cm", "weight_kg"):
+            if other.user_profile[key] is not None:
+                self.update_profile(key, other.user_profile[key])
+        for key in ("allergies", "chronic_conditions"):
+            if other.user_profile[key]:
+                self.update_profile(key, other.user_profile[key])
+        for reminder in other.medication_reminders:
+            self.add_medication_reminder(reminder["medication"], reminder["dosage"], reminder["schedule"],
+                                         reminder["duration"], reminder["notes"], reminder["created_at"])
+        for entry in other.symptom_log:
+            self.log_symptom(entry["symptom"], entry["severity"], entry["related_factors"], entry["timestamp"], entry.get("source"))
+        for entry in other.wellness_activities:
+            self.add_wellness_activity(entry["activity_type"], entry["duration"], entry["notes"], entry["timestamp"])
+        for entry in other.document_readings:
+            self.add_document_reading(entry["vital_type"], entry["value"], entry["unit"], entry["source"], entry["timestamp"])
+        return skipped
+
+    def previous_health_score(self, now=None):
+        """Latest recorded score from a bucket before the current one, or None."""
+        current_bucket = score_bucket(time.time() if now is None else now)
+        for snapshot in reversed(self.health_analytics["health_score_history"]):
+            if score_bucket(snapshot["timestamp"]) < current_bucket:
+                return snapshot["score"]
+        return None
+
+    def approx_bytes(self):
+        """Cheap estimate of the session's memory footprint (no traversal of the history)."""
+        records = (len(self.symptom_log) + len(self.wellness_activities) + len(self.document_readings)
+                   + len(self.previous_recommendations) + len(self.medication_reminders))
+        readings = sum(len(series) for series in self.vital_signs.values())
+        return 4096 + self.message_chars + 200 * len(self.conversation_history) + 400 * records + 25 * readings
+
+    def to_dict(self):
+        """Serializable snapshot of the session (sets become sorted lists, deques lists)."""
+        analytics = dict(self.health_analytics)
+        analytics["topics_discussed"] = sorted(analytics["topics_discussed"])
+        analytics["health_score_history"] = list(analytics["health_score_history"])
+        return {
+            "user_id": self.user_id,
+            "conversation_history": list(self.conversation_history),
+            "user_profile": self.user_profile,
+            "previous_recommendations": list(self.previous_recommendations),
+            "vital_signs": {vital_type: series.to_dict() for vital_type, series in list(self.vital_signs.items())},
+            "medication_reminders": list(self.medication_reminders),
+            "symptom_log": list(self.symptom_log),
+            "wellness_activities": list(self.wellness_activities),
+            "document_readings": list(self.document_readings),
+            "health_analytics": analytics,
+            "notification_preferences": self.notification_preferences,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuilds a session from to_dict() output, including derived rolling windows."""
+        session = cls.__new__(cls) # Skip __init__ logging; every field is set below
+        session.user_id = data["user_id"]
+        session.conversation_history = data["conversation_history"]
+        session.user_profile = data["user_profile"]
+        session.previous_recommendations = data["previous_recommendations"]
+        session.vital_signs = {vital_type: VitalSeries.from_dict(series)
+                               for vital_type, series in data["vital_signs"].items()}
+        session.medication_reminders = data["medication_reminders"]
+        session.symptom_log = data["symptom_log"]
+        session.wellness_activities = data["wellness_activities"]
+        session.document_readings = data.get("document_readings", []) # Absent in sessions saved before uploads
+        session.recent_symptoms = {7: RecentWindow(7), 14: RecentWindow(14)}
+        session.recent_activities = {7: RecentWindow(7), 14: RecentWindow(14)}
+        for entry in session.symptom_log:
+            if entry.get("source") is not None:
+                continue # Not a current symptom; see log_symptom
+            for window in session.recent_symptoms.values():
+                window.add(entry["timestamp"], entry["symptom"], flagged=entry.get("severity") == "severe")
+        for entry in session.wellness_activities:
+            for window in session.recent_activities.values():
+                window.add(entry["timestamp"], entry["activity_type"])
+        analytics = dict(data["health_analytics"])
+        analytics["topics_discussed"] = set(analytics.get("topics_discussed", []))
+        analytics["health_score_history"] = collections.deque(analytics.get("health_score_history", []),
+                                                              maxlen=HEALTH_SCORE_HISTORY_LIMIT)
+        session.health_analytics = analytics
+        session.notification_preferences = data["notification_preferences"]
+        session.message_chars = sum(len(m["message"]) + len(m.get("raw_message") or "")
+                                    for m in session.conversation_history)
+        session.display_history = build_gradio_history(session.conversation_history)
+        last = session.conversation_history[-1] if session.conversation_history else None
+        session.pending_display_message = last["message"] if last and last["role"] == "user" else None
+        session.event_sink = None
+        return session
+
+# --- Session Storage ---
+
+def new_session_id():
+    """Collision-free session ID for a new browser session (used as the gr.State factory)."""
+    return "user_" + uuid.uuid4().hex
+
+class SessionStore:
+    """
+    Dict-like store of UserSession objects (`user_id in store`, `store[user_id]`).
+
+    Sessions are loaded lazily on first access and kept in an LRU of live sessions;
+    callers mark_dirty() a session after changing it, and dirty sessions are written
+    by flush() in batches (write-behind). The live set is bounded: sessions idle for
+    longer than `idle_ttl`, and the least recently used ones beyond `max_sessions` or
+    `max_bytes`, are written out (spilled) by the backend and dropped from memory;
+    the next access loads them back.
+    """
+    def __init__(self, idle_ttl=None, max_sessions=None, max_bytes=None):
+        self.sessions = collections.OrderedDict() # user_id -> live UserSession, least recently used first
+        self.last_access = {}
+        self.dirty = set()
+        self.spilling = {} # user_id -> Event set once an eviction's write has finished
+        self.lock = threading.RLock()
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.stats = {"loads": 0, "evictions": 0, "expirations": 0, "spills": 0}
+        self.closed = threading.Event()
+
+    # Backend hooks
+    def load(self, user_id): return None
+    def exists(self, user_id): return False
+    def is_stale(self, user_id): return False # True if the stored copy is newer than the clean live one
+    def save_many(self, records): return [] # records: [(user_id, serialized session)]; returns user_ids not written
+    def delete(self, user_id): pass
+
+    def __contains__(self, user_id):
+        with self.lock:
+            return user_id in self.sessions or user_id in self.spilling or self.exists(user_id)
+
+    def __getitem__(self, user_id):
+        session = self.get(user_id)
+        if session is None:
+            raise KeyError(user_id)
+        return session
+
+    def __setitem__(self, user_id, session):
+        with self.lock:
+            self.sessions[user_id] = session
+            self.touch(user_id)
+        self.mark_dirty(user_id)
+        self.enforce_limits()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def touch(self, user_id):
+        self.sessions.move_to_end(user_id)
+        self.last_access[user_id] = time.time()
+
+    def get(self, user_id, default=None):
+        while True:
+            with self.lock:
+                spill = self.spilling.get(user_id) if user_id not in self.sessions else None
+                if spill is None:
+                    session = self.sessions.get(user_id)
+                    if session is not None and user_id not in self.dirty and self.is_stale(user_id):
+                        session = None # Changed by another process: reload it
+                    if session is None:
+                        session = self.load(user_id)
+                        if session is None:
+                            return default
+                        self.sessions[user_id] = session
+                        self.stats["loads"] += 1
+                    self.touch(user_id)
+                    break
+            spill.wait() # Being written out: the backend only has the older copy until the write finishes
+        if session is not None and len(self.sessions) > (self.max_sessions or float("inf")):
+            self.enforce_limits()
+        return session
+
+    def mark_dirty(self, user_id, session=None):
+        """Marks a session as changed. Passing the session re-attaches it if it was evicted mid-turn."""
+        with self.lock:
+            if user_id not in self.sessions and session is not None:
+                self.sessions[user_id] = session
+                self.touch(user_id)
+            if user_id in self.sessions:
+                self.dirty.add(user_id)
+
+    def serialize(self, user_id, session):
+        try:
+            return json.dumps(session.to_dict(), separators=(",", ":"))
+        except (RuntimeError, TypeError, ValueError) as e: # e.g. mutated mid-serialization
+            logging.warning(f"Could not serialize session {user_id}, will retry: {e}")
+            return None
+
+    def flush(self):
+        """Writes every dirty session. Sessions that fail to serialize or write stay dirty for the next flush."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            pending = {user_id: self.sessions[user_id] for user_id in dirty if user_id in self.sessions}
+        records = []
+        for user_id, session in pending.items():
+            data = self.serialize(user_id, session)
+            if data is None:
+                self.mark_dirty(user_id)
+            else:
+                records.append((user_id, data))
+        failed = self.save_many(records) if records else []
+        for user_id in failed:
+            self.mark_dirty(user_id, pending[user_id])
+        return len(records) - len(failed)
+
+    def evict(self, user_ids, reason):
+        """
+        Spills the given live sessions to the backend and drops them from memory.
+        Sessions that cannot be serialized or written are put back, dirty, and retried later.
+        """
+        evicted, records, failed = {}, [], []
+        with self.lock:
+            for user_id in user_ids:
+                session = self.sessions.pop(user_id, None)
+                self.last_access.pop(user_id, None)
+                was_dirty = user_id in self.dirty
+                self.dirty.discard(user_id)
+                if session is None:
+                    continue
+                evicted[user_id] = session
+                self.spilling[user_id] = threading.Event() # get() waits for the write instead of loading stale data
+                chart_cache.invalidate_user(user_id) # Series versions restart when the session is reloaded
+                if was_dirty or not self.exists(user_id):
+                    data = self.serialize(user_id, session)
+                    if data is None:
+                        failed.append(user_id)
+                    else:
+                        records.append((user_id, data))
+        written = len(records)
+        if records:
+            try:
+                write_failed = self.save_many(records)
+            except Exception as e: # Waiting get() calls must always be released
+                logging.error(f"Session spill failed: {e}")
+                write_failed = [user_id for user_id, _ in records]
+            written -= len(write_failed)
+            failed.extend(write_failed)
+        with self.lock:
+            for user_id in failed:
+                # Keep the unsaved copy (unless mark_dirty re-attached it mid-turn)
+                self.sessions.setdefault(user_id, evicted.pop(user_id))
+                self.sessions.move_to_end(user_id, last=False)
+                self.last_access[user_id] = time.time()
+                self.dirty.add(user_id)
+            for user_id in list(evicted) + failed:
+                self.spilling.pop(user_id).set()
+        if failed:
+            logging.warning(f"Kept {len(failed)} sessions in memory after failed spill ({reason})")
+        self.stats["expirations" if reason == "idle" else "evictions"] += len(evicted)
+        self.stats["spills"] += written
+        if evicted:
+            logging.info(f"Evicted {len(evicted)} sessions ({reason}); {len(self.sessions)} live")
+
+    def enforce_limits(self, now=None):
+        """Expires idle sessions, then evicts least recently used ones until within the caps."""
+        now = time.time() if now is None else now
+        with self.lock:
+            idle = []
+            if self.idle_ttl:
+                idle = [user_id for user_id in self.sessions
+                        if now - self.last_access.get(user_id, now) > self.idle_ttl]
+            over = []
+            idle_set = set(idle)
+            live = [user_id for user_id in self.sessions if user_id not in idle_set]
+            total_bytes = sum(self.sessions[user_id].approx_bytes() for user_id in live) if self.max_bytes else 0
+            for user_id in live[:-1]: # Never evict the most recently used session
+                too_many = self.max_sessions and len(live) - len(over) > self.max_sessions
+                too_big = self.max_bytes and total_bytes > self.max_bytes
+                if not (too_many or too_big):
+                    break
+                over.append(user_id)
+                if self.max_bytes:
+                    total_bytes -= self.sessions[user_id].approx_bytes()
+        if idle:
+            self.evict(idle, "idle")
+        if over:
+            self.evict(over, "lru")
+
+    def metrics(self):
+        """Session counts, approximate live memory and eviction counters."""
+        with self.lock:
+            live = list(self.sessions.values())
+            dirty = len(self.dirty)
+        return {
+            "live_sessions": len(live),
+            "dirty_sessions": dirty,
+            "approx_bytes": sum(session.approx_bytes() for session in live),
+            **self.stats,
+        }
+
+    def maintenance_loop(self, interval):
+        while not self.closed.wait(interval):
+            try:
+                self.flush()
+                self.enforce_limits()
+            except Exception as e:
+                logging.error(f"Session store maintenance failed: {e}")
+
+    def start_maintenance(self, interval):
+        """Starts the background flush/expiry thread."""
+        self.maintainer = threading.Thread(target=self.maintenance_loop, args=(interval,),
+                                           name="session-maintenance", daemon=True)
+        self.maintainer.start()
+        atexit.register(self.close)
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.flush()
+
+class InMemorySessionStore(SessionStore):
+    """
+    Process-local store (the original behaviour). Nothing is persisted across
+    restarts; sessions evicted from memory are spilled to JSON files in `spill_dir`
+    (or discarded when it is None) and spill files unused for `spill_retention`
+    seconds are removed.
+    """
+    def __init__(self, spill_dir=None, spill_retention=None, **limits):
+        super().__init__(**limits)
+        self.spill_dir = spill_dir
+        self.spill_retention = spill_retention
+        self.last_spill_sweep = 0.0
+
+    def spill_path(self, user_id):
+        return os.path.join(self.spill_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", user_id) + ".json")
+
+    def load(self, user_id):
+        if not self.spill_dir:
+            return None
+        path = self.spill_path(user_id)
+        try:
+            with open(path, encoding="utf-8") as f:
+                session = UserSession.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Could not reload spilled session {user_id}: {e}")
+            return None
+        os.remove(path) # Live again; re-spilled on the next eviction
+        return session
+
+    def exists(self, user_id):
+        return bool(self.spill_dir) and os.path.exists(self.spill_path(user_id))
+
+    def flush(self):
+        with self.lock:
+            self.dirty.clear() # Nothing durable to write; eviction spills the session itself
+        return 0
+
+    def save_many(self, records):
+        if not self.spill_dir:
+            return [] # Evicted sessions are discarded by design
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        except OSError as e:
+            logging.error(f"Could not create spill directory {self.spill_dir}: {e}")
+            return [user_id for user_id, _ in records]
+        failed = []
+        for user_id, data in records:
+            try:
+                with open(self.spill_path(user_id), "w", encoding="utf-8") as f:
+                    f.write(data)
+            except OSError as e:
+                logging.error(f"Could not spill session {user_id}: {e}")
+                failed.append(user_id)
+        return failed
+
+    def enforce_limits(self, now=None):
+        super().enforce_limits(now)
+        now = time.time() if now is None else now
+        # Drop stale spill files, at most once an hour
+        if self.spill_dir and self.spill_retention and now - self.last_spill_sweep > 3600 and os.path.isdir(self.spill_dir):
+            self.last_spill_sweep = now
+            cutoff = now - self.spill_retention
+            for entry in os.scandir(self.spill_dir):
+                if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLite-backed store in WAL mode, shareable by several app processes. Sessions are
+    stored as JSON rows; the maintenance thread flushes dirty sessions every
+    `flush_interval` seconds in one transaction, and close() flushes the rest.
+    Evicted sessions simply stay in the database.
+
+    Each row carries a version. Writes are compare-and-swap against the version this
+    process last loaded or wrote, and get() reloads a clean live session when the row
+    has moved on. If two processes change the same session between flushes, the later
+    write loses: its live copy is dropped (with a warning) and the stored one reloaded.
+    """
+    def __init__(self, path, **limits):
+        super().__init__(**limits)
+        self.path = path
+        self.db_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL") # Durable at checkpoints; fine for write-behind
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                          "user_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL, "
+                          "version INTEGER NOT NULL DEFAULT 0)")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(sessions)")}
+        if "version" not in columns: # Database created before rows were versioned
+            self.conn.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self.versions = {} # user_id -> row version this process last loaded or wrote
+        self.stats["conflicts"] = 0
+        logging.info(f"SQLite session store opened at {path}")
+
+    def load(self, user_id):
+        with self.db_lock:
+            row = self.conn.execute("SELECT data, version FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            self.versions[user_id] = row[1]
+        try:
+            return UserSession.from_dict(json.loads(row[0]))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Could not load stored session {user_id}: {e}")
+            return None
+
+    def is_stale(self, user_id):
+        with self.db_lock:
+            row = self.conn.execute("SELECT version FROM sessions WHERE user_id = ?", (user_id,)).fetchone()
+            return row is not None and row[0] != self.versions.get(user_id)
+
+    def exists(self, user_id):
+        with self.db_lock:
+            return self.conn.execute("SELECT 1 FROM sessions WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def save_many(self, records):
+        now = time.time()
+        written, conflicts = {}, []
+        with self.db_lock:
+            try:
+                self.conn.execute("BEGIN IMMEDIATE")
+                for user_id, data in records:
+                    version = self.versions.get(user_id)
+                    if version is None: # Not loaded from the database: only create the row
+                        cursor = self.conn.execute(
+                            "INSERT INTO sessions (user_id, data, updated_at, version) VALUES (?, ?, ?, 1) "
+                            "ON CONFLICT(user_id) DO NOTHING", (user_id, data, now))
+                    else:
+                        cursor = self.conn.execute(
+                            "UPDATE sessions SET data = ?, updated_at = ?, version = version + 1 "
+                            "WHERE user_id = ? AND version = ?", (data, now, user_id, version))
+                    if cursor.rowcount:
+                        written[user_id] = (version or 0) + 1
+                    else:
+                        conflicts.append(user_id)
+                self.conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                logging.error(f"Failed to write {len(records)} sessions, will retry: {e}")
+                return [user_id for user_id, _ in records]
+            self.versions.update(written)
+            for user_id in conflicts:
+                self.versions.pop(user_id, None)
+        if conflicts:
+            # Another process wrote these sessions first: drop our copies so get() reloads theirs
+            with self.lock:
+                for user_id in conflicts:
+                    self.sessions.pop(user_id, None)
+                    self.last_access.pop(user_id, None)
+                    self.dirty.discard(user_id)
+                self.stats["conflicts"] += len(conflicts)
+            logging.warning(f"Discarded {len(conflicts)} sessions changed by another process: {conflicts}")
+        logging.debug(f"Flushed {len(written)} sessions to {self.path}")
+        return []
+
+    def delete(self, user_id):
+        with self.lock:
+            self.sessions.pop(user_id, None)
+            self.last_access.pop(user_id, None)
+            self.dirty.discard(user_id)
+        with self.db_lock:
+            self.conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+            self.versions.pop(user_id, None)
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        super().close()
+        with self.db_lock:
+            self.conn.close()
+
+class EventLog:
+    """
+    Per-user write-ahead log of session mutations: one JSON object per line in
+    <directory>/<user>.log, next to an optional <user>.snapshot.json. Appends are
+    buffered and written with one fsync per user every `fsync_interval` seconds
+    (group commit). After `compact_after` events the session is snapshotted and
+    the log truncated. recover() loads the snapshot and replays the log.
+    """
+    def __init__(self, directory, fsync_interval=0.5, compact_after=1000):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.compact_after = compact_after
+        self.pending = {} # user_id -> [JSON lines not yet written]
+        self.event_counts = {} # user_id -> events in the log since the last snapshot
+        self.lock = threading.Lock() # Guards pending/event_counts
+        self.io_lock = threading.Lock() # Orders file writes; always taken before self.lock
+        self.closed = threading.Event()
+        self.syncer = threading.Thread(target=self.sync_loop, args=(fsync_interval,), name="event-log-sync", daemon=True)
+        self.syncer.start()
+
+    def paths(self, user_id):
+        base = os.path.join(self.directory, re.sub(r"[^A-Za-z0-9_.-]", "_", user_id))
+        return base + ".log", base + ".snapshot.json"
+
+    def exists(self, user_id):
+        return any(os.path.exists(path) for path in self.paths(user_id))
+
+    def append(self, session, event):
+        """Event sink for UserSession.event_sink."""
+        line = json.dumps(event, separators=(",", ":"), default=str)
+        user_id = session.user_id
+        with self.lock:
+            self.pending.setdefault(user_id, []).append(line)
+            self.event_counts[user_id] = self.event_counts.get(user_id, 0) + 1
+            needs_compaction = self.event_counts[user_id] >= self.compact_after
+        if needs_compaction:
+            self.compact(session)
+
+    def sync(self):
+        """Writes and fsyncs every buffered event."""
+        with self.io_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            for user_id, lines in pending.items():
+                try:
+                    with open(self.paths(user_id)[0], "a", encoding="utf-8") as f:
+                        f.write("\n".join(lines) + "\n")
+                        f.flush()
+                        os.fsync(f.fileno())
+                except OSError as e:
+                    logging.error(f"Could not write {len(lines)} events for {user_id}, will retry: {e}")
+                    self.requeue(user_id, lines)
+
+    def requeue(self, user_id, lines, count=0):
+        """Puts unwritten lines back in front of anything appended since they were taken."""
+        with self.lock:
+            self.pending[user_id] = lines + self.pending.get(user_id, [])
+            self.event_counts[user_id] = self.event_counts.get(user_id, 0) + count
+
+    def compact(self, session):
+        """
+        Replaces the user's log with a snapshot of the session. Returns False if the
+        snapshot could not be written; the buffered events are then kept.
+        """
+        user_id = session.user_id
+        log_path, snapshot_path = self.paths(user_id)
+        with self.io_lock:
+            # Serialized under both locks: no event can be appended or synced between
+            # the snapshot and dropping the lines it already reflects
+            with self.lock:
+                try:
+                    snapshot_data = json.dumps(session.to_dict(), separators=(",", ":"))
+                except (RuntimeError, TypeError, ValueError) as e:
+                    logging.error(f"Could not snapshot session {user_id}: {e}")
+                    return False
+                pending = self.pending.pop(user_id, [])
+                count = self.event_counts.get(user_id, 0)
+                self.event_counts[user_id] = 0
+            try:
+                tmp_path = snapshot_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(snapshot_data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, snapshot_path) # Atomic: a crash leaves the old snapshot + full log
+            except OSError as e:
+                logging.error(f"Event log compaction failed for {user_id}: {e}")
+                self.requeue(user_id, pending, count) # Old snapshot and log are untouched
+                return False
+            try:
+                with open(log_path, "w", encoding="utf-8") as f:
+                    os.fsync(f.fileno())
+            except OSError as e:
+                logging.error(f"Could not truncate event log for {user_id} after compaction: {e}")
+        logging.info(f"Compacted event log for {user_id}")
+        return True
+
+    def recover(self, user_id):
+        """Rebuilds a session from its snapshot plus the logged events, or returns None."""
+        self.sync() # Buffered events for this user must be on disk before replay
+        log_path, snapshot_path = self.paths(user_id)
+        session = None
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, encoding="utf-8") as f:
+                session = UserSession.from_dict(json.load(f))
+        replayed = 0
+        if os.path.exists(log_path):
+            with open(log_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        logging.warning(f"Skipping torn event log line for {user_id}")
+                        continue
+                    if session is None:
+                        session = UserSession(user_id)
+                    session.apply_event(event)
+                    replayed += 1
+        with self.lock:
+            self.event_counts[user_id] = replayed
+        if session is not None:
+            logging.info(f"Recovered session {user_id}: snapshot={os.path.exists(snapshot_path)}, {replayed} events replayed")
+        return session
+
+    def sync_loop(self, interval):
+        while not self.closed.wait(interval):
+            self.sync()
+
+    def close(self):
+        self.closed.set()
+        self.sync()
+
+class EventLogSessionStore(SessionStore):
+    """
+    Store whose durability comes from the per-user EventLog: every mutation is
+    logged as it happens, so flush() only forces buffered events to disk, and
+    sessions evicted from memory are compacted into a snapshot.
+    """
+    def __init__(self, directory, fsync_interval=0.5, compact_after=1000, **limits):
+        super().__init__(**limits)
+        self.log = EventLog(directory, fsync_interval=fsync_interval, compact_after=compact_after)
+        logging.info(f"Event-log session store at {directory}")
+
+    def attach(self, session):
+        session.event_sink = self.log.append
+        return session
+
+    def load(self, user_id):
+        try:
+            session = self.log.recover(user_id)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Could not recover session {user_id}: {e}")
+            return None
+        return self.attach(session) if session is not None else None
+
+    def exists(self, user_id):
+        return self.log.exists(user_id)
+
+    def __setitem__(self, user_id, session):
+        self.attach(session)
+        if not self.log.exists(user_id):
+            # Baseline snapshot, so state set before the sink was attached is not lost
+            self.log.compact(session)
+        super().__setitem__(user_id, session)
+
+    def flush(self):
+        with self.lock:
+            self.dirty.clear()
+        self.log.sync()
+        return 0
+
+    def serialize(self, user_id, session):
+        return session # compact() serializes under the log's locks
+
+    def save_many(self, records):
+        # Evicted sessions: fold their log into a snapshot
+        return [user_id for user_id, session in records if not self.log.compact(session)]
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        super().close()
+        self.log.close()
+
+def create_session_store():
+    """Builds the session store selected by MEDIGUIDE_SESSION_STORE ("memory", "sqlite" or "eventlog")."""
+    limits = {"idle_ttl": SESSION_IDLE_TTL, "max_sessions": SESSION_MAX_LIVE, "max_bytes": SESSION_MAX_BYTES}
+    store = None
+    if SESSION_STORE == "sqlite":
+        try:
+            store = SQLiteSessionStore(SESSION_DB_PATH, **limits)
+        except sqlite3.Error as e:
+            logging.error(f"Could not open session database {SESSION_DB_PATH}: {e}. Falling back to memory.")
+    elif SESSION_STORE == "eventlog":
+        try:
+            store = EventLogSessionStore(EVENT_LOG_DIR, fsync_interval=EVENT_LOG_FSYNC_INTERVAL,
+                                         compact_after=EVENT_LOG_COMPACT_EVENTS, **limits)
+        except OSError as e:
+            logging.error(f"Could not open event log directory {EVENT_LOG_DIR}: {e}. Falling back to memory.")
+    if store is None:
+        store = InMemorySessionStore(spill_dir=SESSION_SPILL_DIR or None, spill_retention=SESSION_SPILL_RETENTION, **limits)
+    store.start_maintenance(SESSION_FLUSH_INTERVAL)
+    return store
+
+# Initialize user sessions store
+user_sessions = create_session_store()
 
 # --- Health Data & Resources ---
 # (Keeping these inline for simplicity, but could be loaded from JSON/CSV)
@@ -862,17 +2109,20 @@ WELLNESS_TIPS = {
 
 def get_current_timestamp():
     """Returns the current timestamp in a standard format."""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return datetime.now().strftime(TIMESTAMP_FORMAT)
 
 def generate_health_chart(data_type, data_values, dates, chart_type="line", unit=""):
-    """Generates a base64 encoded PNG chart string using Matplotlib."""
-    if not data_values or not dates or len(data_values) != len(dates):
+    """Generates a chart data URI: inline SVG by default, or PNG via Matplotlib (MEDIGUIDE_CHART_BACKEND)."""
+    if data_values is None or dates is None or len(data_values) == 0 or len(data_values) != len(dates):
         logging.warning(f"Insufficient or mismatched data for plotting {data_type}.")
         return None
 
-    # Ensure data_values are numeric where possible
+    # Ensure data_values are numeric where possible (VitalSeries columns already are)
     numeric_values = []
     valid_dates = []
+    if isinstance(data_values, np.ndarray):
+        numeric_values, valid_dates = data_values.tolist(), list(dates)
+        data_values = ()
     for i, val in enumerate(data_values):
         try:
              # Handle simple numeric strings and numbers
@@ -903,47 +2153,334 @@ def generate_health_chart(data_type, data_values, dates, chart_type="line", unit
         plot_dates = range(len(numeric_values)) # Fallback to indices
 
 
-    plt.style.use('seaborn-v0_8-fivethirtyeight') # Use a nice style
-    fig, ax = plt.subplots(figsize=(8, 4)) # Smaller figure size for dashboard
-
     try:
-        if chart_type == "line":
-            ax.plot(plot_dates, numeric_values, marker='o', linestyle='-', color='var(--primary-color)', linewidth=2)
-            ax.fill_between(plot_dates, numeric_values, alpha=0.1, color='var(--secondary-color)')
-        elif chart_type == "bar":
-            ax.bar(plot_dates, numeric_values, color='var(--primary-color)')
-        elif chart_type == "scatter":
-            ax.scatter(plot_dates, numeric_values, color='var(--primary-color)', s=60, alpha=0.7)
-
-        ax.set_title(f'{data_type} Trend', fontsize=14, fontweight='bold', color='var(--text-color)')
-        ax.set_ylabel(f"{data_type}{(' (' + unit + ')') if unit else ''}", fontsize=10, color='#555555')
-        ax.grid(True, linestyle='--', alpha=0.6, axis='y') # Grid on y-axis only
-        ax.tick_params(axis='x', rotation=30, labelsize=9)
-        ax.tick_params(axis='y', labelsize=9)
-
-        # Add reference ranges if applicable (simplified)
-        range_info = get_normal_range(data_type)
-        if range_info:
-             min_val, max_val = range_info
-             ax.axhspan(min_val, max_val, alpha=0.15, color='var(--success-color)', label=f'Normal ({min_val}-{max_val})')
-             ax.legend(fontsize=8)
-
-        # Improve layout
-        fig.tight_layout()
-
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=90) # Lower DPI for web
-        buf.seek(0)
-        img_str = base64.b64encode(buf.read()).decode('utf-8')
-        plt.close(fig) # Close the figure to free memory
-        logging.debug(f"Generated chart for {data_type}")
-        return f"data:image/png;base64,{img_str}"
-
+        if CHART_BACKEND == "matplotlib":
+            chart_url = render_chart_png(data_type, plot_dates, numeric_values, chart_type, unit)
+        else:
+            chart_url = render_chart_svg(data_type, plot_dates, numeric_values, chart_type, unit)
+        logging.debug(f"Generated {CHART_BACKEND} chart for {data_type}")
+        return chart_url
     except Exception as e:
         logging.error(f"Error generating plot for {data_type}: {e}")
-        plt.close(fig) # Ensure figure is closed even on error
         return None
 
+# Hex equivalents of the CSS theme variables; chart renderers cannot resolve var(--...)
+THEME_COLORS = {
+    "primary": "#0069b3",
+    "secondary": "#6ac6ff",
+    "text": "#333333",
+    "muted": "#555555",
+    "grid": "#dddddd",
+    "success": "#28a745",
+}
+
+def get_figure_class():
+    """Imports Matplotlib's Figure on first use; only the matplotlib chart backend needs it."""
+    from matplotlib.figure import Figure # Figure renders through the Agg canvas without pyplot
+    return Figure
+
+def render_chart_png(data_type, plot_dates, numeric_values, chart_type="line", unit=""):
+    """Renders a PNG data URI with Matplotlib's object-oriented Figure API (no pyplot global state)."""
+    fig = get_figure_class()(figsize=(8, 4)) # Smaller figure size for dashboard
+    ax = fig.subplots()
+    if chart_type == "line":
+        ax.plot(plot_dates, numeric_values, marker='o', linestyle='-', color=THEME_COLORS["primary"], linewidth=2)
+        ax.fill_between(plot_dates, numeric_values, alpha=0.1, color=THEME_COLORS["secondary"])
+    elif chart_type == "bar":
+        ax.bar(plot_dates, numeric_values, color=THEME_COLORS["primary"])
+    elif chart_type == "scatter":
+        ax.scatter(plot_dates, numeric_values, color=THEME_COLORS["primary"], s=60, alpha=0.7)
+
+    ax.set_title(f'{data_type} Trend', fontsize=14, fontweight='bold', color=THEME_COLORS["text"])
+    ax.set_ylabel(f"{data_type}{(' (' + unit + ')') if unit else ''}", fontsize=10, color=THEME_COLORS["muted"])
+    ax.grid(True, linestyle='--', alpha=0.6, axis='y') # Grid on y-axis only
+    ax.tick_params(axis='x', rotation=30, labelsize=9)
+    ax.tick_params(axis='y', labelsize=9)
+
+    # Add reference ranges if applicable (simplified)
+    range_info = get_normal_range(data_type)
+    if range_info:
+         min_val, max_val = range_info
+         ax.axhspan(min_val, max_val, alpha=0.15, color=THEME_COLORS["success"], label=f'Normal ({min_val}-{max_val})')
+         ax.legend(fontsize=8)
+
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=90) # Lower DPI for web
+    img_str = base64.b64encode(buf.getvalue()).decode('utf-8')
+    return f"data:image/png;base64,{img_str}"
+
+def render_chart_svg(data_type, plot_dates, numeric_values, chart_type="line", unit=""):
+    """
+    Renders a small SVG line/bar/scatter chart as a data URI. Pure string building,
+    so it is thread-safe and a fraction of the size of a base64 PNG.
+    """
+    width, height = 640, 280
+    left, right, top, bottom = 56, 16, 36, 40
+    plot_w, plot_h = width - left - right, height - top - bottom
+
+    # X positions: proportional to time when dates are datetimes, else evenly spaced
+    if all(isinstance(d, datetime) for d in plot_dates):
+        xs = [d.timestamp() for d in plot_dates]
+    else:
+        xs = list(range(len(numeric_values)))
+    x_min, x_max = min(xs), max(xs)
+    x_span = (x_max - x_min) or 1
+
+    numeric_values = list(numeric_values)
+    range_info = get_normal_range(data_type)
+    y_low = min(numeric_values + ([range_info[0]] if range_info else []))
+    y_high = max(numeric_values + ([range_info[1]] if range_info else []))
+    pad = (y_high - y_low) * 0.08 or 1
+    y_low, y_high = y_low - pad, y_high + pad
+    if chart_type == "bar":
+        y_low = min(0, y_low)
+
+    def px(x): return left + (x - x_min) / x_span * plot_w
+    def py(y): return top + (y_high - y) / (y_high - y_low) * plot_h
+
+    colors = THEME_COLORS
+    parts = [f"<svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 {width} {height}' "
+             f"font-family='sans-serif' font-size='11'>",
+             f"<rect width='{width}' height='{height}' fill='#ffffff'/>",
+             f"<text x='{width / 2}' y='22' text-anchor='middle' font-size='15' font-weight='bold' "
+             f"fill='{colors['text']}'>{html_escape(data_type)} Trend</text>"]
+
+    # Normal range band
+    if range_info:
+        band_top, band_bottom = py(range_info[1]), py(range_info[0])
+        parts.append(f"<rect x='{left}' y='{band_top:.1f}' width='{plot_w}' height='{band_bottom - band_top:.1f}' "
+                     f"fill='{colors['success']}' fill-opacity='0.15'/>")
+        parts.append(f"<text x='{left + plot_w - 4}' y='{band_top + 12:.1f}' text-anchor='end' font-size='10' "
+                     f"fill='{colors['success']}'>Normal ({range_info[0]}-{range_info[1]})</text>")
+
+    # Horizontal grid lines with y labels
+    for i in range(5):
+        value = y_low + (y_high - y_low) * i / 4
+        y = py(value)
+        parts.append(f"<line x1='{left}' x2='{left + plot_w}' y1='{y:.1f}' y2='{y:.1f}' stroke='{colors['grid']}' stroke-dasharray='4 3'/>")
+        parts.append(f"<text x='{left - 6}' y='{y + 4:.1f}' text-anchor='end' fill='{colors['muted']}'>{value:.4g}</text>")
+
+    # X labels: first, middle and last point
+    for i in sorted({0, len(xs) // 2, len(xs) - 1}):
+        label = plot_dates[i].strftime("%b %d") if isinstance(plot_dates[i], datetime) else str(plot_dates[i])
+        parts.append(f"<text x='{px(xs[i]):.1f}' y='{height - bottom + 18}' text-anchor='middle' "
+                     f"fill='{colors['muted']}'>{html_escape(label)}</text>")
+    y_label = f"{data_type}{(' (' + unit + ')') if unit else ''}"
+    parts.append(f"<text transform='translate(14 {top + plot_h / 2:.1f}) rotate(-90)' text-anchor='middle' "
+                 f"fill='{colors['muted']}'>{html_escape(y_label)}</text>")
+
+    points = [(px(x), py(y)) for x, y in zip(xs, numeric_values)]
+    if chart_type == "bar":
+        bar_w = max(2.0, plot_w / len(points) * 0.6)
+        base = py(max(y_low, 0))
+        for x, y in points:
+            parts.append(f"<rect x='{x - bar_w / 2:.1f}' y='{min(y, base):.1f}' width='{bar_w:.1f}' "
+                         f"height='{abs(base - y):.1f}' fill='{colors['primary']}'/>")
+    else:
+        if chart_type == "line":
+            coords = " ".join(f"{x:.1f},{y:.1f}" for x, y in points)
+            area = f"{points[0][0]:.1f},{top + plot_h} {coords} {points[-1][0]:.1f},{top + plot_h}"
+            parts.append(f"<polygon points='{area}' fill='{colors['secondary']}' fill-opacity='0.1'/>")
+            parts.append(f"<polyline points='{coords}' fill='none' stroke='{colors['primary']}' stroke-width='2'/>")
+        if chart_type == "scatter" or len(points) <= 60: # Markers only while they stay readable
+            radius, opacity = (4, 0.7) if chart_type == "scatter" else (3, 1)
+            parts.extend(f"<circle cx='{x:.1f}' cy='{y:.1f}' r='{radius}' fill='{colors['primary']}' fill-opacity='{opacity}'/>"
+                         for x, y in points)
+    parts.append("</svg>")
+    return "data:image/svg+xml;utf8," + url_quote("".join(parts), safe=" ='/:,.;()-")
+
+class ChartCache:
+    """
+    LRU cache of rendered chart data URIs, bounded by total payload bytes.
+    Entries are keyed by (user, vital type, chart type) and tagged with the series
+    version, so a new reading invalidates exactly that chart and stale renders are
+    replaced in place instead of lingering until evicted.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = collections.OrderedDict() # key -> (version, chart_url, size)
+        self.lock = threading.Lock() # Dashboard renders run on Gradio worker threads
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None, False
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], True
+
+    def put(self, key, version, chart_url):
+        size = len(chart_url) if chart_url else 64 # Failed renders are cached too, at a nominal size
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[2]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (version, chart_url, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == user_id]:
+                self.total_bytes -= self.entries.pop(key)[2]
+
+chart_cache = ChartCache(CHART_CACHE_MAX_BYTES)
+
+def vital_chart_args(vital_type, series, chart_type="line", window_days=None):
+    """
+    Builds picklable generate_health_chart arguments for a vital series: the last
+    `window_days` days (None for all), LTTB-downsampled to CHART_MAX_POINTS, systolic for BP.
+    """
+    plot_type = vital_type.replace('_', ' ').title()
+    plot_unit = series.latest().get("unit", "") # From the full series: the window may hold no readings
+    if window_days is not None:
+        series = series.slice(start=time.time() - window_days * 86400)
+    chart_timestamps, chart_values = series.downsample(CHART_MAX_POINTS)
+    chart_dates = [datetime.fromtimestamp(ts) for ts in chart_timestamps]
+    if series.is_pair:
+        plot_type = "Systolic Blood Pressure"
+        plot_unit = "mmHg"
+    return (plot_type, chart_values, chart_dates, chart_type, plot_unit)
+
+def chart_window_version(series, window_days):
+    """Cache version for a chart: the series version, plus the hour for time-windowed charts."""
+    if window_days is None:
+        return series.version
+    return (series.version, int(time.time() // 3600))
+
+def render_vital_chart(user_id, vital_type, series, chart_type="line"):
+    """Returns the chart data URI for a vital series, re-rendering only when the series changed."""
+    key = (user_id, vital_type, chart_type)
+    chart_url, hit = chart_cache.get(key, series.version)
+    if hit:
+        return chart_url
+    chart_url = generate_health_chart(*vital_chart_args(vital_type, series, chart_type))
+    chart_cache.put(key, series.version, chart_url)
+    return chart_url
+
+# --- Chart Worker Pool ---
+# Matplotlib renders are CPU-bound and hold the GIL, so with the matplotlib backend the
+# dashboard fans them out to a small pool of worker processes. SVG renders stay in-thread.
+
+chart_executor = None
+chart_executor_lock = threading.Lock()
+
+def warm_chart_worker():
+    """Worker initializer: loads Agg and the font cache before the first real render."""
+    fig = get_figure_class()(figsize=(1, 1))
+    fig.subplots().plot([0, 1], [0, 1])
+    fig.savefig(io.BytesIO(), format='png')
+
+def get_chart_executor():
+    """Returns the shared chart ProcessPoolExecutor, or None when the pool is disabled."""
+    global chart_executor
+    if CHART_BACKEND != "matplotlib" or CHART_RENDER_WORKERS <= 0:
+        return None
+    with chart_executor_lock:
+        if chart_executor is None:
+            # Prefer fork so workers need not re-import the app; start them before the server threads
+            method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+            chart_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=CHART_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context(method),
+                initializer=warm_chart_worker)
+            logging.info(f"Started chart worker pool with {CHART_RENDER_WORKERS} processes")
+        return chart_executor
+
+def reset_chart_executor(executor, kill_after=None):
+    """
+    Replaces a broken or hung pool so the next dashboard view starts a fresh one. Renders
+    other views already submitted are not cancelled. With `kill_after`, the old workers are
+    terminated after that many seconds, by which time every view has given up on them.
+    """
+    global chart_executor
+    with chart_executor_lock:
+        if chart_executor is not executor:
+            return # Already replaced by another view
+        chart_executor = None
+    processes = list((getattr(executor, "_processes", None) or {}).values()) # Captured before shutdown() drops them
+    executor.shutdown(wait=False)
+    if kill_after is not None:
+        killer = threading.Timer(kill_after, terminate_chart_workers, args=(processes,))
+        killer.daemon = True
+        killer.start()
+
+def terminate_chart_workers(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+            process.join(timeout=5)
+    logging.info(f"Terminated {len(processes)} retired chart worker processes")
+
+def render_vital_charts(user_id, vital_signs, chart_type="line", window_days=None):
+    """
+    Returns {vital_type: chart data URI} for every vital with at least two readings
+    (in the last `window_days` days, when given).
+    Cached charts are reused; the rest render in parallel on the worker pool when it is
+    enabled, or in-process when it is disabled or broken. Renders still running after
+    CHART_RENDER_TIMEOUT seconds are abandoned (their chart is omitted and retried on the
+    next view). A running render cannot be cancelled, so the pool is then replaced and
+    its workers terminated once other views' deadlines on them have passed.
+    """
+    charts = {}
+    pending = {} # vital_type -> (series version, chart args)
+    cache_chart_type = chart_type if window_days is None else f"{chart_type}:{window_days}d"
+    for vital_type, series in vital_signs.items():
+        if len(series) < 2: continue
+        version = chart_window_version(series, window_days)
+        chart_url, hit = chart_cache.get((user_id, vital_type, cache_chart_type), version)
+        if hit:
+            charts[vital_type] = chart_url
+        else:
+            pending[vital_type] = (version, vital_chart_args(vital_type, series, chart_type, window_days))
+    if not pending:
+        return charts
+
+    executor = get_chart_executor()
+    futures = None
+    if executor is not None:
+        try:
+            futures = {executor.submit(generate_health_chart, *args): vital_type
+                       for vital_type, (version, args) in pending.items()}
+        except concurrent.futures.process.BrokenProcessPool:
+            logging.error("Chart worker pool is broken; rendering in-process.")
+            reset_chart_executor(executor)
+    if futures is None:
+        for vital_type, (version, args) in pending.items():
+            charts[vital_type] = generate_health_chart(*args)
+            chart_cache.put((user_id, vital_type, cache_chart_type), version, charts[vital_type])
+        return charts
+
+    done, not_done = concurrent.futures.wait(futures, timeout=CHART_RENDER_TIMEOUT)
+    for future in done:
+        vital_type = futures[future]
+        try:
+            charts[vital_type] = future.result()
+        except Exception as e:
+            logging.error(f"Chart worker failed for {vital_type}: {e}")
+            if isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                reset_chart_executor(executor)
+            continue
+        chart_cache.put((user_id, vital_type, cache_chart_type), pending[vital_type][0], charts[vital_type])
+    hung = False
+    for future in not_done:
+        hung |= not future.cancel() # False once the render has started in a worker
+        logging.warning(f"Chart render for {futures[future]} timed out after {CHART_RENDER_TIMEOUT}s")
+    if hung:
+        logging.warning("Replacing the chart worker pool; timed-out renders are still holding workers.")
+        reset_chart_executor(executor, kill_after=CHART_RENDER_TIMEOUT)
+    return charts
+
 def get_normal_range(vital_type):
     """Returns typical normal range (min, max) for common vital signs."""
     vital_type = vital_type.lower()
@@ -958,72 +2495,50 @@ def get_normal_range(vital_type):
 def is_vital_in_normal_range(vital_type, value):
     """Checks if a vital sign value is within a typical normal range."""
     vital_type = vital_type.lower()
-    range_info = get_normal_range(vital_type)
-    if range_info is None:
+    if get_normal_range(vital_type) is None:
         return None # Cannot determine range
 
-    min_val, max_val = range_info
-
-    try:
+    parsed = parse_vital_value(vital_type, value)
+    if parsed is None:
         if "blood pressure" in vital_type:
-            # Expects value like "120/80"
-            parts = str(value).split('/')
-            if len(parts) == 2:
-                systolic = int(parts[0].strip())
-                diastolic = int(parts[1].strip())
-                # Check both components against *their* specific ranges
-                sys_range = get_normal_range("systolic blood pressure")
-                dia_range = get_normal_range("diastolic blood pressure")
-                if sys_range and dia_range:
-                    return sys_range[0] <= systolic <= sys_range[1] and dia_range[0] <= diastolic <= dia_range[1]
             return False # Invalid format
-        else:
-            # Handle numeric types
-            numeric_value = float(value)
-            # Simple temperature scale check (heuristic)
-            if "temperature" in vital_type:
-                 if numeric_value > 50: # Assume Fahrenheit
-                     pass # Use default F range
-                 else: # Assume Celsius
-                     min_val, max_val = (36.1, 37.2) # Celsius range
-
-            return min_val <= numeric_value <= max_val
-    except (ValueError, TypeError, IndexError):
         logging.warning(f"Could not parse value '{value}' for vital type '{vital_type}' range check.")
         return None # Cannot parse value
+    return vital_values_in_range(vital_type, *parsed)
+
+def vital_values_in_range(vital_type, value, value2=None):
+    """Range check on already-parsed numbers (value2 is the diastolic reading for blood pressure)."""
+    vital_type = vital_type.lower()
+    range_info = get_normal_range(vital_type)
+    if range_info is None:
+        return None
+    min_val, max_val = range_info
+
+    if "blood pressure" in vital_type:
+        # Check both components against *their* specific ranges
+        sys_range = get_normal_range("systolic blood pressure")
+        dia_range = get_normal_range("diastolic blood pressure")
+        return bool(sys_range[0] <= value <= sys_range[1] and dia_range[0] <= value2 <= dia_range[1])
+
+    # Simple temperature scale check (heuristic)
+    if "temperature" in vital_type and value <= 50: # Assume Celsius
+        min_val, max_val = (36.1, 37.2) # Celsius range
+    return bool(min_val <= value <= max_val)
 
-def analyze_health_trends(session: UserSession):
-    """Analyzes trends in vital signs, symptoms, and activities."""
+def analyze_health_trends(session: UserSession, current_score=None):
+    """Analyzes trends in vital signs, symptoms, and activities. Read-only: records no score snapshot."""
     if not session: return None
     trends = {}
-    now = datetime.now()
+    now = time.time()
 
     # Analyze vital signs trends (simple slope calculation if > 2 points)
-    for vital_type, measurements in session.vital_signs.items():
-        if len(measurements) < 2: continue
+    for vital_type, series in session.vital_signs.items():
+        if len(series) < 2: continue
 
-        numeric_values = []
-        timestamps = []
-        is_bp = "blood_pressure" in vital_type.lower()
-
-        for m in measurements:
-            try:
-                timestamp = datetime.strptime(m["timestamp"], "%Y-%m-%d %H:%M:%S")
-                if is_bp:
-                    parts = str(m["value"]).split('/')
-                    if len(parts) == 2:
-                        numeric_values.append(int(parts[0].strip())) # Use Systolic for trend indication
-                        timestamps.append(timestamp)
-                else:
-                    numeric_values.append(float(m["value"]))
-                    timestamps.append(timestamp)
-            except (ValueError, TypeError, IndexError):
-                continue # Skip invalid entries for trend analysis
-
-        if len(numeric_values) >= 2:
-            # Simple trend: Compare last value to average of previous ones
-            latest_val = numeric_values[-1]
-            avg_previous = np.mean(numeric_values[:-1]) if len(numeric_values) > 1 else latest_val
+        if len(series) >= 2:
+            # Simple trend: Compare last value (systolic for BP) to average of previous ones
+            latest_val = series.values[-1]
+            avg_previous = series.mean_before_latest() # O(1) from the running sum
 
             trend_direction = "stable"
             if latest_val > avg_previous + (0.05 * abs(avg_previous)): # > 5% increase
@@ -1044,47 +2559,40 @@ def analyze_health_trends(session: UserSession):
                 elif higher_is_better:
                     is_improving = trend_direction == "increasing"
 
+            daily = series.slice(start=now - TREND_DAILY_DAYS * 86400).daily_aggregates()
             trends[vital_type] = {
                 "direction": trend_direction,
                 "improving": is_improving, # True, False, or None
-                "latest_value": measurements[-1]['value'],
-                "is_in_range": is_vital_in_normal_range(vital_type, measurements[-1]['value'])
+                "latest_value": series.format_value(len(series) - 1),
+                "is_in_range": series.latest_in_range(),
+                # Daily means over the last TREND_DAILY_DAYS days (systolic for BP)
+                "daily_means": [(format_timestamp(day, "%Y-%m-%d"), round(float(mean), 1))
+                                for day, mean in zip(daily["day"], daily["mean"])]
             }
 
     # Analyze symptom trends (frequency in last 14 days)
-    recent_symptoms = [s for s in session.symptom_log
-                       if (now - datetime.strptime(s["timestamp"], "%Y-%m-%d %H:%M:%S")).days <= 14]
+    recent_symptoms = session.recent_symptoms[14].expire(now)
     if recent_symptoms:
-        symptom_frequency = {}
-        for entry in recent_symptoms:
-            symptom = entry["symptom"]
-            symptom_frequency[symptom] = symptom_frequency.get(symptom, 0) + 1
         trends["symptoms"] = {
-            "most_frequent": sorted(symptom_frequency.items(), key=lambda item: item[1], reverse=True)[:3],
+            "most_frequent": recent_symptoms.most_frequent(3),
             "total_reported": len(recent_symptoms),
-            "unique_count": len(symptom_frequency)
+            "unique_count": recent_symptoms.unique_count()
         }
 
     # Analyze wellness activity trends (frequency in last 14 days)
-    recent_activities = [a for a in session.wellness_activities
-                         if (now - datetime.strptime(a["timestamp"], "%Y-%m-%d %H:%M:%S")).days <= 14]
+    recent_activities = session.recent_activities[14].expire(now)
     if recent_activities:
-        activity_types = {}
-        for activity in recent_activities:
-            activity_type = activity["activity_type"]
-            activity_types[activity_type] = activity_types.get(activity_type, 0) + 1
         trends["wellness"] = {
-            "most_frequent": sorted(activity_types.items(), key=lambda item: item[1], reverse=True)[:3],
+            "most_frequent": recent_activities.most_frequent(3),
             "total_activities": len(recent_activities),
-            "unique_types": len(activity_types)
+            "unique_types": recent_activities.unique_count()
         }
 
     # Health score trend
-    current_score = session.calculate_health_score() # Ensure latest score is calculated
-    score_history = session.health_analytics["health_score_history"]
-    if score_history:
-        previous_score_entry = score_history[-1]
-        previous_score = previous_score_entry["score"]
+    if current_score is None:
+        current_score = session.calculate_health_score()
+    previous_score = session.previous_health_score(now)
+    if previous_score is not None:
         score_change = current_score - previous_score
         score_direction = "improving" if score_change > 0 else "declining" if score_change < 0 else "stable"
         trends["health_score"] = {
@@ -1102,175 +2610,322 @@ def analyze_health_trends(session: UserSession):
 
     return trends
 
-def preprocess_health_query(message):
-    """Detects potential emergencies and extracts basic health data using regex."""
-    message_lower = message.lower()
-    is_emergency = False
+# --- Keyword Matching ---
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton: finds every occurrence of a fixed set of keywords in
+    one left-to-right pass, so the cost per message does not grow with the
+    number of keywords. Matching is case-sensitive; pass lowercased text and
+    keywords for case-insensitive matching.
+    """
+    def __init__(self, keywords):
+        self.keywords = list(dict.fromkeys(keywords)) # Unique, order preserved
+        goto = [{}]
+        outputs = [[]]
+
+        # 1. Build the keyword trie
+        for keyword in self.keywords:
+            state = 0
+            for ch in keyword:
+                next_state = goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][ch] = next_state
+                    goto.append({})
+                    outputs.append([])
+                state = next_state
+            outputs[state].append(keyword)
+
+        # 2. Breadth-first pass for failure links, folded into a full transition table
+        # so matching needs exactly one dict lookup per character
+        fail = [0] * len(goto)
+        delta = [dict(transitions) for transitions in goto]
+        queue = collections.deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            outputs[state] = outputs[state] + outputs[fail[state]]
+            for ch, fallback in delta[fail[state]].items():
+                if ch not in goto[state]:
+                    delta[state][ch] = fallback
+            for ch, next_state in goto[state].items():
+                fail[next_state] = delta[fail[state]].get(ch, 0) if state else 0
+                queue.append(next_state)
+
+        self._delta = delta
+        self._outputs = [tuple(out) for out in outputs]
+
+    def iter_matches(self, text):
+        """Yields (start, end, keyword) for every keyword occurrence in text, overlaps included."""
+        delta = self._delta
+        outputs = self._outputs
+        state = 0
+        for end, ch in enumerate(text, 1):
+            state = delta[state].get(ch, 0)
+            if outputs[state]:
+                for keyword in outputs[state]:
+                    yield end - len(keyword), end, keyword
+
+
+# Words that negate an emergency keyword they directly precede ("no chest pain", "denies chest pain").
+# Deliberately narrow: "never had chest pain this bad" or "without ..." must still raise the alarm
+NEGATION_TERMS = {"no", "not", "denies", "deny", "denied", "dont", "don't", "doesn't", "didn't",
+                  "haven't", "hasn't", "hadn't", "isn't", "wasn't", "aren't", "weren't", "negative"}
+NEGATION_SCOPE_BREAK = re.compile(r"[.;!?,]|\b(?:but|however|and|or|with)\b")
+
+def is_negated(text, start):
+    """Checks whether the word directly before position `start`, in the same clause, is a negation term."""
+    preceding = text[max(0, start - 40):start]
+    scope_breaks = list(NEGATION_SCOPE_BREAK.finditer(preceding))
+    if scope_breaks:
+        preceding = preceding[scope_breaks[-1].end():]
+    words = preceding.split()
+    return bool(words) and words[-1] in NEGATION_TERMS
+
+# Emergency Keywords (Weighted) - More aggressive check
+EMERGENCY_KEYWORDS = {
+    "chest pain": 10, "severe pain": 8, "cannot breathe": 10, "can't breathe": 10,
+    "difficulty breathing": 9, "shortness of breath": 8, "stroke symptoms": 10,
+    "sudden weakness": 9, "sudden numbness": 9, "facial droop": 10, "slurred speech": 9,
+    "severe bleeding": 9, "uncontrolled bleeding": 10, "loss of consciousness": 10,
+    "unconscious": 10, "unresponsive": 10, "seizure": 9, "collapse": 8,
+    "head injury": 8, "major trauma": 8, "overdose": 9, "poisoning": 8,
+    "suicidal": 10, "want to die": 10, "kill myself": 10,
+    "allergic reaction severe": 8, "anaphylaxis": 10,
+    "emergency": 5 # Lower weight for just the word
+}
+EMERGENCY_SCORE_THRESHOLD = 9 # Adjusted threshold
+# Self-harm phrases always count: "I'm not suicidal" is not worth the risk of a miss
+NON_NEGATABLE_EMERGENCY_KEYWORDS = {"suicidal", "want to die", "kill myself"}
+# Optional: ignore keywords directly negated ("no chest pain"). Off by default; a missed emergency costs more
+EMERGENCY_NEGATION = os.getenv("MEDIGUIDE_EMERGENCY_NEGATION", "0") == "1"
+EMERGENCY_AUTOMATON = KeywordAutomaton(EMERGENCY_KEYWORDS)
+
+def score_emergency_keywords(message, check_negation=None):
+    """
+    Scores a message against EMERGENCY_KEYWORDS in one linear pass.
+    Each keyword counts once if it occurs at least once (with check_negation, at
+    least once not directly negated). Returns (score, matched_keywords).
+    """
+    check_negation = EMERGENCY_NEGATION if check_negation is None else check_negation
+    text = message.lower().replace("\u2019", "'") # Treat curly apostrophes like straight ones
+    matched_keywords = []
+    for start, _, keyword in EMERGENCY_AUTOMATON.iter_matches(text):
+        if keyword in matched_keywords:
+            continue
+        if check_negation and keyword not in NON_NEGATABLE_EMERGENCY_KEYWORDS and is_negated(text, start):
+            logging.info(f"Negated emergency keyword ignored: '{keyword}'")
+            continue
+        logging.warning(f"Emergency keyword detected: '{keyword}'")
+        matched_keywords.append(keyword)
+    return sum(EMERGENCY_KEYWORDS[k] for k in matched_keywords), matched_keywords
+
+# Vital-sign extraction: one compiled alternation, scanned once per message.
+# Each alternative is wrapped in a named group so `match.lastgroup` tells which
+# vital matched; the first mention of each vital wins, like the per-vital
+# re.search calls this replaces. The leading lookahead lists the first letter of
+# every keyword so the scan skips all other positions cheaply.
+VITAL_SIGN_PATTERN = re.compile(r"""
+    (?=[bthpgsowai])
+    (?:
+    (?P<blood_pressure>
+        (?:blood\ pressure|bp)\s*(?:is|was|:|)\s*(?P<bp_systolic>\d{2,3})\s*/\s*(?P<bp_diastolic>\d{2,3})
+    )
+  | (?P<temperature>  # "temp 98.6 F", "temperature 37 C"
+        (?:temperature|temp)\s*(?:is|was|:|)\s*(?P<temp_value>\d{2,3}(?:\.\d)?)\s*(?:°|degrees)?\s*(?P<temp_unit>[CF])?
+    )
+  | (?P<heart_rate>  # "hr 70 bpm", "pulse is 65"
+        (?:heart\ rate|hr|pulse)\s*(?:is|was|:|)\s*(?P<hr_value>\d{2,3})\s*(?:bpm)?
+    )
+  | (?P<blood_sugar>  # "sugar 100 mg/dl", "glucose 5.5 mmol/l"
+        (?:blood\ sugar|glucose|sugar\ level)\s*(?:is|was|:|)\s*(?P<sugar_value>\d{1,3}(?:\.\d)?)\s*(?P<sugar_unit>mg/dl|mmol/l)?
+    )
+  | (?P<oxygen_saturation>  # "spo2 98%", "oxygen saturation 97"
+        (?:spo2|oxygen\ saturation|o2\ sat)\s*(?:is|was|:|)\s*(?P<spo2_value>\d{2,3})\s*%?
+    )
+  | (?P<weight_kg>  # "weight 70 kg", "weigh 150 lbs"
+        (?:weight|weighs|weigh)\s*(?:is|was|:|)\s*(?P<weight_value>\d{2,4}(?:\.\d)?)\s*(?P<weight_unit>kg|kilos|kilograms|lb|lbs|pounds)
+    )
+  | (?P<height_cm>  # "height 175 cm", "height 1.75 m", "tall 5 ft 10 in", "height 6'1\""
+        (?:height|tall)\s*(?:is|was|:|)\s*
+        (?:
+            (?P<height_cm_value>\d{2,3}(?:\.\d)?)\s*(?:cm|centimeters)
+          | (?P<height_m_value>\d(?:\.\d{1,2})?)\s*(?:m|meters)
+          | (?P<height_feet>\d+)\s*(?:ft|feet|')(?:\s*(?P<height_inches>\d{1,2})\s*(?:in|inches|"))?
+        )
+    )
+  | (?P<age>  # "age 30", "I am 25 years old"
+        \b(?:age|aged)\s*(?P<age_value>\d{1,3})\b
+      | \bI(?:\ am|'m)\s*(?P<age_value_i>\d{1,3})\s*(?:years?\ old)?\b
+    )
+    )
+""", re.IGNORECASE | re.VERBOSE)
+
+def extract_vital_signs(message):
+    """Extracts vital signs and basic profile numbers from a message in a single regex pass."""
     extracted_data = {}
+    for match in VITAL_SIGN_PATTERN.finditer(message):
+        key = match.lastgroup
+        if key in extracted_data:
+            continue # Keep the first mention of each vital
+
+        if key == "blood_pressure":
+            extracted_data[key] = f"{match.group('bp_systolic')}/{match.group('bp_diastolic')}"
+        elif key == "temperature":
+            value = float(match.group("temp_value"))
+            unit = match.group("temp_unit")
+            # Basic unit inference if not provided
+            if not unit:
+                unit = "°F" if value > 50 else "°C"
+            else:
+                unit = "°F" if unit.upper() == "F" else "°C"
+            extracted_data[key] = {"value": value, "unit": unit}
+        elif key == "heart_rate":
+            extracted_data[key] = {"value": int(match.group("hr_value")), "unit": "bpm"}
+        elif key == "blood_sugar":
+            unit = match.group("sugar_unit").lower() if match.group("sugar_unit") else "mg/dL" # Default unit
+            extracted_data[key] = {"value": float(match.group("sugar_value")), "unit": unit}
+        elif key == "oxygen_saturation":
+            extracted_data[key] = {"value": int(match.group("spo2_value")), "unit": "%"}
+        elif key == "weight_kg":
+            value = float(match.group("weight_value"))
+            unit_str = match.group("weight_unit").lower()
+            if "lb" in unit_str or "pound" in unit_str:
+                value = round(value * 0.453592, 1) # Convert lbs to kg
+            extracted_data[key] = {"value": value, "unit": "kg"}
+        elif key == "height_cm":
+            if match.group("height_cm_value"):
+                cm_value = float(match.group("height_cm_value"))
+            elif match.group("height_m_value"):
+                cm_value = round(float(match.group("height_m_value")) * 100, 1)
+            else:
+                feet = int(match.group("height_feet"))
+                inches = int(match.group("height_inches")) if match.group("height_inches") else 0
+                cm_value = round(((feet * 12) + inches) * 2.54, 1)
+            extracted_data[key] = {"value": cm_value, "unit": "cm"}
+        elif key == "age":
+            extracted_data[key] = int(match.group("age_value") or match.group("age_value_i"))
 
-    # Emergency Keywords (Weighted) - More aggressive check
-    emergency_keywords = {
-        "chest pain": 10, "severe pain": 8, "cannot breathe": 10, "can't breathe": 10,
-        "difficulty breathing": 9, "shortness of breath": 8, "stroke symptoms": 10,
-        "sudden weakness": 9, "sudden numbness": 9, "facial droop": 10, "slurred speech": 9,
-        "severe bleeding": 9, "uncontrolled bleeding": 10, "loss of consciousness": 10,
-        "unconscious": 10, "unresponsive": 10, "seizure": 9, "collapse": 8,
-        "head injury": 8, "major trauma": 8, "overdose": 9, "poisoning": 8,
-        "suicidal": 10, "want to die": 10, "kill myself": 10,
-        "allergic reaction severe": 8, "anaphylaxis": 10,
-        "emergency": 5 # Lower weight for just the word
-    }
-    emergency_score = 0
-    for keyword, score in emergency_keywords.items():
-        if keyword in message_lower:
-            logging.warning(f"Emergency keyword detected: '{keyword}'")
-            emergency_score += score
-
-    if emergency_score >= 9: # Adjusted threshold
-        is_emergency = True
-        logging.warning(f"Potential emergency detected! Score: {emergency_score}")
-
-
-    # Regex for Data Extraction (using re.IGNORECASE)
-    # Blood Pressure: "bp 120/80", "blood pressure is 120 / 75"
-    bp_match = re.search(r'(?:blood pressure|bp)\s*(?:is|was|:|)\s*(\d{2,3})\s*/\s*(\d{2,3})', message_lower, re.IGNORECASE)
-    if bp_match:
-        extracted_data["blood_pressure"] = f"{bp_match.group(1)}/{bp_match.group(2)}"
-
-    # Temperature: "temp 98.6 F", "temperature 37 C"
-    temp_match = re.search(r'(?:temperature|temp)\s*(?:is|was|:|)\s*(\d{2,3}(?:\.\d)?)\s*(?:°|degrees)?\s*([CF])?', message_lower, re.IGNORECASE)
-    if temp_match:
-        value = float(temp_match.group(1))
-        unit = temp_match.group(2).upper() if temp_match.group(2) else None
-        # Basic unit inference if not provided
-        if not unit:
-             unit = "°F" if value > 50 else "°C"
-        elif unit == 'F': unit = "°F"
-        elif unit == 'C': unit = "°C"
-        extracted_data["temperature"] = {"value": value, "unit": unit}
-
-    # Heart Rate: "hr 70 bpm", "pulse is 65"
-    hr_match = re.search(r'(?:heart rate|hr|pulse)\s*(?:is|was|:|)\s*(\d{2,3})\s*(bpm)?', message_lower, re.IGNORECASE)
-    if hr_match:
-        extracted_data["heart_rate"] = {"value": int(hr_match.group(1)), "unit": "bpm"}
-
-    # Blood Sugar: "sugar 100 mg/dl", "glucose 5.5 mmol/l"
-    sugar_match = re.search(r'(?:blood sugar|glucose|sugar level)\s*(?:is|was|:|)\s*(\d{1,3}(?:\.\d)?)\s*(mg/dl|mmol/l)?', message_lower, re.IGNORECASE)
-    if sugar_match:
-        unit = sugar_match.group(2) if sugar_match.group(2) else "mg/dL" # Default unit
-        extracted_data["blood_sugar"] = {"value": float(sugar_match.group(1)), "unit": unit}
-
-    # SpO2: "spo2 98%", "oxygen saturation 97"
-    spo2_match = re.search(r'(?:spo2|oxygen saturation|o2 sat)\s*(?:is|was|:|)\s*(\d{2,3})\s*(%)?', message_lower, re.IGNORECASE)
-    if spo2_match:
-         extracted_data["oxygen_saturation"] = {"value": int(spo2_match.group(1)), "unit": "%"}
-
-    # Weight: "weight 70 kg", "weigh 150 lbs"
-    weight_match = re.search(r'(?:weight|weighs|weigh)\s*(?:is|was|:|)\s*(\d{2,4}(?:\.\d)?)\s*(kg|kilos|kilograms|lb|lbs|pounds)', message_lower, re.IGNORECASE)
-    if weight_match:
-        value = float(weight_match.group(1))
-        unit_str = weight_match.group(2).lower()
-        unit = "kg"
-        if "lb" in unit_str or "pound" in unit_str:
-            value = round(value * 0.453592, 1) # Convert lbs to kg
-        extracted_data["weight_kg"] = {"value": value, "unit": "kg"}
-
-    # Height: "height 175 cm", "tall 5 ft 10 in", "height 6'1\""
-    # Simpler cm/m pattern first
-    height_cm_match = re.search(r'(?:height|tall)\s*(?:is|was|:|)\s*(\d{2,3}(?:\.\d)?)\s*(cm|centimeters)', message_lower, re.IGNORECASE)
-    height_m_match = re.search(r'(?:height|tall)\s*(?:is|was|:|)\s*(\d(?:\.\d{1,2})?)\s*(m|meters)', message_lower, re.IGNORECASE)
-    # Feet/inches patterns (more complex)
-    height_ft_in_match = re.search(r'(?:height|tall)\s*(?:is|was|:|)\s*(\d+)\s*(?:ft|feet|\')(?:\s*(\d{1,2})\s*(?:in|inches|"))?', message_lower, re.IGNORECASE)
-
-    if height_cm_match:
-        extracted_data["height_cm"] = {"value": float(height_cm_match.group(1)), "unit": "cm"}
-    elif height_m_match:
-        value_m = float(height_m_match.group(1))
-        extracted_data["height_cm"] = {"value": round(value_m * 100, 1), "unit": "cm"}
-    elif height_ft_in_match:
-        feet = int(height_ft_in_match.group(1))
-        inches = int(height_ft_in_match.group(2)) if height_ft_in_match.group(2) else 0
-        total_inches = (feet * 12) + inches
-        cm_value = round(total_inches * 2.54, 1)
-        extracted_data["height_cm"] = {"value": cm_value, "unit": "cm"}
-
-
-    # Age: "age 30", "I am 25 years old"
-    age_match = re.search(r'\b(age|aged)\s*(\d{1,3})\b|\bI(?: am|\'m)\s*(\d{1,3})\s*(?:years? old)?\b', message_lower, re.IGNORECASE)
-    if age_match:
-        # Group 2 is for "age XX", Group 3 is for "I am XX"
-        age_val = age_match.group(2) or age_match.group(3)
-        extracted_data["age"] = int(age_val)
-
-    if extracted_data:
-        logging.info(f"Pre-processed extracted data: {extracted_data}")
-
-    # Return original message, emergency flag, and extracted data
-    return message, is_emergency, extracted_data
-
-
-def identify_potential_conditions(message, symptom_db=COMMON_SYMPTOMS):
-    """Identifies potential conditions based on keywords matching symptoms."""
-    message_lower = message.lower()
-    potential_conditions = []
-    reported_symptoms = set() # Use a set to avoid duplicates initially
+    return extracted_data
+
+
+class SymptomIndex:
+    """
+    Precomputed view of a symptom database: an inverted symptom -> conditions
+    index, inverse-frequency specificity weights, and a single-pass phrase
+    matcher over all known symptoms. Symptoms are keyed in lowercase.
+    """
+    def __init__(self, symptom_db):
+        self.symptom_conditions = {} # e.g., {"fever": ["Influenza (Flu)", "COVID-19"]}
+        self.symptom_names = {} # Lowercase key -> symptom as spelled in the database
+        self.condition_symptom_counts = {}
+        self.condition_order = {} # Database position, keeps ties in database order
+        for condition, condition_data in symptom_db.items():
+            self.condition_order[condition] = len(self.condition_order)
+            condition_symptoms = condition_data.get("symptoms", [])
+            self.condition_symptom_counts[condition] = len(set(condition_symptoms))
+            for symptom in condition_symptoms:
+                key = symptom.lower()
+                self.symptom_names.setdefault(key, symptom)
+                conditions = self.symptom_conditions.setdefault(key, [])
+                if condition not in conditions:
+                    conditions.append(condition)
+
+        # Specificity is inverse frequency: symptoms shared by many conditions say less
+        self.specificity = {key: 1.0 / (len(conditions) + 1) for key, conditions in self.symptom_conditions.items()}
+        self.matcher = KeywordAutomaton(self.symptom_conditions.keys())
+
+    def find_symptom_mentions(self, message_lower):
+        """Returns (start, end, symptom) for every whole-word symptom mention in a lowercased message."""
+        mentions = []
+        for start, end, key in self.matcher.iter_matches(message_lower):
+            # Word boundaries on both sides, like r'\b' + symptom + r'\b'
+            if start > 0 and (message_lower[start - 1].isalnum() or message_lower[start - 1] == "_"):
+                continue
+            if end < len(message_lower) and (message_lower[end].isalnum() or message_lower[end] == "_"):
+                continue
+            mentions.append((start, end, self.symptom_names[key]))
+        return mentions
+
+
+# Built lazily per symptom database; see get_symptom_index
+symptom_index_cache = {}
+
+def get_symptom_index(symptom_db=COMMON_SYMPTOMS):
+    """
+    Returns the SymptomIndex for a symptom database, building it on first use.
+    The index is rebuilt when conditions are added or removed; call
+    invalidate_symptom_index after editing an existing condition's symptoms in place.
+    """
+    cached = symptom_index_cache.get(id(symptom_db))
+    if cached is None or cached[0] is not symptom_db or cached[1] != len(symptom_db):
+        index = SymptomIndex(symptom_db)
+        symptom_index_cache[id(symptom_db)] = (symptom_db, len(symptom_db), index)
+        logging.info(f"Built symptom index: {len(index.symptom_conditions)} symptoms across {len(symptom_db)} conditions")
+        return index
+    return cached[2]
+
+def invalidate_symptom_index(symptom_db=None):
+    """Drops cached symptom indexes (all of them, or the one for `symptom_db`)."""
+    if symptom_db is None:
+        symptom_index_cache.clear()
+    else:
+        symptom_index_cache.pop(id(symptom_db), None)
 
-    # 1. Find all mentioned symptoms from our known list
-    all_known_symptoms = set()
-    for condition_data in symptom_db.values():
-        all_known_symptoms.update(condition_data.get("symptoms", []))
 
-    for known_symptom in all_known_symptoms:
-        # Use word boundaries for more specific matching
-        if re.search(r'\b' + re.escape(known_symptom) + r'\b', message_lower, re.IGNORECASE):
-            reported_symptoms.add(known_symptom)
+def identify_potential_conditions(message, symptom_db=COMMON_SYMPTOMS, symptom_mentions=None):
+    """
+    Identifies potential conditions based on keywords matching symptoms.
+    `symptom_mentions` (from SymptomIndex.find_symptom_mentions) skips rescanning the message.
+    """
+    index = get_symptom_index(symptom_db)
+    potential_conditions = []
 
+    # 1. Find all mentioned symptoms from our known list in one pass
+    if symptom_mentions is None:
+        symptom_mentions = index.find_symptom_mentions(message.lower())
+    reported_symptoms = list(dict.fromkeys(symptom for _, _, symptom in symptom_mentions))
     if not reported_symptoms:
         return [], [] # No relevant symptoms found
 
-    # 2. Match reported symptoms to conditions
-    for condition, condition_data in symptom_db.items():
-        condition_symptoms = set(condition_data.get("symptoms", []))
-        matched_symptoms = list(reported_symptoms.intersection(condition_symptoms))
-
-        if matched_symptoms:
-            match_percentage = (len(matched_symptoms) / len(condition_symptoms)) * 100 if condition_symptoms else 0
-            specificity_score = calculate_symptom_specificity(matched_symptoms, symptom_db)
-
-            potential_conditions.append({
-                "condition": condition,
-                "matched_symptoms": matched_symptoms,
-                "match_percentage": round(match_percentage, 1),
-                "specificity_score": round(specificity_score, 3),
-                "severity_info": condition_data.get("severity", "N/A"), # Use a different key than symptom severity
-                "when_to_see_doctor": condition_data.get("when_to_see_doctor", []),
-                "self_care": condition_data.get("self_care", [])
-            })
+    # 2. Match reported symptoms to conditions through the inverted index
+    matched_by_condition = {}
+    for symptom in reported_symptoms:
+        for condition in index.symptom_conditions[symptom.lower()]:
+            matched_by_condition.setdefault(condition, []).append(symptom)
+
+    for condition in sorted(matched_by_condition, key=index.condition_order.__getitem__):
+        matched_symptoms = matched_by_condition[condition]
+        condition_data = symptom_db[condition]
+        condition_symptom_count = index.condition_symptom_counts[condition]
+        match_percentage = (len(matched_symptoms) / condition_symptom_count) * 100 if condition_symptom_count else 0
+        specificity_score = calculate_symptom_specificity(matched_symptoms, symptom_db)
+
+        potential_conditions.append({
+            "condition": condition,
+            "matched_symptoms": matched_symptoms,
+            "match_percentage": round(match_percentage, 1),
+            "specificity_score": round(specificity_score, 3),
+            "severity_info": condition_data.get("severity", "N/A"), # Use a different key than symptom severity
+            "when_to_see_doctor": condition_data.get("when_to_see_doctor", []),
+            "self_care": condition_data.get("self_care", [])
+        })
 
     # Sort by match percentage primarily, then specificity
     potential_conditions.sort(key=lambda x: (x["match_percentage"], x["specificity_score"]), reverse=True)
 
-    logging.info(f"Identified reported symptoms: {list(reported_symptoms)}")
+    logging.info(f"Identified reported symptoms: {reported_symptoms}")
     logging.info(f"Potential conditions identified: {[pc['condition'] for pc in potential_conditions[:3]]}") # Log top 3
 
-    return potential_conditions, list(reported_symptoms)
+    return potential_conditions, reported_symptoms
 
 
 def calculate_symptom_specificity(symptoms, condition_db):
     """Calculates average specificity score for a list of symptoms."""
     if not symptoms: return 0
-    total_specificity = 0
-    num_symptoms = len(symptoms)
-
-    for symptom in symptoms:
-        symptom_lower = symptom.lower()
-        # Count how many conditions list this symptom (case-insensitive)
-        count = sum(1 for data in condition_db.values()
-                   if symptom_lower in [s.lower() for s in data.get("symptoms", [])])
-        # Specificity is inverse frequency (add 1 to avoid division by zero and give non-listed symptoms zero score)
-        total_specificity += 1.0 / (count + 1) if count > 0 else 0
-
-    return total_specificity / num_symptoms if num_symptoms > 0 else 0
+    specificity = get_symptom_index(condition_db).specificity
+    # Symptoms not listed by any condition score zero
+    return sum(specificity.get(symptom.lower(), 0) for symptom in symptoms) / len(symptoms)
 
 
 def suggest_health_resources(message, reported_symptoms=None, resource_db=RELIABLE_HEALTH_RESOURCES):
@@ -1322,14 +2977,130 @@ def suggest_health_resources(message, reported_symptoms=None, resource_db=RELIAB
     return output_resources
 
 
-def extract_health_data(session: UserSession, message, pre_extracted_data=None):
-    """Extracts health data from message using regex and updates session."""
+SYMPTOM_SEVERITY_KEYWORDS = {
+    "severe": ["severe", "intense", "unbearable", "worst", "bad", "terrible"],
+    "mild": ["mild", "slight", "minor", "a little", "bit of a"],
+    "moderate": ["moderate", "noticeable", "significant"] # Default if not specified
+}
+
+# Every severity keyword as a whole word; the lookahead makes finditer report overlapping hits too
+SEVERITY_MODIFIER_PATTERN = re.compile(
+    r"(?=\b(" + "|".join(re.escape(k) for keywords in SYMPTOM_SEVERITY_KEYWORDS.values() for k in keywords) + r")\b)"
+)
+SEVERITY_KEYWORD_LEVELS = {k: level for level, keywords in SYMPTOM_SEVERITY_KEYWORDS.items() for k in keywords}
+SEVERITY_LEVEL_PRIORITY = {level: i for i, level in enumerate(SYMPTOM_SEVERITY_KEYWORDS)} # severe, then mild, then moderate
+SEVERITY_LINKING_VERB = re.compile(r"\s+(?:is|was)\s+")
+
+def detect_symptom_severities(message_lower, symptom_mentions):
+    """
+    Returns {symptom: severity} for every mentioned symptom ("moderate" by default).
+
+    Severity keywords are located in one scan of the message and resolved
+    against each symptom span (from SymptomIndex.find_symptom_mentions) when
+    adjacent: "<keyword> <symptom>", "<symptom> <keyword>" or
+    "<symptom> is/was <keyword>". If several levels apply, severe wins over mild over moderate.
+    """
+    modifiers_by_start = {}
+    modifiers_by_end = {}
+    for match in SEVERITY_MODIFIER_PATTERN.finditer(message_lower):
+        level = SEVERITY_KEYWORD_LEVELS[match.group(1)]
+        modifiers_by_start.setdefault(match.start(1), []).append(level)
+        modifiers_by_end.setdefault(match.end(1), []).append(level)
+
+    text_length = len(message_lower)
+    symptom_severities = {}
+    for start, end, symptom in symptom_mentions:
+        levels = []
+        if modifiers_by_start or modifiers_by_end:
+            # "<keyword> <symptom>"
+            before = start
+            while before > 0 and message_lower[before - 1].isspace():
+                before -= 1
+            if before < start:
+                levels.extend(modifiers_by_end.get(before, ()))
+            # "<symptom> <keyword>"
+            after = end
+            while after < text_length and message_lower[after].isspace():
+                after += 1
+            if after > end:
+                levels.extend(modifiers_by_start.get(after, ()))
+            # "<symptom> is/was <keyword>"
+            linking_verb = SEVERITY_LINKING_VERB.match(message_lower, end)
+            if linking_verb:
+                levels.extend(modifiers_by_start.get(linking_verb.end(), ()))
+
+        current = symptom_severities.get(symptom)
+        for level in levels:
+            if current is None or SEVERITY_LEVEL_PRIORITY[level] < SEVERITY_LEVEL_PRIORITY[current]:
+                current = level
+        if current is not None:
+            logging.debug(f"Found severity '{current}' for symptom '{symptom}'")
+        symptom_severities[symptom] = current
+
+    return {symptom: severity or "moderate" for symptom, severity in symptom_severities.items()}
+
+
+class MessageAnalysis:
+    """
+    Everything derived from one user message, computed once per chat turn and
+    shared by data extraction, response formatting and analytics so no stage
+    has to rescan the text.
+    """
+    def __init__(self, message, symptom_db=COMMON_SYMPTOMS):
+        self.message = message
+        self.message_lower = message.lower()
+
+        self.emergency_score, self.emergency_keywords = score_emergency_keywords(message)
+        self.is_emergency = self.emergency_score >= EMERGENCY_SCORE_THRESHOLD
+        if self.is_emergency:
+            logging.warning(f"Potential emergency detected! Score: {self.emergency_score}")
+
+        self.vital_signs = extract_vital_signs(message) # {vital_type: {"value", "unit"}}, as extract_health_data expects
+        if self.vital_signs:
+            logging.info(f"Pre-processed extracted data: {self.vital_signs}")
+
+        self.symptom_mentions = get_symptom_index(symptom_db).find_symptom_mentions(self.message_lower)
+        self.potential_conditions, self.reported_symptoms = identify_potential_conditions(
+            message, symptom_db, symptom_mentions=self.symptom_mentions
+        )
+        self.symptom_severities = detect_symptom_severities(self.message_lower, self.symptom_mentions)
+        self.topics = extract_health_topics(message)
+
+
+ACTIVITY_KEYWORDS = {
+    "exercise": ["exercise", "workout", "gym", "run", "ran", "walked", "swam", "cycled", "lifted weights", "yoga", "pilates"],
+    "meditation": ["meditate", "meditation", "mindfulness"],
+    "healthy eating": ["healthy meal", "ate well", "balanced diet", "vegetables", "fruits", "lean protein"],
+    "sleep": ["slept well", "good sleep", "hours of sleep"], # Could extract hours later
+    "social": ["saw friends", "family time", "social event"],
+    "hobby": ["hobby", "leisure activity", "relaxed", "read book"]
+}
+# One precompiled alternation per activity type instead of a search per keyword
+ACTIVITY_PATTERNS = {
+    activity_type: re.compile(r'\b(?:' + '|'.join(re.escape(k) for k in keywords) + r')\b', re.IGNORECASE)
+    for activity_type, keywords in ACTIVITY_KEYWORDS.items()
+}
+
+def extract_health_data(session: UserSession, message, pre_extracted_data=None, analysis=None, source=None):
+    """
+    Extracts health data from message using regex and updates session.
+    When the turn's MessageAnalysis is passed, its vitals, symptoms and severities are reused.
+    `source` marks text that doesn't come from the chat (e.g. "document"): its vitals and profile
+    numbers go to UserSession.add_document_reading and its symptoms are logged with the source.
+    """
     if not session: return False
     data_updated = False
-    message_lower = message.lower()
+    message_lower = analysis.message_lower if analysis is not None else message.lower()
+    if analysis is not None and pre_extracted_data is None:
+        pre_extracted_data = analysis.vital_signs
 
-    # 1. Use pre-extracted data first (from preprocess_health_query)
-    if pre_extracted_data:
+    # 1. Use pre-extracted data first (MessageAnalysis.vital_signs or extract_vital_signs)
+    if pre_extracted_data and source is not None:
+        for key, data in pre_extracted_data.items():
+            value, unit = (data.get('value'), data.get('unit', "")) if isinstance(data, dict) else (data, "mmHg" if key == "blood_pressure" else "")
+            session.add_document_reading(key, value, unit, source)
+            data_updated = True
+    elif pre_extracted_data:
         for key, data in pre_extracted_data.items():
             if isinstance(data, dict) and 'value' in data and 'unit' in data:
                 # Handle vitals with units
@@ -1400,64 +3171,46 @@ def extract_health_data(session: UserSession, message, pre_extracted_data=None):
                  logging.info(f"Extracted medication: {med_name}, Dosage: {dosage}, Schedule: {schedule}")
 
 
-    # Symptoms (Extract severity if possible)
-    potential_conditions, reported_symptoms = identify_potential_conditions(message)
-    if reported_symptoms:
-         severity_map = {
-             "severe": ["severe", "intense", "unbearable", "worst", "bad", "terrible"],
-             "mild": ["mild", "slight", "minor", "a little", "bit of a"],
-             "moderate": ["moderate", "noticeable", "significant"] # Default if not specified
-         }
-         extracted_symptoms_this_message = set()
-         for symptom in reported_symptoms:
-             if symptom in extracted_symptoms_this_message: continue
-
-             symptom_severity = "moderate" # Default
-             # Search for severity keywords near the symptom word
-             for sev_level, keywords in severity_map.items():
-                 for keyword in keywords:
-                     # Pattern: keyword symptom OR symptom keyword OR symptom is/was keyword
-                     pattern = rf'\b({keyword})\s+({re.escape(symptom)})\b|\b({re.escape(symptom)})\s+({keyword})\b|\b({re.escape(symptom)})\s+(?:is|was)\s+({keyword})\b'
-                     sev_match = re.search(pattern, message_lower, re.IGNORECASE)
-                     if sev_match:
-                         symptom_severity = sev_level
-                         logging.debug(f"Found severity '{sev_level}' for symptom '{symptom}'")
-                         break # Found severity for this symptom
-                 if symptom_severity != "moderate": break # Stop searching severity levels
-
-             # Log the symptom with extracted/default severity
-             session.log_symptom(symptom, symptom_severity)
-             extracted_symptoms_this_message.add(symptom)
-             data_updated = True
+    # Symptoms (with severity when the message states one)
+    if analysis is None:
+        symptom_mentions = get_symptom_index().find_symptom_mentions(message_lower)
+        _, reported_symptoms = identify_potential_conditions(message, symptom_mentions=symptom_mentions)
+        symptom_severities = detect_symptom_severities(message_lower, symptom_mentions)
+    else:
+        reported_symptoms, symptom_severities = analysis.reported_symptoms, analysis.symptom_severities
+    for symptom in reported_symptoms:
+        # Log the symptom with extracted/default severity
+        session.log_symptom(symptom, symptom_severities.get(symptom, "moderate"), source=source)
+        data_updated = True
 
 
     # Wellness Activities (Simplified)
-    activity_keywords = {
-        "exercise": ["exercise", "workout", "gym", "run", "ran", "walked", "swam", "cycled", "lifted weights", "yoga", "pilates"],
-        "meditation": ["meditate", "meditation", "mindfulness"],
-        "healthy eating": ["healthy meal", "ate well", "balanced diet", "vegetables", "fruits", "lean protein"],
-        "sleep": ["slept well", "good sleep", "hours of sleep"], # Could extract hours later
-        "social": ["saw friends", "family time", "social event"],
-        "hobby": ["hobby", "leisure activity", "relaxed", "read book"]
-    }
-    for activity_type, keywords in activity_keywords.items():
-        if any(re.search(r'\b' + keyword + r'\b', message_lower, re.IGNORECASE) for keyword in keywords):
+    for activity_type, pattern in ACTIVITY_PATTERNS.items():
+        if pattern.search(message_lower):
              # Avoid logging duplicates rapidly
-             recent_activity_timestamps = [
-                 datetime.strptime(a['timestamp'], "%Y-%m-%d %H:%M:%S")
-                 for a in session.wellness_activities
-                 if a['activity_type'] == activity_type
-             ]
-             now = datetime.now()
-             if not any((now - ts).total_seconds() < 3600 for ts in recent_activity_timestamps): # Don't log same activity type within an hour
+             last_logged = session.recent_activities[7].last_timestamp(activity_type)
+             if last_logged is None or time.time() - last_logged >= 3600: # Don't log same activity type within an hour
                 session.add_wellness_activity(activity_type)
                 data_updated = True
 
 
     return data_updated
 
-def format_health_response(session: UserSession, bot_response, user_message, is_emergency, health_data_extracted, detected_health_data):
-    """Formats the bot response with contextual health info, warnings, and resources."""
+EMERGENCY_BANNER_HTML = (
+    '<div class="emergency-banner">'
+    '<span class="emergency-icon">⚠️</span>'
+    '<strong>MEDICAL EMERGENCY POSSIBLE:</strong> Based on your message, '
+    'this could be a serious medical situation. '
+    '<strong>Please seek immediate medical attention. Call 911 (or your local emergency number) '
+    'or go to the nearest emergency room.</strong> Do not rely on this chat for emergency help.'
+    '</div>'
+)
+
+def format_health_response(session: UserSession, bot_response, user_message, is_emergency, health_data_extracted, detected_health_data, analysis=None):
+    """
+    Formats the bot response with contextual health info, warnings, and resources.
+    Pass the turn's MessageAnalysis to reuse its symptom and topic results.
+    """
     if not session:
         return bot_response # Should not happen if session is managed properly
 
@@ -1465,16 +3218,7 @@ def format_health_response(session: UserSession, bot_response, user_message, is_
 
     # 1. Emergency Banner (Highest Priority)
     if is_emergency:
-        emergency_warning = (
-            '<div class="emergency-banner">'
-            '<span class="emergency-icon">⚠️</span>'
-            '<strong>MEDICAL EMERGENCY POSSIBLE:</strong> Based on your message, '
-            'this could be a serious medical situation. '
-            '<strong>Please seek immediate medical attention. Call 911 (or your local emergency number) '
-            'or go to the nearest emergency room.</strong> Do not rely on this chat for emergency help.'
-            '</div>'
-        )
-        formatted_response_parts.append(emergency_warning)
+        formatted_response_parts.append(EMERGENCY_BANNER_HTML)
         # Add the original bot response *after* the critical warning
         formatted_response_parts.append(f"<p><strong>AI Assistant:</strong> {bot_response}</p>")
         # Stop further formatting if it's a clear emergency to avoid distraction
@@ -1506,7 +3250,10 @@ def format_health_response(session: UserSession, bot_response, user_message, is_
 
 
     # 4. Symptom Analysis Section
-    potential_conditions, reported_symptoms = identify_potential_conditions(user_message)
+    if analysis is not None:
+        potential_conditions, reported_symptoms = analysis.potential_conditions, analysis.reported_symptoms
+    else:
+        potential_conditions, reported_symptoms = identify_potential_conditions(user_message)
     if reported_symptoms:
         symptom_section = '<div class="vital-card"><div class="vital-title">Symptom Analysis (Informational Only)</div>'
         symptom_section += '<div><strong>Reported Symptoms:</strong> '
@@ -1543,7 +3290,7 @@ def format_health_response(session: UserSession, bot_response, user_message, is_
         try:
             # Try to select a category relevant to the conversation or profile
             relevant_category = None
-            topics = extract_health_topics(user_message)
+            topics = analysis.topics if analysis is not None else extract_health_topics(user_message)
             if topics:
                 topic_to_category = {"nutrition": "Nutrition", "exercise": "Physical Activity", "sleep": "Sleep", "mental_health": "Mental Wellbeing"}
                 for topic in topics:
@@ -1597,137 +3344,600 @@ def format_health_response(session: UserSession, bot_response, user_message, is_
     return "".join(formatted_response_parts)
 
 
-# --- Main Chatbot Logic ---
+# --- LLM Context Assembly ---
 
-def health_chatbot(message: str, history: list, user_id: str = "default_user"):
-    """Handles user message, interacts with LLM, formats response, updates session."""
-    logging.info(f"Received message from user {user_id}: '{message[:50]}...'")
+def estimate_tokens(text):
+    """Roughly estimates the token count of a text (~4 characters per token)."""
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+def strip_html(text):
+    """Removes HTML tags and collapses whitespace (for legacy bot messages without raw text)."""
+    return re.sub(r'\s+', ' ', re.sub(r'<[^>]+>', ' ', text or "")).strip()
 
-    if model is None and GOOGLE_API_KEY == "YOUR_API_KEY_HERE":
-         return "API Key not configured. Please set the GOOGLE_API_KEY environment variable."
-    elif model is None:
-         return "Chatbot model is not available due to configuration error. Please check logs."
+def build_profile_summary(session: UserSession):
+    """Returns a one-line summary of the user's profile for the LLM, or None if empty."""
+    profile_items = []
+    if session.user_profile["age"]: profile_items.append(f"Age: {session.user_profile['age']}")
+    if session.user_profile["gender"]: profile_items.append(f"Gender: {session.user_profile['gender']}")
+    if session.user_profile["chronic_conditions"]: profile_items.append(f"Conditions: {', '.join(session.user_profile['chronic_conditions'])}")
+    if session.user_profile["allergies"]: profile_items.append(f"Allergies: {', '.join(session.user_profile['allergies'])}")
+    if not profile_items:
+        return None
+    return "User Context: " + ". ".join(profile_items) + "."
+
+def get_llm_text(item):
+    """Returns the text of a history entry as it should be sent to the LLM."""
+    if item["role"] == "bot":
+        # Send the raw model text, not the HTML built by format_health_response
+        return item.get("raw_message") or strip_html(item["message"])
+    return item["message"]
+
+def summarize_dropped_turns(messages, max_tokens=CONTEXT_SUMMARY_TOKENS):
+    """Builds a short extractive summary of older turns that were dropped from the context."""
+    user_messages = [m["message"] for m in messages if m["role"] == "user"]
+    if not user_messages:
+        return None
 
+    topics = set()
+    for text in user_messages:
+        topics.update(extract_health_topics(text))
+
+    summary = f"Summary of earlier conversation ({len(messages)} older messages omitted)."
+    if topics:
+        summary += " Topics discussed: " + ", ".join(sorted(topics)).replace('_', ' ') + "."
+    # Most recent dropped questions first, they are the most likely to be referenced
+    questions = [f'"{text[:80]}"' for text in reversed(user_messages[-3:])]
+    summary += " Earlier user messages included: " + "; ".join(questions) + "."
+
+    max_chars = max_tokens * 4
+    if len(summary) > max_chars:
+        summary = summary[:max_chars - 3] + "..."
+    return summary
+
+def build_llm_context(session: UserSession, token_budget=None, max_messages=None):
+    """
+    Assembles the Gemini `contents` list for the latest user message within a token budget.
 
+    The system prompt and profile summary are prepended once, history is walked
+    newest-first until the budget or message limit is reached, and dropped turns
+    are replaced by a short summary. Returns (contents, prompt_stats); the stats
+    record whether profile or history context went into the prompt.
+    """
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    max_messages = CONTEXT_MAX_MESSAGES if max_messages is None else max_messages
+    history = session.conversation_history
+    if not history:
+        return [], {"prompt_tokens": 0, "messages_included": 0, "messages_dropped": 0, "summarized": False, "token_budget": token_budget,
+                    "profile_used": False, "history_used": False}
+
+    preamble_parts = [SYSTEM_PROMPT.strip()]
+    profile_summary = build_profile_summary(session)
+    if profile_summary:
+        preamble_parts.append(profile_summary)
+
+    current_text = get_llm_text(history[-1]) # Latest user message, always included
+    remaining = token_budget - sum(estimate_tokens(p) for p in preamble_parts) - estimate_tokens(current_text)
+
+    older = history[:-1]
+    if older:
+        remaining -= CONTEXT_SUMMARY_TOKENS # Reserve room in case older turns have to be summarized
+
+    selected = []
+    for item in reversed(older):
+        if len(selected) >= max_messages:
+            break
+        cost = estimate_tokens(get_llm_text(item))
+        if cost > remaining:
+            break
+        selected.append(item)
+        remaining -= cost
+    selected.reverse()
+
+    # Don't start the kept window on a bot reply whose question was dropped
+    while selected and selected[0]["role"] == "bot":
+        selected.pop(0)
+
+    dropped = older[:len(older) - len(selected)]
+    summary = summarize_dropped_turns(dropped) if dropped else None
+    if summary:
+        preamble_parts.append(summary)
+
+    contents = []
+    def append_turn(role, text):
+        # Gemini expects alternating roles, so consecutive same-role turns are merged
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"][0] += "\n\n" + text
+        else:
+            contents.append({"role": role, "parts": [text]})
+
+    append_turn("user", "\n\n".join(preamble_parts))
+    for item in selected:
+        append_turn("model" if item["role"] == "bot" else "user", get_llm_text(item))
+    append_turn("user", current_text)
+
+    prompt_stats = {
+        "prompt_tokens": sum(estimate_tokens(c["parts"][0]) for c in contents),
+        "messages_included": len(selected) + 1,
+        "messages_dropped": len(dropped),
+        "summarized": summary is not None,
+        "token_budget": token_budget,
+        "profile_used": profile_summary is not None,
+        "history_used": bool(selected) or summary is not None # False means the reply depends on the message alone
+    }
+    return contents, prompt_stats
+
+
+# --- Response Cache ---
+
+class ResponseCache:
+    """
+    LRU + TTL cache of model replies to context-free turns, keyed on the
+    normalized message text and whether profile/history context was used.
+    Only context-free lookups are served or stored, so a reply never leaks
+    from one user's context into another's. With `path`, entries are also
+    written to a SQLite file (WAL mode) and survive restarts. Disk writes go
+    through a single background writer thread and disk reads don't hold the
+    memory lock; the async chat path does its lookups in a worker thread.
+    """
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL, path=RESPONSE_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (response, expires_at)
+        self.lock = threading.Lock() # Sync and async chat paths share the cache
+        self.db_lock = threading.Lock()
+        self.writer = None
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0, "expirations": 0}
+        # Entries are only valid for the prompt they were generated with
+        self.namespace = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()[:16]
+        self.conn = None
+        if path and max_entries > 0:
+            try:
+                self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                  "key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)")
+                self.conn.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+                self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+                logging.info(f"Response cache backed by {path}")
+            except sqlite3.Error as e:
+                logging.error(f"Could not open response cache database {path}: {e}. Caching in memory only.")
+                self.conn = None
+
+    @staticmethod
+    def normalize(message):
+        """Lowercases, collapses whitespace and drops trailing punctuation: "Tips to improve sleep?" == "tips to improve sleep"."""
+        return " ".join(message.lower().split()).rstrip("?!. ")
+
+    def key(self, message, context_used):
+        text = f"{self.namespace}\n{int(bool(context_used))}\n{self.normalize(message)}"
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, message, context_used=False):
+        """Cached reply for the message, or None. Turns that used profile/history context always miss."""
+        if self.max_entries <= 0 or context_used:
+            with self.lock:
+                self.stats["bypassed"] += 1
+            return None
+        key = self.key(message, context_used)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self.entries[key]
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+        row = self.read(key, now) if self.conn is not None else None
+        with self.lock:
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.insert(key, (row[0], row[1]))
+            self.stats["disk_hits"] += 1
+            self.stats["hits"] += 1
+            return row[0]
+
+    def read(self, key, now):
+        with self.db_lock:
+            try:
+                return self.conn.execute("SELECT response, expires_at FROM responses WHERE key = ? AND expires_at > ?",
+                                         (key, now)).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f"Response cache read failed: {e}")
+                return None
+
+    def write(self, key, entry):
+        with self.db_lock:
+            try:
+                self.conn.execute("INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)",
+                                  (key, entry[0], entry[1]))
+            except sqlite3.Error as e:
+                logging.error(f"Response cache write failed: {e}")
+
+    def put(self, message, response, context_used=False):
+        """Stores a complete reply to a context-free turn (other turns are ignored)."""
+        if self.max_entries <= 0 or context_used or not response:
+            return
+        key = self.key(message, context_used)
+        entry = (response, time.time() + self.ttl)
+        with self.lock:
+            self.insert(key, entry)
+            self.stats["stores"] += 1
+        if self.writer is not None:
+            self.writer.submit(self.write, key, entry) # Off the request path; the executor drains at exit
+
+    def close(self):
+        """Waits for pending disk writes."""
+        if self.writer is not None:
+            self.writer.shutdown(wait=True)
+
+    def insert(self, key, entry):
+        """Adds an entry to the in-memory LRU (lock held), evicting the least recently used beyond max_entries."""
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def metrics(self):
+        """Entry count, hit rate over served lookups, and the raw counters."""
+        with self.lock:
+            stats = dict(self.stats)
+            entries = len(self.entries)
+        lookups = stats["hits"] + stats["misses"]
+        return {"entries": entries, "lookups": lookups, "hit_rate": stats["hits"] / lookups if lookups else 0.0, **stats}
+
+response_cache = ResponseCache()
+
+def cached_turn_response(turn):
+    """The cached reply for a context-free, non-emergency turn, or None."""
+    if turn["is_emergency"]:
+        return None # Always answered fresh
+    response = response_cache.get(turn["processed_message"], context_used=turn["context_used"])
+    if response is not None:
+        metrics = response_cache.metrics()
+        logging.info(f"Response cache hit for user {turn['user_id']} (hit rate {metrics['hit_rate']:.0%} over {metrics['lookups']} lookups)")
+    return response
+
+async def cached_turn_response_async(turn):
+    """cached_turn_response for the async path: lookups that may read the cache file run in a worker thread."""
+    if response_cache.conn is None:
+        return cached_turn_response(turn)
+    return await asyncio.to_thread(cached_turn_response, turn)
+
+def turn_response_cacher(turn):
+    """on_complete callback that caches the turn's reply, or None if the turn must not be cached."""
+    if turn["is_emergency"] or turn["context_used"]:
+        return None
+    return lambda response: response_cache.put(turn["processed_message"], response, context_used=False)
+
+
+# --- Main Chatbot Logic ---
+
+def get_model_unavailable_message():
+    """Returns the user-facing reason the model can't be called, or None if it is available."""
+    current_model = get_model()
+    if current_model is None and GOOGLE_API_KEY == "YOUR_API_KEY_HERE":
+        return "API Key not configured. Please set the GOOGLE_API_KEY environment variable."
+    elif current_model is None:
+        return "Chatbot model is not available due to configuration error. Please check logs."
+    return None
+
+
+def start_chat_turn(message, user_id, display_turns=None):
+    """
+    First stage of a chat turn: gets the session, preprocesses the message and
+    records it in the history. Returns the turn state shared by later stages.
+    """
     # Get or create user session
     if user_id not in user_sessions:
         user_sessions[user_id] = UserSession(user_id)
         logging.info(f"New session started for user {user_id}")
     session = user_sessions[user_id]
 
-    # Preprocess message for emergencies and initial data extraction
+    # Analyze the message once: emergency check, vitals, symptoms, topics
     try:
-        processed_message, is_emergency, detected_health_data = preprocess_health_query(message)
+        analysis = MessageAnalysis(message)
     except Exception as e:
         logging.error(f"Error during preprocessing for user {user_id}: {e}")
-        # Fallback safely
-        processed_message, is_emergency, detected_health_data = message, False, {}
+        analysis = None # Fall back safely to per-stage extraction
 
     # Add user message to session history (internal)
-    session.add_message("user", processed_message)
+    session.add_message("user", message)
+    user_sessions.mark_dirty(user_id)
+
+    return {
+        "user_id": user_id,
+        "session": session,
+        "processed_message": message,
+        "analysis": analysis,
+        "is_emergency": analysis.is_emergency if analysis is not None else False,
+        "detected_health_data": analysis.vital_signs if analysis is not None else {},
+        "context_used": True, # Whether profile/history went into the prompt; set by build_turn_context
+        "display_turns": display_turns # How many chat turns the UI shows
+    }
+
 
-    # Extract and store health data mentioned in the message
+def run_health_data_extraction(turn):
+    """Extracts and stores health data mentioned in the turn's message. Never raises."""
     try:
-        health_data_extracted = extract_health_data(session, processed_message, detected_health_data)
+        return extract_health_data(turn["session"], turn["processed_message"], turn["detected_health_data"], analysis=turn["analysis"])
     except Exception as e:
-        logging.error(f"Error during health data extraction for user {user_id}: {e}")
-        health_data_extracted = False # Proceed without assuming data extraction worked
+        logging.error(f"Error during health data extraction for user {turn['user_id']}: {e}")
+        return False # Proceed without assuming data extraction worked
+
+
+def build_turn_context(turn):
+    """Builds the token-budgeted LLM context for the turn (noting whether it used profile/history) and logs the prompt size."""
+    session = turn["session"]
+    api_contents, prompt_stats = build_llm_context(session)
+    session.health_analytics["last_prompt_stats"] = prompt_stats
+    turn["context_used"] = prompt_stats["profile_used"] or prompt_stats["history_used"]
+    logging.info(
+        f"LLM prompt for user {turn['user_id']}: ~{prompt_stats['prompt_tokens']} tokens "
+        f"(budget {prompt_stats['token_budget']}), {prompt_stats['messages_included']} messages included, "
+        f"{prompt_stats['messages_dropped']} dropped, summarized={prompt_stats['summarized']}"
+    )
+    return api_contents
 
 
-    # Build context for the LLM
-    context = [
-        # {"role": "system", "content": SYSTEM_PROMPT}, # System prompt often handled differently by genai models
-    ]
-    # Add profile context if available
-    profile_items = []
-    if session.user_profile["age"]: profile_items.append(f"Age: {session.user_profile['age']}")
-    if session.user_profile["gender"]: profile_items.append(f"Gender: {session.user_profile['gender']}")
-    if session.user_profile["chronic_conditions"]: profile_items.append(f"Conditions: {', '.join(session.user_profile['chronic_conditions'])}")
-    if session.user_profile["allergies"]: profile_items.append(f"Allergies: {', '.join(session.user_profile['allergies'])}")
-    if profile_items:
-         profile_summary = "User Context: " + ". ".join(profile_items) + "."
-         # Add as a user message for context, or potentially system if API supports it well
-         context.append({"role": "user", "content": profile_summary})
+def finish_chat_turn(turn, bot_response_text, health_data_extracted):
+    """Last stage of a chat turn: formats the reply, records it and returns the final Gradio history."""
+    session = turn["session"]
+    processed_message = turn["processed_message"]
+
+    # Format the raw text response with additional context once the reply is complete
+    try:
+        formatted_response_html = format_health_response(
+            session, bot_response_text, processed_message, turn["is_emergency"], health_data_extracted, turn["detected_health_data"],
+            analysis=turn["analysis"]
+        )
+    except Exception as e:
+        logging.error(f"Error formatting health response for user {turn['user_id']}: {e}")
+        formatted_response_html = bot_response_text # Fallback to raw text on formatting error
 
 
-    # Add conversation history (last ~5 exchanges) - map roles correctly
-    history_limit = 10 # Number of individual messages (5 pairs)
-    start_index = max(0, len(session.conversation_history) - history_limit)
-    for item in session.conversation_history[start_index:-1]: # Exclude the latest user message already added
-        role = "model" if item["role"] == "bot" else item["role"] # Map 'bot' to 'model'
-        # Simple way to include history, might need more sophisticated context management
-        context.append({"role": role, "content": item["message"]})
+    # Add formatted bot response to session history (internal)
+    session.add_message("bot", formatted_response_html, raw_message=bot_response_text) # HTML for display, raw text for the LLM
+    user_sessions.mark_dirty(session.user_id, session) # Re-attaches the session if it was evicted mid-turn
+
+    # Update analytics
+    topics = turn["analysis"].topics if turn["analysis"] is not None else extract_health_topics(processed_message)
+    session.add_topics(topics)
+    # Calculate score periodically
+    if session.health_analytics["interaction_count"] % 3 == 0:
+         session.record_health_score()
 
+    return visible_chat_history(session, turn["display_turns"]) # Final history for Gradio Chatbot component
 
-    # Add the current processed user message
-    context.append({"role": "user", "content": processed_message})
 
-    # --- Call the Generative AI Model ---
-    bot_response_text = ""
-    try:
-        # Construct the prompt including the system instructions
-        # Gemini API uses generate_content which takes the history directly
-        # The system prompt needs to be integrated, often as the first 'user' or 'model' turn,
-        # or via specific API parameters if available. Let's prepend it simply.
+def health_chatbot(message: str, history: list, user_id: str = "default_user", display_turns: int = None):
+    """
+    Handles user message, interacts with LLM, formats response, updates session.
+    Generator: yields the Gradio chat history, with the partial reply while the model streams.
+    """
+    logging.info(f"Received message from user {user_id}: '{message[:50]}...'")
+
+    unavailable_message = get_model_unavailable_message()
+    if unavailable_message:
+        yield (history or []) + [[message, unavailable_message]]
+        return
+
+    turn = start_chat_turn(message, user_id, display_turns)
+    health_data_extracted = run_health_data_extraction(turn)
+    api_contents = build_turn_context(turn)
+
+    # --- Call the Generative AI Model (streamed) ---
+    # Show the user's message right away, then grow the bot bubble as chunks arrive
+    previous_history = visible_chat_history(turn["session"], display_turns)
+    pending_pair = [turn["processed_message"], render_partial_response("", turn["is_emergency"])]
+    yield previous_history + [pending_pair]
+
+    bot_response_text = cached_turn_response(turn)
+    if bot_response_text is None:
+        bot_response_text = ""
+        for bot_response_text in generate_model_response(api_contents, user_id, on_complete=turn_response_cacher(turn)):
+            pending_pair = [turn["processed_message"], render_partial_response(bot_response_text, turn["is_emergency"])]
+            yield previous_history + [pending_pair]
+
+    yield finish_chat_turn(turn, bot_response_text, health_data_extracted)
+
+
+# --- Async Chat Pipeline ---
+
+class AsyncLLMClient:
+    """Async Gemini client that bounds the number of in-flight model requests with a semaphore."""
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+
+    async def stream_response(self, contents, user_id, stream=None, on_complete=None):
+        """Async counterpart of generate_model_response: yields the accumulated response text."""
+        stream = STREAM_RESPONSES if stream is None else stream
+        async with self._semaphore:
+            self.in_flight += 1
+            accumulator = ResponseAccumulator(user_id, on_complete)
+            try:
+                response = await get_model().generate_content_async(contents, stream=stream)
+                blocked_text = accumulator.check_blocked(response)
+                if blocked_text:
+                    yield blocked_text
+                    return
+                async for chunk in response:
+                    if accumulator.add(chunk):
+                        yield accumulator.text
+                fallback_text = accumulator.finish()
+                if fallback_text:
+                    yield fallback_text
+            except Exception as e:
+                yield accumulator.error_text(e)
+            finally:
+                self.in_flight -= 1
+
+llm_client = AsyncLLMClient()
+
+# One lock per user so a user's turns are processed strictly in order. Weak values: a
+# lock lives only while a turn or upload job holds a reference, so idle users cost nothing
+user_turn_locks = weakref.WeakValueDictionary()
+
+def get_user_turn_lock(user_id):
+    """Returns the asyncio lock serializing chat turns for a user."""
+    lock = user_turn_locks.get(user_id)
+    if lock is None:
+        lock = user_turn_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+async def health_chatbot_async(message: str, history: list, user_id: str = "default_user", display_turns: int = None):
+    """
+    Asyncio-native version of health_chatbot used by the Gradio UI.
 
-        # Prepending system prompt as a user message instructing the bot
-        # Note: The effectiveness of this depends on the model's training.
-        # Sometimes it's better placed differently or using API-specific features.
-        full_context = [{"role": "user", "content": SYSTEM_PROMPT}]
+    Turns from the same user are serialized, the model call goes through the
+    semaphore-limited llm_client, and the regex data extraction runs in a worker
+    thread concurrently with the model call. The context is built before
+    extraction starts, so profile fields found in this message reach the model
+    through the message itself rather than the profile summary.
+    """
+    logging.info(f"Received message from user {user_id}: '{message[:50]}...'")
+
+    await asyncio.to_thread(get_model) # The first call imports the SDK and builds the client; keep that off the loop
+    unavailable_message = get_model_unavailable_message()
+    if unavailable_message:
+        yield (history or []) + [[message, unavailable_message]]
+        return
+
+    async with get_user_turn_lock(user_id):
+        turn = start_chat_turn(message, user_id, display_turns)
+        api_contents = build_turn_context(turn)
+        extraction_task = asyncio.create_task(asyncio.to_thread(run_health_data_extraction, turn))
+
+        previous_history = visible_chat_history(turn["session"], display_turns)
+        pending_pair = [turn["processed_message"], render_partial_response("", turn["is_emergency"])]
+        yield previous_history + [pending_pair]
+
+        bot_response_text = await cached_turn_response_async(turn)
+        try:
+            if bot_response_text is None:
+                bot_response_text = ""
+                async for bot_response_text in llm_client.stream_response(api_contents, user_id, on_complete=turn_response_cacher(turn)):
+                    pending_pair = [turn["processed_message"], render_partial_response(bot_response_text, turn["is_emergency"])]
+                    yield previous_history + [pending_pair]
+        finally:
+            # Even if the client disconnects mid-stream, finish the extraction before releasing the lock
+            health_data_extracted = await extraction_task
 
-        # Convert internal history roles ('bot') to 'model' for the API
-        api_history = []
-        for item in session.conversation_history:
-             role = "model" if item["role"] == "bot" else "user"
-             # Basic sanitization/shortening might be needed for long messages in history
-             # For now, just append content
-             api_history.append({"role": role, "content": item["message"]})
+        yield finish_chat_turn(turn, bot_response_text, health_data_extracted)
 
 
-        # Use the internal session history for the API call
-        response = model.generate_content(api_history) # Pass the converted history
+class ResponseAccumulator:
+    """
+    Response handling shared by generate_model_response and AsyncLLMClient.stream_response:
+    the safety-block check, chunk accumulation, the empty-reply and error fallbacks, and logging.
+    """
+    def __init__(self, user_id, on_complete=None):
+        self.user_id = user_id
+        self.on_complete = on_complete
+        self.request_start = time.perf_counter()
+        self.text = ""
 
-        # Check for safety ratings or blocks if necessary (response.prompt_feedback)
+    def check_blocked(self, response):
+        """Returns the reply for a prompt blocked by the safety filters, or None."""
         if response.prompt_feedback and response.prompt_feedback.block_reason:
-             logging.warning(f"Prompt blocked for user {user_id}. Reason: {response.prompt_feedback.block_reason}")
-             bot_response_text = "I cannot respond to that request due to safety guidelines."
-        elif not response.candidates or not response.candidates[0].content.parts:
-             logging.warning(f"No valid response candidate received from API for user {user_id}.")
-             bot_response_text = "I'm sorry, I couldn't generate a response for that."
-        else:
-             bot_response_text = response.text
-             logging.info(f"LLM response received for user {user_id}: '{bot_response_text[:50]}...'")
+            logging.warning(f"Prompt blocked for user {self.user_id}. Reason: {response.prompt_feedback.block_reason}")
+            return "I cannot respond to that request due to safety guidelines."
+        return None
 
-    except Exception as e:
-        logging.error(f"Error calling Gemini API for user {user_id}: {e}")
-        bot_response_text = f"I'm sorry, I encountered an error trying to generate a response. Please try again. (Error: {type(e).__name__})"
+    def add(self, chunk):
+        """Appends a chunk's text; returns False for chunks without content (e.g. only the finish reason)."""
+        if not chunk.candidates or not chunk.candidates[0].content.parts:
+            return False
+        if not self.text:
+            logging.info(f"Time to first token for user {self.user_id}: {time.perf_counter() - self.request_start:.2f}s")
+        self.text += chunk.text
+        return True
+
+    def finish(self):
+        """Ends a stream: returns the fallback reply if nothing arrived, else calls on_complete and returns None."""
+        if not self.text:
+            logging.warning(f"No valid response candidate received from API for user {self.user_id}.")
+            return "I'm sorry, I couldn't generate a response for that."
+        logging.info(f"LLM response received for user {self.user_id} in {time.perf_counter() - self.request_start:.2f}s: '{self.text[:50]}...'")
+        if self.on_complete: self.on_complete(self.text)
+        return None
+
+    def error_text(self, error):
+        """Reply after a failed call, keeping whatever was already streamed so the user doesn't lose a partial answer."""
+        logging.error(f"Error calling Gemini API for user {self.user_id}: {error}")
+        error_text = f"I'm sorry, I encountered an error trying to generate a response. Please try again. (Error: {type(error).__name__})"
+        return f"{self.text}\n\n{error_text}" if self.text else error_text
 
-    # Format the raw text response with additional context
+
+def generate_model_response(contents, user_id, stream=None, on_complete=None):
+    """
+    Calls Gemini and yields the accumulated response text as chunks arrive.
+    The last value yielded is the complete response (or a fallback message on errors).
+    on_complete(text) is called only for a complete, successful response.
+    """
+    stream = STREAM_RESPONSES if stream is None else stream
+    accumulator = ResponseAccumulator(user_id, on_complete)
     try:
-        formatted_response_html = format_health_response(
-            session, bot_response_text, processed_message, is_emergency, health_data_extracted, detected_health_data
-        )
+        response = get_model().generate_content(contents, stream=stream)
+        blocked_text = accumulator.check_blocked(response)
+        if blocked_text:
+            yield blocked_text
+            return
+        for chunk in response: # A non-streamed response iterates as a single chunk
+            if accumulator.add(chunk):
+                yield accumulator.text
+        fallback_text = accumulator.finish()
+        if fallback_text:
+            yield fallback_text
     except Exception as e:
-        logging.error(f"Error formatting health response for user {user_id}: {e}")
-        formatted_response_html = bot_response_text # Fallback to raw text on formatting error
-
+        yield accumulator.error_text(e)
 
-    # Add formatted bot response to session history (internal)
-    session.add_message("bot", formatted_response_html) # Store the final HTML
 
-    # Update analytics
-    topics = extract_health_topics(processed_message)
-    session.health_analytics["topics_discussed"].update(topics)
-    # Calculate score periodically
-    if session.health_analytics["interaction_count"] % 3 == 0:
-         session.calculate_health_score()
+def render_partial_response(bot_response_text, is_emergency):
+    """Renders an in-progress bot reply while it is streaming."""
+    body = f"<p>{bot_response_text}</p>" if bot_response_text else '<p><span class="loading-spinner"></span>Thinking...</p>'
+    if is_emergency:
+        # The emergency warning must never wait for the model
+        return EMERGENCY_BANNER_HTML + body
+    return body
 
 
-    # Update Gradio history - Gradio expects a list of [user_msg, bot_msg] pairs
-    # We reconstruct this from our internal session history for Gradio's display
+def visible_chat_history(session, display_turns=None):
+    """
+    The last `display_turns` (default CHAT_HISTORY_TURNS) pairs of the session's maintained
+    display history, preceded by a note when earlier turns are hidden. Avoids rebuilding
+    and resending the whole conversation on every turn.
+    """
+    display_turns = display_turns or CHAT_HISTORY_TURNS
+    pairs = session.display_history
+    if len(pairs) <= display_turns:
+        return list(pairs)
+    hidden = len(pairs) - display_turns
+    note = f'<p class="history-note">{hidden} earlier exchange{"s" if hidden != 1 else ""} hidden. Use "Show earlier messages" to load more.</p>'
+    return [[None, note]] + pairs[-display_turns:]
+
+def show_earlier_messages(user_id: str, display_turns: int):
+    """Pages older turns into the chat view. Returns (chat history, new display_turns)."""
+    display_turns = (display_turns or CHAT_HISTORY_TURNS) + CHAT_HISTORY_TURNS
+    session = user_sessions.get(user_id)
+    if session is None:
+        return [], display_turns
+    return visible_chat_history(session, display_turns), display_turns
+
+def build_gradio_history(conversation_history):
+    """Builds Gradio's [user_msg, bot_msg] pairs from the internal conversation history (full rebuild)."""
     gradio_history = []
     user_msg = None
-    for msg in session.conversation_history:
+    for msg in conversation_history:
         if msg["role"] == "user":
             user_msg = msg["message"] # Store the user message
         elif msg["role"] == "bot" and user_msg is not None:
@@ -1737,11 +3947,8 @@ def health_chatbot(message: str, history: list, user_id: str = "default_user"):
         elif msg["role"] == "bot" and user_msg is None:
              # This might happen if the first message is from the bot (unlikely here)
              # Or if there are consecutive bot messages (e.g. due to errors/retries)
-             # Decide how to handle - maybe display bot message alone?
              gradio_history.append([None, msg["message"]])
-
-
-    return gradio_history # Return the updated history for Gradio Chatbot component
+    return gradio_history
 
 
 def extract_health_topics(message):
@@ -1768,8 +3975,8 @@ def extract_health_topics(message):
 
 # --- Dashboard & Report Functions ---
 
-def view_health_data(user_id: str = "default_user"):
-    """Generates HTML for the Health Dashboard tab."""
+def view_health_data(user_id: str = "default_user", chart_window: str = "all"):
+    """Generates HTML for the Health Dashboard tab. `chart_window` is a CHART_WINDOWS key."""
     logging.info(f"Generating health data view for user {user_id}")
     if user_id not in user_sessions:
         return """
@@ -1800,8 +4007,9 @@ def view_health_data(user_id: str = "default_user"):
         </div>"""
 
     # Calculate health score & analyze trends
-    health_score = session.calculate_health_score()
-    trends = analyze_health_trends(session)
+    health_score = session.record_health_score()
+    user_sessions.mark_dirty(user_id)
+    trends = analyze_health_trends(session, current_score=health_score)
 
     output = f"""
     <div class="health-report">
@@ -1840,18 +4048,19 @@ def view_health_data(user_id: str = "default_user"):
             <h3 class="report-section-title">Recent Vital Signs</h3>
             <div style="display: grid; grid-template-columns: repeat(auto-fit, minmax(220px, 1fr)); gap: 16px;">""" # Use grid layout
 
-        for vital_type, measurements in session.vital_signs.items():
-            if not measurements: continue
-            latest = measurements[-1]
+        vital_charts = render_vital_charts(user_id, session.vital_signs, window_days=CHART_WINDOWS.get(chart_window))
+        for vital_type, series in session.vital_signs.items():
+            if not series: continue
+            latest = series.latest()
             formatted_type = vital_type.replace('_', ' ').title()
-            in_range = is_vital_in_normal_range(vital_type, latest["value"])
+            in_range = series.latest_in_range()
             range_color = "var(--success-color)" if in_range is True else "var(--danger-color)" if in_range is False else "var(--text-color)" # Default color if range unknown
 
             card_html = f"""
             <div class="vital-card">
                 <div class="vital-title">{formatted_type}</div>
                 <div class="vital-value" style="color: {range_color};">{latest["value"]} {latest.get("unit", "")}</div>
-                <div class="vital-timestamp">Recorded: {latest["timestamp"]}</div>"""
+                <div class="vital-timestamp">Recorded: {format_timestamp(latest["timestamp"])}</div>"""
 
             # Add trend if available
             if trends and vital_type in trends:
@@ -1866,21 +4075,9 @@ def view_health_data(user_id: str = "default_user"):
                         Trend: {trend_icon} {trend_text}
                     </div>"""
 
-            # Generate chart if enough data
-            if len(measurements) >= 2:
-                 chart_values = [m['value'] for m in measurements]
-                 chart_dates = [m['timestamp'].split()[0] for m in measurements] # Use only date for x-axis labels
-                 # Handle BP separately for plotting (e.g., plot systolic)
-                 plot_type = formatted_type
-                 plot_unit = latest.get("unit", "")
-                 if vital_type == "blood_pressure":
-                      try:
-                          chart_values = [int(str(v).split('/')[0]) for v in chart_values] # Plot systolic
-                          plot_type = "Systolic Blood Pressure"
-                          plot_unit = "mmHg"
-                      except Exception: chart_values = [] # Cannot plot BP if format wrong
-
-                 chart_url = generate_health_chart(plot_type, chart_values, chart_dates, unit=plot_unit)
+            # Chart (rendered up front for all vitals, see render_vital_charts)
+            if len(series) >= 2:
+                 chart_url = vital_charts.get(vital_type)
                  if chart_url:
                      card_html += f'<div class="health-chart"><img src="{chart_url}" alt="{formatted_type} Chart"></div>'
 
@@ -1916,8 +4113,8 @@ def view_health_data(user_id: str = "default_user"):
                     <td style="padding: 8px; border-bottom: 1px solid #eee;">
                         <span style="color: {severity_color}; font-weight: 500;">{severity.capitalize()}</span>
                     </td>
-                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{symptom["timestamp"]}</td>
-                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{symptom.get("related_factors", "")}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{format_timestamp(symptom["timestamp"])}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{symptom.get("related_factors") or ("From an uploaded document" if symptom.get("source") == "document" else "")}</td>
                 </tr>"""
         symptoms_html += """</tbody></table>"""
 
@@ -2039,8 +4236,9 @@ def generate_health_report(user_id: str = "default_user"):
     report += "</table></div>"
 
     # --- Health Score & Trend ---
-    health_score = session.calculate_health_score()
-    trends = analyze_health_trends(session) # Analyze trends
+    health_score = session.record_health_score()
+    user_sessions.mark_dirty(user_id)
+    trends = analyze_health_trends(session, current_score=health_score) # Analyze trends
     report += f"""
         <div class="report-section">
             <h3 class="report-section-title">Health Score Assessment</h3>
@@ -2086,11 +4284,11 @@ def generate_health_report(user_id: str = "default_user"):
                         </tr>
                     </thead>
                     <tbody>"""
-        for vital_type, measurements in session.vital_signs.items():
-            if not measurements: continue
-            latest = measurements[-1]
+        for vital_type, series in session.vital_signs.items():
+            if not series: continue
+            latest = series.latest()
             formatted_type = vital_type.replace('_', ' ').title()
-            in_range = is_vital_in_normal_range(vital_type, latest["value"])
+            in_range = series.latest_in_range()
             status = "Normal" if in_range is True else "Check Range" if in_range is False else "N/A"
             status_color = "var(--success-color)" if status == "Normal" else "var(--warning-color)" if status == "Check Range" else "var(--text-color)"
 
@@ -2109,7 +4307,7 @@ def generate_health_report(user_id: str = "default_user"):
                 <tr>
                     <td style="padding: 8px; border-bottom: 1px solid #eee;">{formatted_type}</td>
                     <td style="padding: 8px; border-bottom: 1px solid #eee;">{latest["value"]} {latest.get("unit", "")}</td>
-                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{latest["timestamp"]}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{format_timestamp(latest["timestamp"])}</td>
                     <td style="padding: 8px; border-bottom: 1px solid #eee; color: {status_color};">{status}</td>
                     <td style="padding: 8px; border-bottom: 1px solid #eee; color: {trend_color};">{trend_text}</td>
                 </tr>"""
@@ -2138,8 +4336,8 @@ def generate_health_report(user_id: str = "default_user"):
                  <tr>
                     <td style="padding: 8px; border-bottom: 1px solid #eee;">{symptom["symptom"]}</td>
                     <td style="padding: 8px; border-bottom: 1px solid #eee;"><span style="color: {severity_color};">{severity.capitalize()}</span></td>
-                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{symptom["timestamp"]}</td>
-                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{symptom.get("related_factors", "")}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{format_timestamp(symptom["timestamp"])}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{symptom.get("related_factors") or ("From an uploaded document" if symptom.get("source") == "document" else "")}</td>
                  </tr>"""
         report += "</tbody></table>"
         # Add frequency analysis if available
@@ -2148,6 +4346,30 @@ def generate_health_report(user_id: str = "default_user"):
             report += ", ".join([f"{s} ({c})" for s, c in trends["symptoms"]["most_frequent"]])
         report += "</div>"
 
+    # --- Readings From Uploaded Documents ---
+    if session.document_readings:
+        report += """
+            <div class="report-section">
+                <h3 class="report-section-title">Readings From Uploaded Documents (Last 10)</h3>
+                <p style="font-size: 0.85rem; color: #777;">Measurement dates are unknown; these are not part of your vital sign trends or health score.</p>
+                <table style="width: 100%; border-collapse: collapse;">
+                    <thead>
+                        <tr>
+                            <th style="text-align: left; padding: 8px; border-bottom: 2px solid var(--primary-color);">Measurement</th>
+                            <th style="text-align: left; padding: 8px; border-bottom: 2px solid var(--primary-color);">Value</th>
+                            <th style="text-align: left; padding: 8px; border-bottom: 2px solid var(--primary-color);">Uploaded</th>
+                        </tr>
+                    </thead>
+                    <tbody>"""
+        for reading in reversed(session.document_readings[-10:]):
+            report += f"""
+                 <tr>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{reading["vital_type"].replace("_", " ").title()}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{html_escape(str(reading["value"]))} {html_escape(reading["unit"] or "")}</td>
+                    <td style="padding: 8px; border-bottom: 1px solid #eee;">{format_timestamp(reading["timestamp"])}</td>
+                 </tr>"""
+        report += "</tbody></table></div>"
+
     # --- Medication Summary ---
     if session.medication_reminders:
         report += """
@@ -2206,16 +4428,11 @@ def generate_health_report(user_id: str = "default_user"):
     # Check vital signs for out-of-range values
     vital_out_of_range = False
     try: # Add try-except for safety during iteration
-        for vital_type, measurements in session.vital_signs.items():
-            if measurements: # Check if list is not empty
-                latest = measurements[-1]
-                # Ensure 'value' key exists before checking range
-                if 'value' in latest:
-                    in_range_status = is_vital_in_normal_range(vital_type, latest['value'])
-                    if in_range_status is False: # Explicitly check for False (out of range)
-                        vital_out_of_range = True
-                        logging.debug(f"Vital sign '{vital_type}' found out of range: {latest['value']}")
-                        break # Found one, no need to check further
+        for vital_type, series in session.vital_signs.items():
+            if series and series.latest_in_range() is False: # Explicitly check for False (out of range)
+                vital_out_of_range = True
+                logging.debug(f"Vital sign '{vital_type}' found out of range: {series.latest()['value']}")
+                break # Found one, no need to check further
     except Exception as e:
         logging.error(f"Error checking vital sign ranges for report recommendations: {e}")
 
@@ -2232,8 +4449,7 @@ def generate_health_report(user_id: str = "default_user"):
     # Check wellness activities
     try:
         # Check activities logged in the last 14 days
-        recent_activities_count = sum(1 for a in session.wellness_activities
-                                    if (datetime.now() - datetime.strptime(a["timestamp"], "%Y-%m-%d %H:%M:%S")).days <= 14)
+        recent_activities_count = len(session.recent_activities[14].expire())
         if recent_activities_count < 3: # Arbitrary threshold for recent activity
              action_items_report.append("Consider incorporating regular wellness activities like exercise or mindfulness into your routine.")
     except Exception as e:
@@ -2273,66 +4489,707 @@ def generate_health_report(user_id: str = "default_user"):
     return report
 
 
-def process_uploaded_file(file: gr.File, user_id: str = "default_user"):
-    """Handles uploaded files (placeholder implementation)."""
-    if file is None:
-        return "<p>No file uploaded. Please select a file.</p>"
+# --- Document Ingestion ---
 
-    logging.info(f"Processing uploaded file '{file.name}' for user {user_id}")
+def split_text_chunk(buffer, chunk_chars):
+    """
+    Splits the first chunk (at most chunk_chars) off the buffer, cutting at a
+    paragraph, line or sentence break when one falls in its second half so the
+    extractors rarely see a phrase split in two. Returns (chunk, rest).
+    """
+    window = buffer[:chunk_chars]
+    for separator in ("\n\n", "\n", ". "):
+        cut = window.rfind(separator)
+        if cut >= chunk_chars // 2:
+            cut += len(separator)
+            return buffer[:cut], buffer[cut:]
+    return window, buffer[chunk_chars:]
 
-    # In a real application, you would:
-    # 1. Securely save the file temporarily.
-    # 2. Use libraries like PyPDF2, python-docx, openpyxl, Pillow, OCR (like Tesseract via pytesseract)
-    #    to extract text or data based on file type.
-    # 3. Parse the extracted content (potentially using complex regex or another AI model pass)
-    #    to identify relevant health information (labs, diagnoses, meds).
-    # 4. Update the user's session data (e.g., add extracted vitals, conditions).
-    # 5. Provide a summary of extracted information or analysis results.
-    # 6. Securely delete the temporary file.
 
-    file_path = file.name
-    file_ext = os.path.splitext(file_path)[1].lower()
+def iter_text_chunks(path, chunk_chars=None, on_progress=None):
+    """
+    Yields text chunks from a UTF-8 text or Markdown file. The file is read in
+    DOCUMENT_READ_BYTES blocks, so memory use is bounded by the chunk size.
+    on_progress(fraction) is called after each block.
+    """
+    chunk_chars = chunk_chars or DOCUMENT_CHUNK_CHARS
+    total_bytes = max(os.path.getsize(path), 1)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace") # Tolerates a BOM and stray bytes
+    buffer, bytes_read = "", 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(DOCUMENT_READ_BYTES)
+            bytes_read += len(block)
+            buffer += decoder.decode(block, final=not block)
+            while len(buffer) >= chunk_chars:
+                chunk, buffer = split_text_chunk(buffer, chunk_chars)
+                yield chunk
+            if on_progress: on_progress(bytes_read / total_bytes)
+            if not block: break
+    if buffer.strip():
+        yield buffer
+
+
+def iter_pdf_chunks(path, chunk_chars=None, on_progress=None):
+    """
+    Yields text chunks from a PDF, extracting one page at a time. Needs the
+    optional pypdf package (ImportError otherwise). on_progress(fraction) is
+    called after each page.
+    """
+    from pypdf import PdfReader # Optional dependency, only needed for PDF uploads
+    chunk_chars = chunk_chars or DOCUMENT_CHUNK_CHARS
+    # Memory-mapped: given a path, pypdf would read the whole file into a BytesIO
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        reader = PdfReader(mapped) # Pages are parsed on access, not up front
+        page_count = max(len(reader.pages), 1)
+        buffer = ""
+        for i, page in enumerate(reader.pages):
+            try:
+                buffer += (page.extract_text() or "") + "\n\n"
+            except Exception as e:
+                logging.warning(f"Could not extract text from page {i + 1} of '{path}': {e}")
+            while len(buffer) >= chunk_chars:
+                chunk, buffer = split_text_chunk(buffer, chunk_chars)
+                yield chunk
+            if on_progress: on_progress((i + 1) / page_count)
+        if buffer.strip():
+            yield buffer
+
+
+def iter_document_chunks(path, chunk_chars=None, on_progress=None):
+    """Yields text chunks from a supported document (see DOCUMENT_EXTENSIONS)."""
+    file_ext = os.path.splitext(path)[1].lower()
+    if file_ext == ".pdf":
+        return iter_pdf_chunks(path, chunk_chars, on_progress)
+    if file_ext in DOCUMENT_EXTENSIONS:
+        return iter_text_chunks(path, chunk_chars, on_progress)
+    raise ValueError(f"Unsupported document type: {file_ext}")
+
+
+def ingest_document(session: UserSession, path, on_progress=None):
+    """
+    Streams a document through the chat extractors chunk by chunk and merges
+    the vitals, medications, conditions, allergies and symptoms they find into
+    the session. Vitals and profile numbers are kept as document readings and
+    symptoms are logged with source "document": the document's date is unknown,
+    so neither counts as a current reading. Returns a summary of what was added; on_progress(fraction,
+    summary) gets a snapshot of the running summary after each block or page.
+    """
+    reading_count = len(session.document_readings)
+    med_count = len(session.medication_reminders)
+    condition_count = len(session.user_profile["chronic_conditions"])
+    allergy_count = len(session.user_profile["allergies"])
+    symptom_count = len(session.symptom_log)
+    new_symptoms = collections.Counter()
+    counts = {"chunks": 0, "characters": 0, "failed_chunks": 0}
+
+    def current_summary():
+        nonlocal symptom_count
+        new_symptoms.update(entry["symptom"] for entry in session.symptom_log[symptom_count:]) # Only entries since the last call
+        symptom_count = len(session.symptom_log)
+        return dict(counts,
+            vitals=dict(collections.Counter(entry["vital_type"] for entry in session.document_readings[reading_count:])),
+            medications=[m["medication"] for m in session.medication_reminders[med_count:]],
+            conditions=session.user_profile["chronic_conditions"][condition_count:],
+            allergies=session.user_profile["allergies"][allergy_count:],
+            symptoms=dict(new_symptoms.most_common()),
+        )
 
-    output = f"""
+    report = (lambda fraction: on_progress(fraction, current_summary())) if on_progress else None
+    for chunk in iter_document_chunks(path, on_progress=report):
+        counts["chunks"] += 1
+        counts["characters"] += len(chunk)
+        try:
+            extract_health_data(session, chunk, extract_vital_signs(chunk), source="document")
+        except Exception as e:
+            counts["failed_chunks"] += 1
+            logging.error(f"Error extracting health data from chunk {counts['chunks']} of '{path}': {e}")
+    return current_summary()
+
+
+def render_ingestion_summary(summary):
+    """HTML report section for an ingest_document summary."""
+    items = []
+    for vital_type, count in summary["vitals"].items():
+        items.append(f"<li>{html_escape(vital_type.replace('_', ' ').title())}: {count} reading(s)</li>")
+    for label, key in (("Medications", "medications"), ("Conditions", "conditions"), ("Allergies", "allergies")):
+        if summary[key]:
+            items.append(f"<li>{label}: {html_escape(', '.join(summary[key]))}</li>")
+    if summary["symptoms"]:
+        symptoms = ", ".join(f"{symptom} ({count})" if count > 1 else symptom for symptom, count in summary["symptoms"].items())
+        items.append(f"<li>Symptoms: {html_escape(symptoms)}</li>")
+
+    html = f"""
+            <div class="report-section">
+                <h3 class="report-section-title">Extracted Health Information</h3>
+                <p>Scanned {summary['characters']:,} characters in {summary['chunks']} chunk(s).</p>"""
+    if items:
+        html += f"<ul>{''.join(items)}</ul><p>This information has been added to your health dashboard and report.</p>"
+        if summary["vitals"]:
+            html += ("<p style=\"font-size: 0.85rem; color: #777;\">Readings from documents are listed separately in your health report; "
+                     "they are not counted as your current vitals since the date they were taken is unknown.</p>")
+    else:
+        html += "<p>No vitals, medications, conditions or symptoms were recognized in this document.</p>"
+    if summary["failed_chunks"]:
+        html += f"<p style=\"color: var(--warning-color);\">{summary['failed_chunks']} chunk(s) could not be analyzed.</p>"
+    return html + "</div>"
+
+
+# --- Spreadsheet Vital Import ---
+# Device exports (glucose meters, BP cuffs, ...) are parsed a column at a time with pandas
+
+# Header keywords per column role, checked in order (component columns before "blood pressure")
+VITAL_COLUMN_KEYWORDS = [
+    ("systolic", ["systolic", "sys"]),
+    ("diastolic", ["diastolic", "dia"]),
+    ("blood_pressure", ["blood pressure", "bp"]),
+    ("heart_rate", ["heart rate", "pulse", "hr", "bpm"]),
+    ("blood_sugar", ["blood sugar", "glucose", "sugar", "bg"]),
+    ("temperature", ["temperature", "temp"]),
+    ("oxygen_saturation", ["oxygen saturation", "spo2", "o2 sat", "oxygen"]),
+    ("weight_kg", ["weight"]),
+]
+TIMESTAMP_COLUMN_KEYWORDS = ["timestamp", "datetime", "date time", "measured at", "recorded at"]
+DATE_COLUMN_KEYWORDS = ["date", "day"]
+TIME_COLUMN_KEYWORDS = ["time"]
+UNIT_COLUMN_KEYWORDS = ["unit", "units"]
+BP_CELL_PATTERN = r"^\s*(\d{2,3})\s*/\s*(\d{2,3})" # "120/80"
+NUMERIC_CELL_PATTERN = r"^\s*([-+]?\d+(?:\.\d+)?)\s*(\S.*?)?\s*$" # "98.6", "98.6 F", "5.4 mmol/L"
+IMPORT_SAMPLE_ROWS = 200 # Rows read up front to detect columns
+
+# Imported readings are stored in one canonical unit per vital; keys are normalize_unit() forms
+VITAL_IMPORT_UNITS = {"blood_pressure": "mmHg", "heart_rate": "bpm", "blood_sugar": "mg/dL",
+                      "temperature": "°F", "oxygen_saturation": "%", "weight_kg": "kg"}
+VITAL_UNIT_CONVERSIONS = {
+    "blood_sugar": {"mmol/l": lambda v: v * 18.016},
+    "temperature": {"c": lambda v: v * 9 / 5 + 32, "celsius": lambda v: v * 9 / 5 + 32},
+    "weight_kg": {"lb": lambda v: v * 0.453592, "lbs": lambda v: v * 0.453592, "pounds": lambda v: v * 0.453592},
+}
+# Readings outside these bounds (canonical units) are treated as data errors and skipped
+VITAL_PLAUSIBLE_RANGES = {"systolic": (50, 300), "diastolic": (20, 200), "heart_rate": (20, 300), "blood_sugar": (10, 1500),
+                          "temperature": (80, 115), "oxygen_saturation": (50, 100), "weight_kg": (1, 500)}
+
+def normalize_header(header):
+    """Splits a spreadsheet header into (lowercase name, unit in brackets or "")."""
+    header = str(header)
+    unit_match = re.search(r"[(\[]([^)\]]*)[)\]]", header)
+    name = re.sub(r"[(\[][^)\]]*[)\]]", " ", header).lower()
+    name = " ".join(re.sub(r"[_\-/.:]", " ", name).split())
+    return name, unit_match.group(1).strip() if unit_match else ""
+
+def normalize_unit(unit):
+    """Comparable form of a unit string: "°C" -> "c", "mmol/L" -> "mmol/l"."""
+    return re.sub(r"°|degrees?|\s", "", str(unit).lower())
+
+def header_matches(name, keywords):
+    return any(re.search(r"\b" + re.escape(keyword) + r"\b", name) for keyword in keywords)
+
+def detect_import_columns(sample):
+    """
+    Assigns column roles from the headers of a sample frame, falling back to
+    the sampled cell contents for blood pressure ("120/80") and timestamp
+    columns. Returns {"vitals": {role: (column, header unit)}, "timestamp",
+    "date", "time", "unit"} (column names, or None).
+    """
+    import pandas as pd
+    roles = {"vitals": {}, "timestamp": None, "date": None, "time": None, "unit": None}
+    unassigned = []
+    for column in sample.columns:
+        name, header_unit = normalize_header(column)
+        if roles["timestamp"] is None and header_matches(name, TIMESTAMP_COLUMN_KEYWORDS):
+            roles["timestamp"] = column
+            continue
+        if roles["date"] is None and header_matches(name, DATE_COLUMN_KEYWORDS):
+            roles["date"] = column
+            continue
+        if roles["time"] is None and header_matches(name, TIME_COLUMN_KEYWORDS):
+            roles["time"] = column
+            continue
+        if roles["unit"] is None and name in UNIT_COLUMN_KEYWORDS:
+            roles["unit"] = column
+            continue
+        role = next((role for role, keywords in VITAL_COLUMN_KEYWORDS if header_matches(name, keywords)), None)
+        if role is not None and role not in roles["vitals"]:
+            roles["vitals"][role] = (column, header_unit)
+        else:
+            unassigned.append(column)
+
+    # Content sniffing for columns whose headers said nothing useful
+    for column in unassigned:
+        cells = sample[column].dropna()
+        if cells.empty or pd.api.types.is_numeric_dtype(cells):
+            continue
+        cells = cells.astype(str)
+        if not ({"blood_pressure", "systolic"} & roles["vitals"].keys()) and cells.str.match(BP_CELL_PATTERN).mean() >= 0.8:
+            roles["vitals"]["blood_pressure"] = (column, "")
+        elif roles["timestamp"] is None and roles["date"] is None and pd.to_datetime(cells, errors="coerce", format="mixed").notna().mean() >= 0.8:
+            roles["timestamp"] = column
+    if roles["timestamp"] is None and roles["date"] is None and roles["time"] is not None:
+        roles["timestamp"], roles["time"] = roles["time"], None # A lone "Time" column holding full datetimes
+    return roles
+
+def csv_separator(path):
+    """Comma, semicolon or tab, whichever the header line uses most."""
+    with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+        first_line = f.readline()
+    return max([",", ";", "\t"], key=first_line.count)
+
+def read_import_frame(path, nrows=None, usecols=None):
+    """Reads a CSV (comma, semicolon or tab separated) or Excel file into a DataFrame."""
+    import pandas as pd
+    if path.lower().endswith(".csv"):
+        return pd.read_csv(path, sep=csv_separator(path), nrows=nrows, usecols=usecols, skipinitialspace=True, encoding="utf-8-sig")
+    return pd.read_excel(path, nrows=nrows, usecols=usecols) # Needs openpyxl (xlsx) or xlrd (xls)
+
+def iter_csv_frames(path, usecols, chunk_rows=None):
+    """Yields (DataFrame, fraction of the file read) pieces of at most chunk_rows rows, so memory is bounded by the chunk."""
+    import pandas as pd
+    total_bytes = max(os.path.getsize(path), 1)
+    with open(path, "rb") as f:
+        reader = pd.read_csv(f, sep=csv_separator(path), usecols=usecols, skipinitialspace=True, encoding="utf-8-sig",
+                             chunksize=chunk_rows or IMPORT_CHUNK_ROWS)
+        for frame in reader:
+            yield frame, min(f.tell() / total_bytes, 1.0)
+
+def localize_import_times(parsed):
+    """
+    Attaches the local time zone to naive device times using the UTC offset in effect
+    on each reading's date. Times that don't exist (spring-forward gap) move forward;
+    ambiguous ones (the repeated fall-back hour) become NaT and are skipped as undated.
+    """
+    name = local_timezone_name()
+    if name:
+        try:
+            return parsed.dt.tz_localize(name, ambiguous="NaT", nonexistent="shift_forward")
+        except (KeyError, ValueError) as e: # Unknown zone name, e.g. a POSIX TZ string
+            logging.warning(f"Could not localize imported times to '{name}', using the current UTC offset: {e}")
+    return parsed.dt.tz_localize(datetime.now().astimezone().tzinfo)
+
+def parse_import_timestamps(frame, roles):
+    """Epoch seconds per row (NaN where missing or unparseable). Naive times are in the server's local zone."""
+    import pandas as pd
+    if roles["timestamp"] is not None:
+        raw = frame[roles["timestamp"]]
+        if pd.api.types.is_numeric_dtype(raw) and not pd.api.types.is_bool_dtype(raw):
+            epoch = raw.to_numpy(dtype=float, na_value=np.nan)
+            return np.where(epoch > 1e11, epoch / 1000, epoch) # Millisecond epochs
+    else:
+        raw = frame[roles["date"]].astype("string")
+        if roles["time"] is not None:
+            raw = raw + " " + frame[roles["time"]].astype("string").fillna("")
+
+    if pd.api.types.is_datetime64_any_dtype(raw):
+        parsed = raw
+    else:
+        text = raw.astype("string")
+        parsed = pd.to_datetime(text, errors="coerce") # Format inferred from the first row, then applied vectorized
+        if parsed.isna().sum() > text.isna().sum():
+            parsed = pd.to_datetime(text, errors="coerce", format="mixed") # Mixed formats: slower per-element parse
+
+    if getattr(parsed.dt, "tz", None) is None:
+        parsed = localize_import_times(parsed)
+    parsed = parsed.dt.tz_convert("UTC").dt.tz_localize(None)
+    missing = parsed.isna().to_numpy()
+    epoch = parsed.to_numpy(dtype="datetime64[ns]").astype(np.int64) / 1e9
+    epoch[missing] = np.nan
+    return epoch
+
+def parse_import_values(column):
+    """(float values, per-row inline units or None) for a vital column; unparseable cells become NaN."""
+    import pandas as pd
+    if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+        return column.to_numpy(dtype=float, na_value=np.nan), None
+    parts = column.astype("string").str.extract(NUMERIC_CELL_PATTERN)
+    return pd.to_numeric(parts[0], errors="coerce").to_numpy(dtype=float, na_value=np.nan), parts[1]
+
+def convert_import_units(vital_type, values, units):
+    """Converts values to the vital's canonical unit; rows without a unit get the chat's inference heuristics."""
+    units = units.fillna("").astype(str).map(normalize_unit).to_numpy() if units is not None else np.full(len(values), "")
+    missing = units == ""
+    if vital_type == "temperature":
+        units = np.where(missing & (values <= 50), "c", units) # Same Celsius heuristic as chat extraction
+    elif vital_type == "blood_sugar":
+        units = np.where(missing & (values < 35), "mmol/l", units) # mg/dL readings are never this low
+    for unit, convert in VITAL_UNIT_CONVERSIONS.get(vital_type, {}).items():
+        mask = units == unit
+        if mask.any():
+            values[mask] = np.round(convert(values[mask]), 1)
+    return values
+
+def parse_import_vital(frame, role, column, header_unit, vitals, row_units):
+    """(vital_type, values, values2 or None) for one detected vital column of a frame, in canonical units."""
+    import pandas as pd
+    if role == "systolic":
+        values, _ = parse_import_values(frame[column])
+        values2, _ = parse_import_values(frame[vitals["diastolic"][0]])
+        return "blood_pressure", values, values2
+    if role == "blood_pressure":
+        parts = frame[column].astype("string").str.extract(BP_CELL_PATTERN)
+        return (role, pd.to_numeric(parts[0], errors="coerce").to_numpy(dtype=float, na_value=np.nan),
+                pd.to_numeric(parts[1], errors="coerce").to_numpy(dtype=float, na_value=np.nan))
+    values, units = parse_import_values(frame[column])
+    if row_units is not None:
+        units = row_units if units is None else units.fillna(row_units)
+    if header_unit:
+        units = pd.Series(header_unit, index=frame.index, dtype="string") if units is None else units.fillna(header_unit)
+    return role, convert_import_units(role, values, units), None
+
+def in_normal_range(vital_type, values, values2=None):
+    """Boolean mask of readings (canonical units) within get_normal_range; both components for blood pressure."""
+    with np.errstate(invalid="ignore"):
+        if vital_type == "blood_pressure":
+            sys_low, sys_high = get_normal_range("systolic blood pressure")
+            dia_low, dia_high = get_normal_range("diastolic blood pressure")
+            return (values >= sys_low) & (values <= sys_high) & (values2 >= dia_low) & (values2 <= dia_high)
+        normal_range = get_normal_range(vital_type.replace("_", " "))
+        return (values >= normal_range[0]) & (values <= normal_range[1]) if normal_range else np.ones(len(values), dtype=bool)
+
+def import_vital_spreadsheet(session: UserSession, path, on_progress=None):
+    """
+    Bulk-imports vital readings from a CSV/XLSX device export. Columns are
+    detected from a sample, then values, units and timestamps are parsed a
+    column at a time (CSVs in IMPORT_CHUNK_ROWS pieces). Undated, implausible
+    and already-stored readings are skipped, readings outside get_normal_range
+    are counted, and each vital is added with one VitalSeries.extend at the end.
+    Returns a summary; on_progress(fraction, summary) gets a snapshot of the
+    running summary (None before parsing starts). Raises ValueError if no
+    usable columns are found.
+    """
+    report = on_progress or (lambda fraction, summary: None)
+    is_csv = path.lower().endswith(".csv")
+    frame = read_import_frame(path, nrows=IMPORT_SAMPLE_ROWS) if is_csv else read_import_frame(path)
+    roles = detect_import_columns(frame.head(IMPORT_SAMPLE_ROWS))
+    vitals = roles["vitals"]
+    if ("systolic" in vitals) != ("diastolic" in vitals):
+        vitals.pop("systolic", None) # A lone systolic or diastolic column cannot make a blood pressure reading
+        vitals.pop("diastolic", None)
+    if not vitals:
+        raise ValueError("No vital sign columns were recognized (expected headers such as Glucose, Blood Pressure, Pulse).")
+    if roles["timestamp"] is None and roles["date"] is None:
+        raise ValueError("No date/time column was found.")
+    report(0.05, None)
+
+    if is_csv: # Re-read in chunks, only the columns in use
+        used = [column for column in (roles["timestamp"], roles["date"], roles["time"], roles["unit"]) if column is not None]
+        used += [column for column, _ in vitals.values()]
+        frames = iter_csv_frames(path, used)
+    else:
+        frames = [(frame, 1.0)]
+
+    summary = {"rows": 0, "undated": 0, "vitals": {}}
+    pieces = collections.defaultdict(list) # vital_type -> [(timestamps, values, values2)] kept per chunk
+    stored_timestamps = {} # Existing readings, for duplicate detection
+    for frame, fraction in frames:
+        timestamps = parse_import_timestamps(frame, roles)
+        row_units = frame[roles["unit"]].astype("string") if roles["unit"] is not None and len(vitals) == 1 else None
+        summary["rows"] += len(frame)
+        summary["undated"] += int(np.isnan(timestamps).sum())
+
+        for role, (column, header_unit) in vitals.items():
+            if role == "diastolic":
+                continue # Handled with systolic
+            vital_type, values, values2 = parse_import_vital(frame, role, column, header_unit, vitals, row_units)
+
+            valid = ~np.isnan(timestamps) & ~np.isnan(values)
+            if vital_type == "blood_pressure":
+                valid &= ~np.isnan(values2)
+                bounds = ((values, VITAL_PLAUSIBLE_RANGES["systolic"]), (values2, VITAL_PLAUSIBLE_RANGES["diastolic"]))
+            else:
+                bounds = ((values, VITAL_PLAUSIBLE_RANGES.get(vital_type, (-np.inf, np.inf))),)
+            with np.errstate(invalid="ignore"):
+                for column_values, (low, high) in bounds:
+                    valid &= (column_values >= low) & (column_values <= high)
+            if vital_type not in stored_timestamps:
+                existing = session.vital_signs.get(vital_type)
+                stored_timestamps[vital_type] = existing.timestamps.copy() if existing is not None else np.empty(0)
+            duplicates = valid & np.isin(timestamps, stored_timestamps[vital_type])
+            keep = valid & ~duplicates
+
+            # Normal-range check on the kept readings (informational; abnormal readings are still imported)
+            in_range = in_normal_range(vital_type, values, values2)
+
+            kept_timestamps = timestamps[keep]
+            pieces[vital_type].append((kept_timestamps, values[keep], values2[keep] if values2 is not None else None))
+            stats = summary["vitals"].setdefault(vital_type, {"imported": 0, "invalid": 0, "duplicates": 0, "out_of_range": 0, "first": None, "last": None})
+            stats["imported"] += len(kept_timestamps)
+            stats["invalid"] += int(len(valid) - valid.sum())
+            stats["duplicates"] += int(duplicates.sum())
+            stats["out_of_range"] += int((keep & ~in_range).sum())
+            if len(kept_timestamps):
+                first, last = float(kept_timestamps.min()), float(kept_timestamps.max())
+                stats["first"] = first if stats["first"] is None else min(stats["first"], first)
+                stats["last"] = last if stats["last"] is None else max(stats["last"], last)
+        report(0.05 + 0.9 * fraction, {**summary, "vitals": {k: dict(v) for k, v in summary["vitals"].items()}})
+
+    for vital_type, parts in pieces.items():
+        values2 = np.concatenate([p[2] for p in parts]) if vital_type == "blood_pressure" else None
+        session.add_vital_readings(vital_type, np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]),
+                                   values2, VITAL_IMPORT_UNITS[vital_type])
+    report(1.0, summary)
+    return summary
+
+def render_import_summary(summary):
+    """HTML report section for an import_vital_spreadsheet summary."""
+    rows = []
+    for vital_type, stats in summary["vitals"].items():
+        span = f"{format_timestamp(stats['first'], '%Y-%m-%d')} – {format_timestamp(stats['last'], '%Y-%m-%d')}" if stats["imported"] else "–"
+        rows.append(
+            f"<tr><td>{html_escape(vital_type.replace('_', ' ').title())}</td><td>{stats['imported']:,}</td>"
+            f"<td>{stats['out_of_range']:,}</td><td>{stats['invalid']:,}</td><td>{stats['duplicates']:,}</td><td>{span}</td></tr>"
+        )
+    html = f"""
+            <div class="report-section">
+                <h3 class="report-section-title">Imported Vital Signs</h3>
+                <p>Read {summary['rows']:,} row(s).</p>
+                <table style="width: 100%; border-collapse: collapse;">
+                    <tr><th>Vital</th><th>Imported</th><th>Outside normal range</th><th>Skipped (invalid)</th><th>Skipped (already stored)</th><th>Dates</th></tr>
+                    {''.join(rows)}
+                </table>"""
+    if summary["undated"]:
+        html += f"<p style=\"color: var(--warning-color);\">{summary['undated']:,} row(s) had no readable date and were skipped.</p>"
+    return html + "<p>Imported readings appear in your health dashboard charts.</p></div>"
+
+
+# --- Upload Jobs ---
+# Uploads are processed by background jobs so a large file never holds a request worker. A job
+# imports into a scratch session and merges it into the user's session at the end, under the
+# user's turn lock, so chat stays responsive while it runs and a cancelled job leaves no trace.
+
+UPLOAD_IMPORTERS = { # Extension group -> (importer, summary renderer, progress label, missing-dependency hint)
+    "document": (ingest_document, render_ingestion_summary, "Extracting health information",
+                 "PDF support needs the optional <code>pypdf</code> package (<code>pip install pypdf</code>)."),
+    "spreadsheet": (import_vital_spreadsheet, render_import_summary, "Importing vital signs",
+                    "Spreadsheet import needs <code>pandas</code> (and <code>openpyxl</code> for Excel files)."),
+}
+
+class UploadJobCancelled(Exception):
+    """Raised from a job's progress callback once cancellation was requested."""
+
+class UploadJob:
+    """State of one upload job; the UI polls it by job_id."""
+    def __init__(self, user_id, file_path):
+        self.job_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.file_path = file_path
+        self.file_name = os.path.basename(file_path)
+        self.kind = "document" if os.path.splitext(file_path)[1].lower() in DOCUMENT_EXTENSIONS else "spreadsheet"
+        self.status = "queued" # queued -> running -> done | failed | cancelled
+        self.progress = 0.0
+        self.partial = None # Latest summary snapshot from the importer
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancel_requested = threading.Event()
+        self.task = None # Keeps the asyncio task referenced
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def on_progress(self, fraction, summary=None):
+        """Importer progress callback (worker thread); cancellation takes effect here."""
+        if self.cancel_requested.is_set():
+            raise UploadJobCancelled()
+        self.progress = fraction
+        if summary is not None:
+            self.partial = summary
+
+
+class UploadJobManager:
+    """
+    Runs upload jobs as tasks on the server's event loop, at most `max_workers`
+    importing at a time, and keeps finished jobs pollable for `retention`
+    seconds. Jobs live in server memory: they survive a browser refresh, not
+    a server restart.
+    """
+    def __init__(self, max_workers=UPLOAD_JOB_WORKERS, retention=UPLOAD_JOB_RETENTION):
+        self.jobs = {} # job_id -> UploadJob
+        self.max_workers = max_workers
+        self.retention = retention
+        self.semaphore = None # Created on first submit, inside the running loop
+
+    def submit(self, user_id, file_path):
+        """Queues a job for the file and returns it. Must be called on the event loop."""
+        self.prune()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+        job = UploadJob(user_id, file_path)
+        self.jobs[job.job_id] = job
+        job.task = asyncio.get_running_loop().create_task(self.run(job))
+        logging.info(f"Upload job {job.job_id} queued for user {user_id}: '{job.file_name}'")
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id) if job_id else None
+
+    def cancel(self, job_id):
+        """Requests cancellation; the job stops at its next progress report. Returns False if it already finished."""
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return False
+        job.cancel_requested.set()
+        return True
+
+    def prune(self, now=None):
+        """Drops finished jobs older than the retention period."""
+        now = time.time() if now is None else now
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and now - job.finished_at > self.retention]:
+            del self.jobs[job_id]
+
+    async def run(self, job):
+        importer = UPLOAD_IMPORTERS[job.kind][0]
+        try:
+            async with self.semaphore:
+                if job.cancel_requested.is_set():
+                    raise UploadJobCancelled()
+                job.status = "running"
+                scratch = UserSession(job.user_id)
+                summary = await asyncio.to_thread(importer, scratch, job.file_path, job.on_progress)
+            async with get_user_turn_lock(job.user_id):
+                if job.user_id not in user_sessions:
+                    user_sessions[job.user_id] = UserSession(job.user_id)
+                    logging.info(f"New session started for user {job.user_id}")
+                session = user_sessions[job.user_id]
+                skipped = session.merge_from(scratch)
+                user_sessions.mark_dirty(job.user_id, session)
+            for vital_type, rows in skipped.items(): # Readings already stored before this upload
+                stats = summary["vitals"].get(vital_type)
+                if rows.any() and isinstance(stats, dict):
+                    series = scratch.vital_signs[vital_type]
+                    in_range = in_normal_range(vital_type, series.values[rows], series.values2[rows] if series.is_pair else None)
+                    stats["imported"] -= int(rows.sum())
+                    stats["duplicates"] += int(rows.sum())
+                    stats["out_of_range"] -= int((~in_range).sum())
+                    merged = series.timestamps[~rows]
+                    stats["first"], stats["last"] = (float(merged.min()), float(merged.max())) if merged.size else (None, None)
+            job.result, job.progress, job.status = summary, 1.0, "done"
+        except UploadJobCancelled:
+            job.status = "cancelled"
+        except ImportError as e:
+            logging.error(f"Upload job {job.job_id} is missing a dependency: {e}")
+            job.error, job.status = UPLOAD_IMPORTERS[job.kind][3], "failed"
+        except Exception as e:
+            logging.error(f"Upload job {job.job_id} failed for user {job.user_id}: {e}")
+            job.error, job.status = html_escape(str(e)), "failed"
+        finally:
+            job.finished_at = time.time()
+            logging.info(f"Upload job {job.job_id} finished: {job.status}")
+
+upload_jobs = UploadJobManager()
+
+
+def render_upload_header(file_name, file_ext):
+    return f"""
     <div class="health-report">
         <div class="report-header"><h2>File Processing Result</h2></div>
-        <p>Received file: <strong>{os.path.basename(file_path)}</strong> (Type: {file_ext})</p>"""
+        <p>Received file: <strong>{html_escape(file_name)}</strong> (Type: {html_escape(file_ext)})</p>"""
+
+def render_upload_job(job):
+    """Status HTML for an upload job: progress and partial results while running, the summary when done."""
+    renderer, label = UPLOAD_IMPORTERS[job.kind][1], UPLOAD_IMPORTERS[job.kind][2]
+    output = render_upload_header(job.file_name, os.path.splitext(job.file_name)[1].lower())
+    if job.status in ("queued", "running"):
+        percent = round(job.progress * 100)
+        state = "Waiting for a free worker..." if job.status == "queued" else f"{label}... {percent}%"
+        output += f"""
+        <p>{state}</p>
+        <div class="progress-bar"><div class="progress-bar-inner" style="width: {percent}%"></div></div>
+        <p style="font-size: 0.85rem; color: #777;">You can keep chatting or reload this tab; results are added to your data when processing finishes.</p>"""
+        if job.partial is not None:
+            output += "<p><em>Found so far:</em></p>" + renderer(job.partial)
+    elif job.status == "done":
+        output += renderer(job.result)
+    elif job.status == "cancelled":
+        output += "<p>Processing was cancelled. Nothing from this file was added to your data.</p>"
+    else:
+        output += f"""
+            <p style="color: var(--danger-color);">Could not process this file: {job.error}</p>"""
+    return output + "</div>"
 
-    if file_ext in [".pdf", ".txt", ".md", ".docx", ".jpg", ".png"]:
+def render_unanalyzed_upload(file_path, file_ext):
+    """Result HTML for file types that are not analyzed."""
+    output = render_upload_header(os.path.basename(file_path), file_ext)
+    if file_ext in [".docx", ".jpg", ".jpeg", ".png"]:
          output += """
             <div class="report-section">
                 <h3 class="report-section-title">Analysis (Simulated)</h3>
-                <p><strong>Demo Note:</strong> File content analysis is not implemented in this version.</p>
-                <p>In a full implementation, the system would attempt to extract key health information like:</p>
-                <ul>
-                    <li>Diagnoses and Conditions</li>
-                    <li>Lab Results (e.g., Cholesterol, Blood Counts)</li>
-                    <li>Medications and Dosages</li>
-                    <li>Vital Signs Records</li>
-                    <li>Procedure Notes</li>
-                </ul>
-                <p>Extracted data would be added to your health dashboard and report.</p>
-                <p>You could then ask questions like: <em>"Summarize the key findings from the uploaded report"</em> or <em>"Explain the lab results in the document."</em></p>
-            </div>"""
-    elif file_ext in [".csv", ".xlsx", ".xls"]:
-         output += """
-            <div class="report-section">
-                <h3 class="report-section-title">Data File Analysis (Simulated)</h3>
-                 <p><strong>Demo Note:</strong> Spreadsheet analysis is not implemented in this version.</p>
-                 <p>In a full implementation, the system would parse the data to identify trends, generate visualizations, and integrate the information (e.g., blood sugar readings over time) into your dashboard.</p>
+                <p><strong>Demo Note:</strong> Word documents and images (which would need OCR) are not analyzed in this version.</p>
+                <p>Export the document as PDF or plain text to have vitals, medications and conditions extracted automatically.</p>
             </div>"""
     else:
         output += f"""
-            <p style="color: var(--danger-color);">File type '{file_ext}' is not currently supported for analysis in this demo.</p>
-            <p>Supported types (simulation): PDF, TXT, DOCX, JPG, PNG, CSV, XLSX.</p>
+            <p style="color: var(--danger-color);">File type '{html_escape(file_ext)}' is not currently supported for analysis in this demo.</p>
+            <p>Supported types: PDF, TXT, MD, CSV, XLSX (analyzed); DOCX, JPG, PNG (simulation).</p>
             """
+    return output + "</div>"
+
+
+async def process_uploaded_file(file, user_id: str = "default_user"):
+    """
+    Handles uploaded files. Text, Markdown and PDF documents (streamed through
+    the health data extractors) and CSV/Excel device exports (bulk-imported as
+    vital readings) start a background upload job. Returns (job id, status
+    HTML, poll timer update).
+    """
+    if file is None:
+        return "", "<p>No file uploaded. Please select a file.</p>", gr.Timer(active=False)
+
+    file_path = file if isinstance(file, str) else file.name # gr.File passes a path (or a tempfile wrapper)
+    file_ext = os.path.splitext(file_path)[1].lower()
+    logging.info(f"Processing uploaded file '{file_path}' for user {user_id}")
+
+    if file_ext in DOCUMENT_EXTENSIONS or file_ext in SPREADSHEET_EXTENSIONS:
+        job = upload_jobs.submit(user_id, file_path)
+        return job.job_id, render_upload_job(job), gr.Timer(active=True)
+    return "", render_unanalyzed_upload(file_path, file_ext), gr.Timer(active=False)
+
+
+def poll_upload_job(job_id: str):
+    """Timer tick: refreshes the job status and stops polling once the job has finished."""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        # Unknown or expired job (e.g. restored after a restart): leave the tab as it is
+        return gr.update(), gr.Timer(active=False)
+    return render_upload_job(job), gr.Timer(active=not job.finished)
+
+
+def resume_upload_job(job_id: str, user_id: str):
+    """
+    Page load: resumes polling a job restored from the tab's sessionStorage. The
+    page adopts the job's user ID, whose session receives the results, in place
+    of the fresh one it was given.
+    """
+    job = upload_jobs.get(job_id) if job_id else None
+    if job is None:
+        return gr.update(), gr.Timer(active=False), user_id
+    logging.info(f"Resuming upload job {job_id} for user {job.user_id}")
+    return render_upload_job(job), gr.Timer(active=not job.finished), job.user_id
 
-    output += "</div>"
-    return output
+
+def cancel_upload_job(job_id: str):
+    """Requests cancellation of the current upload job."""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        return "<p>No upload is being processed.</p>"
+    if upload_jobs.cancel(job_id):
+        logging.info(f"Cancellation requested for upload job {job_id}")
+    return render_upload_job(job)
 
 
 # --- Gradio Interface Definition ---
 
+# Upload job ID persistence across page reloads (sessionStorage: per tab, so tabs don't share a job)
+store_upload_job_js = """
+(job_id) => {
+    if (job_id) { sessionStorage.setItem('mediguide-upload-job', job_id); }
+    return job_id;
+}
+"""
+restore_upload_job_js = """
+() => sessionStorage.getItem('mediguide-upload-job') || ''
+"""
+
 # JS function to set textbox value and click submit
 # (Using _js parameter for simple cases, more complex JS might need different approach)
 set_and_submit_js = """
@@ -2359,7 +5216,7 @@ set_and_submit_js = """
 
 
 with gr.Blocks(css=custom_css, title="MediGuide AI", theme=gr.themes.Soft()) as demo:
-    user_id_state = gr.State("user_" + str(random.randint(1000, 9999))) # Simple unique ID per session
+    user_id_state = gr.State(new_session_id) # Called per page load: a fresh collision-free ID per browser session
 
     # Header
     gr.HTML("""
@@ -2406,6 +5263,9 @@ with gr.Blocks(css=custom_css, title="MediGuide AI", theme=gr.themes.Soft()) as
                 show_copy_button=True,
                
             )
+            # Long conversations show only the latest turns; this pages older ones back in
+            display_turns_state = gr.State(CHAT_HISTORY_TURNS)
+            show_earlier_btn = gr.Button("⬆️ Show earlier messages", size="sm", variant="secondary")
 
             with gr.Row():
                 msg_input = gr.Textbox(
@@ -2432,6 +5292,7 @@ with gr.Blocks(css=custom_css, title="MediGuide AI", theme=gr.themes.Soft()) as
             with gr.Tabs():
                 with gr.TabItem("📊 Health Dashboard"):
                     health_data_output = gr.HTML("<p style='text-align: center; padding: 20px; color: #777;'>Click 'View/Update Dashboard' to load your health summary.</p>")
+                    chart_window_radio = gr.Radio(list(CHART_WINDOWS), value="all", label="Chart window", container=False)
                     view_data_btn = gr.Button("🔄 View/Update Dashboard", variant="secondary") # Use icon
 
                 with gr.TabItem("📋 Health Report"):
@@ -2441,13 +5302,17 @@ with gr.Blocks(css=custom_css, title="MediGuide AI", theme=gr.themes.Soft()) as
                 with gr.TabItem("⬆️ Upload Records"):
                      gr.HTML("""
                     <div style="margin-bottom: 15px; padding: 10px;">
-                        <h4 style="margin-top: 0;">Upload Medical Document (Demo)</h4>
-                        <p style="font-size: 0.9rem; color: #555;">Upload PDF, TXT, JPG, PNG files. (Analysis is simulated).</p>
+                        <h4 style="margin-top: 0;">Upload Medical Document</h4>
+                        <p style="font-size: 0.9rem; color: #555;">PDF, TXT and Markdown documents are scanned for vitals, medications, conditions and symptoms. CSV and Excel exports from glucose meters, blood pressure cuffs and similar devices are imported into your vital sign history. (Image analysis is simulated).</p>
                     </div>""")
                      # Accept common document/image types
-                     file_upload = gr.File(label="Select file", file_types=["pdf", "txt", "jpg", "jpeg", "png", "csv", "xlsx"], height=100)
+                     file_upload = gr.File(label="Select file", file_types=["pdf", "txt", "md", "jpg", "jpeg", "png", "csv", "xlsx"], height=100)
                      upload_button = gr.Button("⚙️ Process Uploaded File", variant="secondary")
+                     cancel_upload_button = gr.Button("✖ Cancel Processing", variant="stop", size="sm")
                      upload_output = gr.HTML("<p style='text-align: center; padding: 20px; color: #777;'>Upload a file and click 'Process'.</p>")
+                     # Current job ID, mirrored to sessionStorage so a reloaded tab resumes the job and its user session
+                     upload_job_id = gr.Textbox(visible=False, elem_id="upload-job-id")
+                     upload_timer = gr.Timer(UPLOAD_POLL_INTERVAL, active=False)
 
                 with gr.TabItem("ℹ️ Resources & Emergency"):
                     gr.HTML("""
@@ -2508,9 +5373,11 @@ with gr.Blocks(css=custom_css, title="MediGuide AI", theme=gr.themes.Soft()) as
 
     # When user submits message (Enter key)
     msg_input.submit(
-        health_chatbot,
-        inputs=[msg_input, chatbot_display, user_id_state],
-        outputs=[chatbot_display] # Only update chatbot
+        health_chatbot_async,
+        inputs=[msg_input, chatbot_display, user_id_state, display_turns_state],
+        outputs=[chatbot_display], # Only update chatbot
+        concurrency_limit=QUEUE_CONCURRENCY,
+        concurrency_id="chat" # Enter and Send share one pool of chat workers
     ).then(
         lambda: "", # Function to return empty string
         inputs=None,
@@ -2520,9 +5387,11 @@ with gr.Blocks(css=custom_css, title="MediGuide AI", theme=gr.themes.Soft()) as
 
     # When user clicks Send button
     submit_btn.click(
-        health_chatbot,
-        inputs=[msg_input, chatbot_display, user_id_state],
-        outputs=[chatbot_display]
+        health_chatbot_async,
+        inputs=[msg_input, chatbot_display, user_id_state, display_turns_state],
+        outputs=[chatbot_display],
+        concurrency_limit=QUEUE_CONCURRENCY,
+        concurrency_id="chat" # Enter and Send share one pool of chat workers
      ).then(
         lambda: "",
         inputs=None,
@@ -2530,12 +5399,23 @@ with gr.Blocks(css=custom_css, title="MediGuide AI", theme=gr.themes.Soft()) as
         queue=False
     )
 
+    show_earlier_btn.click(show_earlier_messages, inputs=[user_id_state, display_turns_state],
+                           outputs=[chatbot_display, display_turns_state])
+
     # Dashboard and Report buttons
-    view_data_btn.click(view_health_data, inputs=[user_id_state], outputs=[health_data_output])
+    view_data_btn.click(view_health_data, inputs=[user_id_state, chart_window_radio], outputs=[health_data_output])
+    chart_window_radio.change(view_health_data, inputs=[user_id_state, chart_window_radio], outputs=[health_data_output])
     generate_report_btn.click(generate_health_report, inputs=[user_id_state], outputs=[report_output])
 
-    # File upload button
-    upload_button.click(process_uploaded_file, inputs=[file_upload, user_id_state], outputs=[upload_output])
+    # File upload: start a background job, then poll it until it finishes
+    upload_button.click(
+        process_uploaded_file, inputs=[file_upload, user_id_state], outputs=[upload_job_id, upload_output, upload_timer]
+    ).then(None, inputs=[upload_job_id], outputs=None, js=store_upload_job_js)
+    upload_timer.tick(poll_upload_job, inputs=[upload_job_id], outputs=[upload_output, upload_timer])
+    cancel_upload_button.click(cancel_upload_job, inputs=[upload_job_id], outputs=[upload_output])
+    demo.load(None, inputs=None, outputs=[upload_job_id], js=restore_upload_job_js).then(
+        resume_upload_job, inputs=[upload_job_id, user_id_state], outputs=[upload_output, upload_timer, user_id_state]
+    )
 
     click_submit_js = """
     () => {
@@ -2600,6 +5480,7 @@ with gr.Blocks(css=custom_css, title="MediGuide AI", theme=gr.themes.Soft()) as
 
 # --- Launch the App ---
 if __name__ == "__main__":
+    from PIL import Image
     # Create dummy static files if they don't exist (for Gradio avatar paths)
     os.makedirs("./static", exist_ok=True)
     if not os.path.exists("./static/user_avatar.png"):
@@ -2617,8 +5498,16 @@ if __name__ == "__main__":
             logging.warning(f"Could not create placeholder bot avatar: {e}")
 
 
+    # Fork the chart workers (matplotlib backend only) before Gradio starts its threads
+    chart_workers = get_chart_executor()
+    if chart_workers is not None:
+        chart_workers.submit(int).result()
+
+    # Build the Gemini client in the background so the UI comes up without waiting for the SDK import
+    threading.Thread(target=get_model, name="model-init", daemon=True).start()
+
     logging.info("Launching Gradio Interface...")
-    demo.queue().launch(
+    demo.queue(default_concurrency_limit=QUEUE_CONCURRENCY).launch(
         # share=True, # Creates a public link - Use with caution due to API key/data
         debug=True, # Set to True for more detailed Gradio errors
         share=True,